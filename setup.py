@@ -32,6 +32,7 @@ def discover_and_run_tests():
     # run the test suite
     test_runner.run(test_suite)
 
+from setuptools import Command
 from setuptools.command.test import test
 
 class DiscoverTest(test):
@@ -43,6 +44,30 @@ class DiscoverTest(test):
     def run_tests(self):
         discover_and_run_tests()
 
+# Help text index installed in /usr/share/pcp2pdf, so that the help texts
+# which are not in the archive do not need a running pmcd. It is written
+# by the help_index command, before building, on a host with PCP.
+help_index = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'share',
+                          'pcp2pdf', 'help.json')
+
+
+class HelpIndex(Command):
+    description = 'write share/pcp2pdf/help.json from the local PCP help texts'
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        srcdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+        env = dict(os.environ, PYTHONPATH=srcdir)
+        subprocess.check_call([sys.executable,
+                               os.path.join(srcdir, 'bin', 'pcp2pdf-help-index'),
+                               help_index], env=env)
+
 # Build manpages if we're making a source distribution tarball.
 if 'sdist' in sys.argv:
     # Go into the docs directory and build the manpage.
@@ -60,6 +85,10 @@ if 'sdist' in sys.argv:
         shutil.rmtree(mandir)
     shutil.copytree(os.path.join(docdir, '_build', 'man'), mandir)
 
+share_files = ['src/pcplogo.png']
+if os.path.exists(help_index):
+    share_files.append('share/pcp2pdf/help.json')
+
 config = {
     'name': 'pcp2pdf',
     'version': '0.3',
@@ -69,14 +98,14 @@ config = {
     'license': 'GPLv2',
     'package_dir': {'': 'src'},
     'packages': ['pcp2pdf'],
-    'scripts': ['src/bin/pcp2pdf'],
+    'scripts': ['src/bin/pcp2pdf', 'src/bin/pcp2pdf-help-index'],
     'data_files': [('/etc/bash_completion.d', ['src/pcp2pdf.bash']),
                    ('/etc/pcp/pcp2pdf/', ['src/pcp2pdf.conf']),
-                   ('/usr/share/pcp2pdf/', ['src/pcplogo.png']),
+                   ('/usr/share/pcp2pdf/', share_files),
                    ('/usr/share/man/man1/', ['man/pcp2pdf.1']),
                    ('/usr/share/doc/pcp2pdf/', ['README.md']),
                 ],
-    'cmdclass': {'test': DiscoverTest},
+    'cmdclass': {'test': DiscoverTest, 'help_index': HelpIndex},
     'classifiers': [
         "Development Status :: 3 - Alpha",
         "Topic :: Utilities",
@@ -26,6 +26,7 @@ import sys
 
 import cpmapi as c_api
 from pcp import pmapi
+import pcp2pdf.archive
 import pcp2pdf.stats
 
 NAME = "pcp2pdf"
@@ -38,6 +39,8 @@ class _Options(object):
         self.include = []
         self.exclude = []
         self.custom_graphs = []
+        # list of (metric_re, N) tuples, see --top-instances
+        self.top_instances = []
         self.raw = False
         self.output_file = "output.pdf"
         self.interval = None
@@ -46,6 +49,18 @@ class _Options(object):
         self.histogram = False
         # max nr of CPUs to use. None == All available CPUs
         self.max_cpus = None
+        # None == use the cache directory from the configuration
+        self.cache_dir = None
+        self.no_cache = False
+        # None == use the graph format from the configuration
+        self.graph_format = None
+        # Memory in MB used for buffering samples before spilling them to
+        # disk. 0 == keep everything in memory, None == use the configuration
+        self.max_memory = None
+        # Files where the instrumentation report and the per-stage
+        # profiles are written. None == disabled
+        self.stats_json = None
+        self.profile_dir = None
         self.opts = self.setup()
         configfiles = []
         path = os.path.join(pmapi.pmContext.pmGetConfig('PCP_SYSCONF_DIR'),
@@ -73,7 +88,7 @@ class _Options(object):
         opts.pmSetShortOptions("grVi:e:o:c:?S:T:t:a:l:m:d:")
         opts.pmSetOptionFlags(c_api.PM_OPTFLAG_BOUNDARIES)
         opts.pmSetOptionFlags(c_api.PM_OPTFLAG_MULTI)
-        opts.pmSetShortUsage("[options] -a <pcp_archive>\nFor example:\npcp2pdf -S \"May 30 12:00 2014\" -T \"May 30 15:00 2014\" -t \"4 minute\" \\\n -c \"traffic:network.interface.out.bytes:eth0,network.interface.in.bytes:*\" -l 'foo:2014-05-30 12:30:00' -a tests/20140530.0")
+        opts.pmSetShortUsage("[options] -a <pcp_archive|directory> [-a <pcp_archive> ...]\nFor example:\npcp2pdf -S \"May 30 12:00 2014\" -T \"May 30 15:00 2014\" -t \"4 minute\" \\\n -c \"traffic:network.interface.out.bytes:eth0,network.interface.in.bytes:*\" -l 'foo:2014-05-30 12:30:00' -a tests/20140530.0")
         opts.pmSetLongOptionHeader("Options")
 
         opts.pmSetLongOption("include", 1, 'i', '', "Include specific metrics")
@@ -93,6 +108,11 @@ class _Options(object):
         opts.pmSetLongOptionText(t + "would create a 'traffic' page with the above matrics as regular expressions combined in a single graph.")
         opts.pmSetLongOptionText(t + "The general syntax is:")
         opts.pmSetLongOptionText(t + "--custom '<label>:<metric1_re>:<indom1_re>,...<metricN_re>:<indomN_re>'. The option can be specified multiple times")
+        opts.pmSetLongOption("top-instances", 1, '', '', "Only plot the busiest instances of some metrics")
+        opts.pmSetLongOptionText(t + "For example: --top-instances 'proc\\..*:10' plots the 10 instances of the proc metrics with the")
+        opts.pmSetLongOptionText(t + "highest 95th percentile and draws all the other ones as a single min-max band. The general syntax is:")
+        opts.pmSetLongOptionText(t + "--top-instances '<metric_re>:<N>'. The option can be specified multiple times and takes")
+        opts.pmSetLongOptionText(t + "precedence over the [top_instances] section of the configuration")
         opts.pmSetLongOption("raw", 0, 'r', '', "Disable rate conversions")
         opts.pmSetLongOptionText(t + "Disable the rate conversion for all the metrics that have the PM_SEM_COUNTER semantic")
         opts.pmSetLongOptionText(t + "associated with them. By default those are converted via: (value(T) - value(T-1)) / (T - T-1)")
@@ -103,7 +123,21 @@ class _Options(object):
         opts.pmSetLongOption("dpi", 1, 'd', '', "Sets the DPI used to create the images for the graph. Default is 200")
         opts.pmSetLongOptionText(t + "unless overridden in the configuration. The lower the value, the less memory the process will need")
         opts.pmSetLongOptionText(t + "and the less quality the graphs will have.")
-        opts.pmSetLongOption("cpus", 1, 'm', '', "Maximum nr of CPUs to use when rendering (default: all available CPUs)")
+        opts.pmSetLongOption("cpus", 1, 'm', '', "Maximum nr of CPUs to use when parsing and rendering (default: all available CPUs)")
+        opts.pmSetLongOption("graph-format", 1, '', '', "Format of the graphs embedded in the pdf: png or svg")
+        opts.pmSetLongOptionText(t + "svg graphs are embedded as vector drawings, which usually make smaller pdfs but take")
+        opts.pmSetLongOptionText(t + "longer to create than png graphs. Defaults to the 'graph_format' setting of the [main] section")
+        opts.pmSetLongOptionText(t + "in the configuration")
+        opts.pmSetLongOption("cache-dir", 1, '', '', "Directory used to cache parsed archives")
+        opts.pmSetLongOptionText(t + "Rendering the same archive again with different options will skip the parsing.")
+        opts.pmSetLongOptionText(t + "Defaults to the 'dir' setting of the [cache] section in the configuration")
+        opts.pmSetLongOption("no-cache", 0, '', '', "Do not use the parsed archive cache")
+        opts.pmSetLongOption("max-memory", 1, '', '', "Parse in memory-bounded mode using at most <MB> for buffering samples")
+        opts.pmSetLongOptionText(t + "The parsed samples are spilled to per-series files in /var/tmp and the graphs only map the")
+        opts.pmSetLongOptionText(t + "series they plot, so the memory usage does not grow with the length of the archive.")
+        opts.pmSetLongOptionText(t + "Defaults to the 'max_memory' setting of the [main] section in the configuration")
+        opts.pmSetLongOption("stats-json", 1, '', '', "Write per-stage timings, counters and memory usage to a JSON file")
+        opts.pmSetLongOption("profile-dir", 1, '', '', "Write a cProfile dump of each stage in the given directory")
         opts.pmSetLongOptionStart()
         opts.pmSetLongOptionFinish()
         opts.pmSetLongOptionInterval()
@@ -167,6 +201,29 @@ class _Options(object):
             self.output_file = optarg
         elif opt == "r":
             self.raw = True
+        elif opt == "graph-format":
+            self.graph_format = optarg
+        elif opt == "top-instances":
+            try:
+                (metric_re, count) = optarg.rsplit(':', 1)
+                self.top_instances.append((metric_re, int(count)))
+            except Exception:
+                print("Error parsing top-instances: {0}".format(optarg))
+                sys.exit(1)
+        elif opt == "max-memory":
+            try:
+                self.max_memory = int(optarg)
+            except Exception:
+                print("Error parsing max-memory: {0}".format(optarg))
+                sys.exit(1)
+        elif opt == "stats-json":
+            self.stats_json = optarg
+        elif opt == "profile-dir":
+            self.profile_dir = optarg
+        elif opt == "cache-dir":
+            self.cache_dir = optarg
+        elif opt == "no-cache":
+            self.no_cache = True
 
 
 def main():
@@ -181,12 +238,17 @@ def main():
         print("Error: No pcp archives specified")
         c_api.pmUsageMessage()
         sys.exit(1)
+    # Directories are replaced by the archives they contain
+    pcp_files = pcp2pdf.archive.expand_archives(pcp_files)
+    if not pcp_files:
+        print("Error: No pcp archives found")
+        sys.exit(1)
 
     print("Parsing: {0}".format(" ".join(
           map(os.path.basename, pcp_files))), end='')
     print()
 
-    pcpstats = pcp2pdf.stats.PcpStats([pcp_files[0]], opts)
+    pcpstats = pcp2pdf.stats.PcpStats(pcp_files, opts)
     pcpstats.output()
 
 if __name__ == '__main__':
@@ -16,54 +16,233 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
-import datetime
+import bisect
+import glob
+import itertools
+import json
+import multiprocessing
+import operator
+import os
+import re
 import sys
 
+import numpy
+
 import cpmapi as c_api
 from pcp import pmapi
+from pcp2pdf.instrument import worker_stats
+from pcp2pdf.series import SeriesStore
+from pcp2pdf.series import SpillStore
+
+# numpy types used to store the values of each PCP type. String metrics are
+# stored separately and map to None
+NUMPY_TYPES = {
+    c_api.PM_TYPE_32: numpy.int32,
+    c_api.PM_TYPE_U32: numpy.uint32,
+    c_api.PM_TYPE_64: numpy.int64,
+    c_api.PM_TYPE_U64: numpy.uint64,
+    c_api.PM_TYPE_FLOAT: numpy.float32,
+    c_api.PM_TYPE_DOUBLE: numpy.float64,
+    c_api.PM_TYPE_STRING: None,
+}
+
+# Functions returning the python value out of a pmAtomValue for each PCP type
+EXTRACTORS = {
+    c_api.PM_TYPE_32: operator.attrgetter('l'),
+    c_api.PM_TYPE_U32: operator.attrgetter('ul'),
+    c_api.PM_TYPE_64: operator.attrgetter('ll'),
+    c_api.PM_TYPE_U64: operator.attrgetter('ull'),
+    c_api.PM_TYPE_FLOAT: operator.attrgetter('f'),
+    c_api.PM_TYPE_DOUBLE: operator.attrgetter('d'),
+    c_api.PM_TYPE_STRING: operator.attrgetter('cp'),
+}
+
+
+def _get_values_worker(args):
+    '''Wrapper due to pool.imap() single argument limit.
+
+    args = (pcparchive, window, metrics) where pcparchive is a PcpArchive
+    object and metrics the list of metrics to fetch.
+    The PCP context is not pickled, so each worker opens its own one on the
+    same archive and parses only its own time window.
+    '''
+    (pcparchive, window, metrics) = args
+    pcparchive.ctx = pmapi.pmContext(c_api.PM_CONTEXT_ARCHIVE,
+                                     pcparchive.get_window_target(window))
+    pcparchive.metadata_calls = 0
+    pcparchive.fetch_calls = 0
+    pcparchive.extracted_values = 0
+    pcparchive.load_metadata(metrics)
+    (data, skipped_metrics) = pcparchive.get_window_values(window, metrics=metrics)
+    return (data, skipped_metrics,
+            worker_stats(metadata_calls=pcparchive.metadata_calls,
+                         fetch_calls=pcparchive.fetch_calls,
+                         extracted_values=pcparchive.extracted_values))
+
+
+def _unknown_type_extractor(mtype):
+    '''Returns an extractor which fails for metrics of unknown types.'''
+    def extractor(value):
+        raise Exception("Metric has unknown type: [%s]" % (mtype))
+    return extractor
+
+
+def expand_archives(paths):
+    '''Returns the archives in paths, replacing directories with their archives.'''
+    archives = []
+    for path in paths:
+        if not os.path.isdir(path):
+            archives.append(path)
+            continue
+        metas = glob.glob(os.path.join(glob.escape(path), '*.meta*'))
+        archives.extend(sorted(set(re.sub(r'\.meta(\.[a-z0-9]+)?$', '', meta)
+                                   for meta in metas)))
+    return archives
+
+
+def lookup_names(ctx, names):
+    '''Resolves names to pmids with as few pmLookupName() calls as possible
+
+    Returns the list of pmids, with PM_ID_NULL for the names which are
+    unknown to ctx.
+    '''
+    if not names:
+        return []
+    try:
+        return list(ctx.pmLookupName(names, relaxed=1))
+    except TypeError:  # python bindings without relaxed lookups
+        pass
+    except pmapi.pmErr:
+        return [c_api.PM_ID_NULL] * len(names)
+    try:
+        return list(ctx.pmLookupName(names))
+    except pmapi.pmErr:
+        pass
+    # At least one name is unknown, resolve them one by one
+    pmids = []
+    for name in names:
+        try:
+            pmids.append(ctx.pmLookupName(name)[0])
+        except pmapi.pmErr:
+            pmids.append(c_api.PM_ID_NULL)
+    return pmids
+
+
+def lookup_descs(ctx, pmids):
+    '''Returns the descriptors of pmids, with None for the unknown ones.'''
+    valid = [pmid for pmid in pmids if pmid != c_api.PM_ID_NULL]
+    try:
+        descs = dict(zip(valid, ctx.pmLookupDescs(valid)))
+        return [descs.get(pmid) for pmid in pmids]
+    except (AttributeError, pmapi.pmErr):
+        # Bindings without pmLookupDescs() or at least one failed lookup
+        pass
+    descs = []
+    for pmid in pmids:
+        try:
+            descs.append(ctx.pmLookupDesc(pmid))
+        except pmapi.pmErr:
+            descs.append(None)
+    return descs
 
 
 class PcpHelp(object):
-    '''Class to fetch description texts from local pmcd instance
-
-    Help texts are not shipped in an archive file. This class is used
-    to fetch the help texts from the locally running pmcd service. This
-    presumes that the PMNS tree is the same between the archive and the
-    local PCP instance. Just a best effort thing. If the local PCP instance
-    does not have the same PMDAs or has a different PMNS tree, texts
-    will be missing.
+    '''Class to fetch the description texts of the metrics in a report
+
+    Help texts are only fetched for the metrics passed to load(). Each text
+    is taken from the first of these sources which has it:
+    - the archive itself. Archives written by recent PCP versions contain
+      the help texts of their metrics
+    - the help text index shipped with pcp2pdf, see write_help_index()
+    - the locally running pmcd service. This presumes that the PMNS tree is
+      the same between the archive and the local PCP instance. Just a best
+      effort thing
     '''
-    pmns = {}
-    help_text = {}
-    ctx = None
 
-    def _pmns_callback(self, label):
-        '''Callback for the PMNS tree walk.'''
+    def __init__(self, index_file=None):
+        self.help_text = {}
+        self.index_file = index_file
+
+    def _load_from_context(self, ctx, metrics):
+        '''Loads the help texts of metrics from ctx. Returns the missing ones.'''
+        missing = []
+        for (metric, pmid) in zip(metrics, lookup_names(ctx, metrics)):
+            text = None
+            if pmid != c_api.PM_ID_NULL:
+                try:
+                    text = ctx.pmLookupText(pmid, kind=c_api.PM_TEXT_HELP)
+                except pmapi.pmErr:
+                    pass
+            if not text:
+                missing.append(metric)
+                continue
+            try:
+                self.help_text[metric] = text.decode('utf-8')
+            except AttributeError:
+                self.help_text[metric] = text
+        return missing
+
+    def _load_from_index(self, metrics):
+        '''Loads the help texts of metrics from the index. Returns the missing ones.'''
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return metrics
         try:
-            newlabel = label.decode("utf-8")
-        except AttributeError:
-            newlabel = label
+            with open(self.index_file) as index_file:
+                index = json.load(index_file)
+        except (IOError, OSError, ValueError) as e:
+            print("Unable to read help text index {0}: {1}".format(self.index_file, e))
+            return metrics
+        missing = []
+        for metric in metrics:
+            if metric in index:
+                self.help_text[metric] = index[metric]
+            else:
+                missing.append(metric)
+        return missing
 
-        self.pmns[newlabel] = None
+    def load(self, metrics, archive_ctx=None):
+        '''Loads the help texts of metrics
 
-    def __init__(self):
+        archive_ctx is the context of the archive the metrics come from.
+        pmcd is only contacted when some texts are in neither the archive nor
+        the index.
+        '''
+        missing = [m for m in metrics if m not in self.help_text]
+        if missing and archive_ctx is not None:
+            missing = self._load_from_context(archive_ctx, missing)
+        if missing:
+            missing = self._load_from_index(missing)
+        if not missing:
+            return
         try:
-            self.ctx = pmapi.pmContext(target='local:')
+            ctx = pmapi.pmContext(target='local:')
         except Exception:
             print("Unable to contact local pmcd. Help text will be missing")
             return
-        self.ctx.pmTraversePMNS('', self._pmns_callback)
-        for metric in self.pmns:
-            try:
-                pmid = self.ctx.pmLookupName(metric)
-                text = self.ctx.pmLookupText(pmid[0],
-                                             kind=c_api.PM_TEXT_HELP)
-                try:
-                    self.help_text[metric] = text.decode('utf-8')
-                except AttributeError:
-                    self.help_text[metric] = text
-            except Exception:
-                pass
+        self._load_from_context(ctx, missing)
+
+
+def write_help_index(fname):
+    '''Writes the help texts of all the metrics of the local pmcd to fname
+
+    The resulting json file can be used as the help_index of the
+    configuration, so that the help texts are available without pmcd.
+    '''
+    ctx = pmapi.pmContext(target='local:')
+    metrics = []
+
+    def pmns_callback(label):
+        try:
+            metrics.append(label.decode("utf-8"))
+        except AttributeError:
+            metrics.append(label)
+
+    ctx.pmTraversePMNS('', pmns_callback)
+    pcphelp = PcpHelp()
+    pcphelp._load_from_context(ctx, metrics)
+    with open(fname, 'w') as index_file:
+        json.dump(pcphelp.help_text, index_file, indent=0, sort_keys=True)
+    return len(pcphelp.help_text)
 
 
 class PcpArchive(object):
@@ -71,72 +250,224 @@ class PcpArchive(object):
     pcparchive = ''
     ctx = None
     result = None
-    # keys is the metric string. Value is (type, sem, units)
-    pmns = {}
-    skipped = []
 
     def __init__(self, pcp_fname, opts):
-        '''Opens a PCP archive and does an initial walk of the PMNS tree.'''
+        '''Opens a PCP archive and does an initial walk of the PMNS tree
+
+        pcp_fname is either an archive name or a list of archive names of
+        the same host. A list is opened as a single multi-archive context
+        whose timeline spans all the archives.
+        '''
         self.pcparchive = pcp_fname
+        # keys are the pmids. Value is (metric, desc, numpy type, extractor)
+        self.metadata = {}
+        # Number of metadata calls (name, desc and instance lookups) done
+        self.metadata_calls = 0
+        # Number of pmFetch() calls done and values extracted from them
+        self.fetch_calls = 0
+        self.extracted_values = 0
+        # Counters returned by each parse worker, see worker_stats()
+        self.worker_stats = []
+        # keys are (indom, inst). Value is the instance name
+        self.instances = {}
+        # indoms whose instances have all been loaded in self.instances
+        self.loaded_indoms = set()
+        # keys are the metric names. Value is (type, sem, units, type,
+        # units string, type string)
+        self.pmns = {}
+        # metrics without a descriptor in the archive
+        self.skipped = []
+        # Start times (in microseconds) of the archives, sorted
+        self.archive_starts = []
         try:
-            self.ctx = pmapi.pmContext.fromOptions(opts.opts, sys.argv)
+            if isinstance(self.pcparchive, (list, tuple)) and len(self.pcparchive) > 1:
+                self.load_archive_starts()
+                self.ctx = pmapi.pmContext(c_api.PM_CONTEXT_ARCHIVE,
+                                           self.get_archive_target())
+            else:
+                self.ctx = pmapi.pmContext.fromOptions(opts.opts, sys.argv)
         except pmapi.pmErr as e:
             print("Error: {0}".format(e))
             sys.exit(-1)
 
-        self.ctx.pmTraversePMNS('', self._pmns_callback)
+        self.load_pmns()
         if self.skipped:
             print("Unable to get description for: {0}".format(", ".join(self.skipped)))
         self.start = opts.opts.pmGetOptionStart()
         self.end = opts.opts.pmGetOptionFinish()
         self.interval = opts.opts.pmGetOptionInterval()
+        # max nr of CPUs to use when parsing. None == All available CPUs
+        self.max_cpus = opts.max_cpus
+        # Directory where the series are spilled and the memory each parser
+        # process can use for buffering samples. See get_values()
+        self.spill_dir = None
+        self.spill_bytes = 0
+
+    def __getstate__(self):
+        '''Drops the PCP context when pickled. Workers open their own.'''
+        state = self.__dict__.copy()
+        state['ctx'] = None
+        state['result'] = None
+        # descs are bound to the context, see load_metadata()
+        state['metadata'] = {}
+        # Not used by the parse workers
+        state['pmns'] = {}
+        return state
+
+    def load_archive_starts(self):
+        '''Sorts the archives by start time and records their start times
+
+        All the archives must come from the same host.
+        '''
+        labels = []
+        for archive in self.pcparchive:
+            ctx = pmapi.pmContext(c_api.PM_CONTEXT_ARCHIVE, archive)
+            label = ctx.pmGetArchiveLabel()
+            hostname = label.hostname
+            try:
+                hostname = hostname.decode("utf-8")
+            except AttributeError:
+                pass
+            labels.append((self._timestamp_to_usecs(label.start), archive, hostname))
+        labels.sort()
+        hostnames = set(hostname for (start, archive, hostname) in labels)
+        if len(hostnames) > 1:
+            print("Error: the archives come from different hosts: {0}".format(
+                ", ".join(sorted(hostnames))))
+            sys.exit(-1)
+        self.pcparchive = [archive for (start, archive, hostname) in labels]
+        self.archive_starts = [start for (start, archive, hostname) in labels]
 
     def _timestamp_to_secs(self, tstamp):
         '''Convert a timestamp object (tv_sec + tv_usec) to seconds.'''
         secs = tstamp.tv_sec + (tstamp.tv_usec * 10**-6)
         return secs
 
-    def _pmns_callback(self, label):
-        '''Callback to walk the PMNS tree and populate self.pmns dictionary.'''
-        try:
-            newlabel = label.decode("utf-8")
-        except AttributeError:
-            newlabel = label
-        pmid = self.ctx.pmLookupName(label)
+    def _timestamp_to_usecs(self, tstamp):
+        '''Convert a timestamp object (tv_sec + tv_usec) to microseconds.'''
+        return tstamp.tv_sec * 10**6 + tstamp.tv_usec
+
+    def _usecs_to_timestamp(self, usecs):
+        '''Convert microseconds to a timestamp object.'''
+        return pmapi.timeval(usecs // 10**6, usecs % 10**6)
+
+    def load_pmns(self):
+        '''Walks the PMNS tree and populates the self.pmns dictionary
+
+        All the names are collected first and then resolved with batched
+        name and descriptor lookups. The units and type strings are only
+        computed once for each distinct units and type.
+        '''
+        names = []
+
+        def pmns_callback(label):
+            try:
+                names.append(label.decode("utf-8"))
+            except AttributeError:
+                names.append(label)
+
+        self.ctx.pmTraversePMNS('', pmns_callback)
+        pmids = lookup_names(self.ctx, names)
+        descs = lookup_descs(self.ctx, pmids)
+        self.metadata_calls += 2
+        units_strs = {}
+        type_strs = {}
+        for (name, pmid, desc) in zip(names, pmids, descs):
+            if desc is None:
+                self.skipped.append(name)
+                continue
+            self._add_metadata(name, pmid, desc)
+            units = desc.contents.units
+            units_key = (units.dimSpace, units.dimTime, units.dimCount,
+                         units.scaleSpace, units.scaleTime, units.scaleCount)
+            if units_key not in units_strs:
+                units_strs[units_key] = self.ctx.pmUnitsStr(units)
+            mtype = desc.contents.type
+            if mtype not in type_strs:
+                type_strs[mtype] = self.ctx.pmTypeStr(mtype)
+            self.pmns[name] = (desc.type, desc.sem, units, mtype,
+                               units_strs[units_key], type_strs[mtype])
+
+    def _add_metadata(self, metric, pmid, desc):
+        '''Stores the metadata needed to decode the values of pmid.'''
+        mtype = desc.contents.type
+        if mtype in EXTRACTORS:
+            extractor = EXTRACTORS[mtype]
+        else:
+            extractor = _unknown_type_extractor(mtype)
+        self.metadata[pmid] = (metric, desc, NUMPY_TYPES.get(mtype, numpy.float64),
+                               extractor)
+
+    def load_metadata(self, metrics):
+        '''Resolves the pmids and descriptors of metrics in the current context
+
+        This is done once, so that the fetch loop only does dictionary
+        lookups in self.metadata. Metrics unknown to the context are left
+        out, as not all the archives of a set need to carry the same metrics.
+        '''
+        pmids = self.get_pmids(metrics)
+        known = [(metric, pmid) for (metric, pmid) in zip(metrics, pmids)
+                 if pmid != c_api.PM_ID_NULL]
+        descs = lookup_descs(self.ctx, [pmid for (metric, pmid) in known])
+        self.metadata_calls += 1
+        for ((metric, pmid), desc) in zip(known, descs):
+            if desc is not None:
+                self._add_metadata(metric, pmid, desc)
+
+    def _load_indom(self, desc):
+        '''Loads all the instance names of an indom seen in the archive.'''
+        indom = desc.contents.indom
+        self.loaded_indoms.add(indom)
         try:
-            desc = self.ctx.pmLookupDesc(pmid[0])
+            (insts, names) = self.ctx.pmGetInDomArchive(desc)
+            self.metadata_calls += 1
         except pmapi.pmErr:
-            self.skipped.append(label)
             return
+        for (inst, name) in zip(insts, names):
+            try:
+                name = name.decode("utf-8")
+            except AttributeError:
+                pass
+            self.instances[(indom, inst)] = name
 
-        self.pmns[newlabel] = (desc.type, desc.sem, desc.contents.units,
-                            desc.contents.type,
-                            self.ctx.pmUnitsStr(desc.contents.units),
-                            self.ctx.pmTypeStr(desc.contents.type))
+    def load_instances(self, metrics):
+        '''Loads the instance names of all the indoms used by metrics
+
+        The resulting cache is pickled along with the object, so the parse
+        workers do not need to do any instance lookups.
+        '''
+        metrics = set(metrics)
+        for (metric, desc, dtype, extractor) in self.metadata.values():
+            if metric not in metrics:
+                continue
+            indom = desc.contents.indom
+            if indom != c_api.PM_INDOM_NULL and indom not in self.loaded_indoms:
+                self._load_indom(desc)
 
-    def _extract_value(self, result, desc, i, inst=0):
+    def get_instance_name(self, desc, inst):
+        '''Returns the name of instance inst of desc's indom or None.'''
+        key = (desc.contents.indom, inst)
+        if key in self.instances:
+            return self.instances[key]
+        if key[0] not in self.loaded_indoms:
+            self._load_indom(desc)
+            if key in self.instances:
+                return self.instances[key]
+        # Not in the archive's instance domain records, ask for this one only
+        try:
+            name = self.ctx.pmNameInDomArchive(desc, inst)
+            self.metadata_calls += 1
+        except pmapi.pmErr:
+            return None
+        self.instances[key] = name
+        return name
+
+    def _extract_value(self, result, mtype, extractor, i, inst=0):
         '''Return python value given a pmExtractValue set of parameters.'''
-        mtype = desc.contents.type
         value = self.ctx.pmExtractValue(result.contents.get_valfmt(i),
                                         result.contents.get_vlist(i, inst),
                                         mtype, mtype)
-        if mtype == c_api.PM_TYPE_U64:
-            retval = value.ull
-        elif mtype == c_api.PM_TYPE_U32:
-            retval = value.ul
-        elif mtype == c_api.PM_TYPE_64:
-            retval = value.ll
-        elif mtype == c_api.PM_TYPE_32:
-            retval = value.l
-        elif mtype == c_api.PM_TYPE_STRING:
-            retval = value.cp
-        elif mtype == c_api.PM_TYPE_FLOAT:
-            retval = value.f
-        elif mtype == c_api.PM_TYPE_DOUBLE:
-            retval = value.d
-        else:
-            raise Exception("Metric has unknown type: [%s]" % (mtype))
-        return retval
+        return extractor(value)
 
     def close(self):
         '''Frees the context.'''
@@ -156,52 +487,206 @@ class PcpArchive(object):
         return self.pmns[metric]
 
     def get_pmids(self, metrics):
-        '''Given a list of metrics, returns a list of PMIDs.'''
-        return self.ctx.pmLookupName(metrics)
+        '''Given a list of metrics, returns a list of PMIDs
+
+        The metrics unknown to the context, e.g. the ones missing from the
+        archive a parse worker opened, get PM_ID_NULL.
+        '''
+        self.metadata_calls += 1
+        return lookup_names(self.ctx, metrics)
+
+    def get_fetch_pmids(self, metrics):
+        '''Returns the pmids of the metrics which have metadata loaded
+
+        The pmids are taken from self.metadata (see load_metadata()), so no
+        further lookups are needed and every fetched pmid can be decoded.
+        '''
+        metrics = set(metrics)
+        return [pmid for (pmid, (metric, desc, dtype, extractor)) in self.metadata.items()
+                if metric in metrics]
+
+    def get_archive_target(self):
+        '''Returns the archive name(s) as accepted by pmNewContext().'''
+        if isinstance(self.pcparchive, (list, tuple)):
+            return ",".join(self.pcparchive)
+        return self.pcparchive
+
+    def _split_range(self, start, end, count):
+        '''Returns the start of at most count windows splitting [start, end].'''
+        if self.interval:
+            # pmSetMode() is called with PM_XTB_SET(PM_TIME_SEC) so the
+            # interpolation step is expressed in whole seconds
+            step = max(1, int(self.interval)) * 10**6
+            samples = (end - start) // step + 1
+            count = max(1, min(count, samples))
+            return [start + (samples * k // count) * step
+                    for k in range(count)]
+        count = max(1, min(count, end - start))
+        return [start + (end - start) * k // count for k in range(count)]
+
+    def split_windows(self, count):
+        '''Splits the [start, end] time range in about count windows
 
-    def get_values(self, progress=None):
-        '''Returns a dictionary of dictionaries with the archive data
+        Returns a list of (start, end) tuples expressed in microseconds. Each
+        window is half-open, except for the last one whose end is None which
+        stands for the inclusive end of the archive. When an interval is set,
+        the windows start on a sample of the interpolation grid so that the
+        workers fetch exactly the timestamps the serial walk would fetch.
+        With several archives no window spans two archives, each archive
+        gets at least one window and the rest are shared out by duration.
+        '''
+        start = self._timestamp_to_usecs(self.start)
+        end = self._timestamp_to_usecs(self.end)
+        step = max(1, int(self.interval)) * 10**6 if self.interval else 1
+        # Split the range at the start of each archive, on the grid
+        cuts = [start]
+        for archive_start in self.archive_starts:
+            cut = start + -(-(archive_start - start) // step) * step
+            if cuts[-1] < cut <= end:
+                cuts.append(cut)
+        ranges = [(cuts[k], cuts[k + 1] - 1) for k in range(len(cuts) - 1)]
+        ranges.append((cuts[-1], end))
+
+        bounds = []
+        for (range_start, range_end) in ranges:
+            share = int(round(count * (range_end - range_start + 1) /
+                              float(max(1, end - start + 1))))
+            bounds.extend(self._split_range(range_start, range_end,
+                                            max(1, share)))
+        bounds.append(None)
+        return [(bounds[k], bounds[k + 1]) for k in range(len(bounds) - 1)]
+
+    def get_window_target(self, window):
+        '''Returns the archive(s) a worker needs to open to parse window.'''
+        if not self.archive_starts:
+            return self.get_archive_target()
+        index = bisect.bisect_right(self.archive_starts, window[0]) - 1
+        return self.pcparchive[max(0, index)]
+
+    def new_store(self, name):
+        '''Returns an empty SeriesStore for the parsed data
+
+        In memory-bounded mode (see get_values()) the store keeps its series
+        in the name subdirectory of the spill directory.
+        '''
+        if self.spill_dir is None:
+            return SeriesStore()
+        return SpillStore(os.path.join(self.spill_dir, name), self.spill_bytes)
+
+    def get_values(self, progress=None, metrics=None, spill_dir=None,
+                   max_memory=0):
+        '''Returns a SeriesStore with the archive data
 
         It will contain all the data within a PCP archive log file. Data will
         be returned as a a tuple (data, skipped_metrics). skipped_metrics is a
         list of metrics skipped because the archive log was corrupted. data
-        will be in the following form:
-        return[metric1] = {'indom1': [(ts0, ts1, .., tsN), (v0, v1, .., vN)],
-                           ....
-                           'indomN': [(ts0, ts1, .., tsN), (v0, v1, .., vN)]}
-        return[metric2] = {'indom1': [(ts0, ts1, .., tsX), (v0, v1, .., vX)],
-                           ....
-                           'indomN': [(ts0, ts1, .., tsX), (v0, v1, .., vX)]}
-
-        (ts0, .., tsN) are timestamps in datetime format and (v0, .., vN) are
-        the actual values. If a metric has no indom, "0" will be used as its
-        key.
-        "progress" is a callback function which takes a boolean argument (True
-        when the pmFetch() call returned data and False if it did not)
+        can be accessed in the following form:
+        data[metric1] = {'indom1': Series((ts0, ts1, .., tsN), (v0, v1, .., vN)),
+                         ....
+                         'indomN': Series((ts0, ts1, .., tsN), (v0, v1, .., vN))}
+        data[metric2] = {'indom1': Series((ts0, ts1, .., tsX), (v0, v1, .., vX)),
+                         ....
+                         'indomN': Series((ts0, ts1, .., tsX), (v0, v1, .., vX))}
+
+        (ts0, .., tsN) are timestamps in seconds since the epoch and
+        (v0, .., vN) are the actual values. If a metric has no indom, "0" will
+        be used as its key. data.as_dict() returns the same data with
+        datetime timestamps and plain lists.
+        "progress" is a callback function which takes the timestamp (in
+        seconds) of the last parsed sample, the start and the end of the
+        archive.
+        "metrics" is the list of metrics to fetch. It defaults to all the
+        metrics in the archive. Only the listed metrics are decoded, so the
+        parsing cost depends on it rather than on the size of the archive.
+
+        The archive is split in one time window per CPU (see max_cpus) and
+        each window is parsed by a separate process. With several archives
+        the windows never span two archives and each worker only opens the
+        archive of its window. The per-window results are then stitched
+        together in timestamp order, so the archives end up on a single
+        timeline.
+
+        When "spill_dir" is set, the samples are streamed into per-series
+        append-only files in that directory instead of being kept in memory
+        (see SpillStore). The parser processes together buffer at most
+        about "max_memory" bytes of samples, and the returned series
+        memory-map their files.
         '''
-        data = {}
-        self.ctx.pmSetMode(c_api.PM_MODE_FORW, self.start, 0)
+        if metrics is None:
+            metrics = self.get_metrics()
+        if not metrics:
+            return (SeriesStore(), [])
+        cpus = self.max_cpus or multiprocessing.cpu_count()
+        windows = self.split_windows(cpus)
+        workers = min(cpus, len(windows))
+        self.spill_dir = spill_dir
+        self.spill_bytes = max_memory // workers
+        self.load_instances(metrics)
+        if len(windows) == 1:
+            (data, skipped_metrics) = self.get_window_values(windows[0], progress, metrics)
+            data.trim()
+            return (data, skipped_metrics)
+
+        data = self.new_store('all')
+        skipped_metrics = []
+        start = self._timestamp_to_secs(self.start)
+        end = self._timestamp_to_secs(self.end)
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.imap(_get_values_worker,
+                                zip(itertools.repeat(self), windows,
+                                    itertools.repeat(metrics)))
+            for (window, (window_data, window_skipped, stats)) in zip(windows, results):
+                data.merge(window_data)
+                skipped_metrics.extend(window_skipped)
+                self.worker_stats.append(stats)
+                self.metadata_calls += stats['metadata_calls']
+                self.fetch_calls += stats['fetch_calls']
+                self.extracted_values += stats['extracted_values']
+                if progress:
+                    if window[1] is None:
+                        progress(end, start, end)
+                    else:
+                        progress(window[1] * 10**-6, start, end)
+        finally:
+            pool.close()
+            pool.join()
+
+        data.trim()
+        return (data, skipped_metrics)
+
+    def get_window_values(self, window, progress=None, metrics=None):
+        '''Returns the archive data within a single time window
+
+        window is a (start, end) tuple as returned by split_windows(). The
+        other arguments and the return value are the same as get_values().
+        '''
+        (window_start, window_end) = window
+        data = self.new_store('window%d' % window_start)
+        mode_start = self._usecs_to_timestamp(window_start)
+        self.ctx.pmSetMode(c_api.PM_MODE_FORW, mode_start, 0)
         # If the user defined an interval, we set it up
         if self.interval:
             self.ctx.pmSetMode(c_api.PM_MODE_INTERP |
                                c_api.PM_XTB_SET(c_api.PM_TIME_SEC),
-                               self.start, self.interval)
+                               mode_start, self.interval)
 
         skipped_metrics = []
-        # indom_map is just used as an optimization. The keys are (numpmid,
-        # numinst) and the value is the indom name. This avoids too many
-        # expensive calls to pmNameInDomArchive.
-        indom_map = {}
-        metrics = self.get_metrics()
-        pmids = self.get_pmids(metrics)
+        if metrics is None:
+            metrics = self.get_metrics()
+        pmids = self.get_fetch_pmids(metrics)
+        if not pmids:  # None of the metrics are in this archive
+            return (data, skipped_metrics)
         start = self._timestamp_to_secs(self.start)
         end = self._timestamp_to_secs(self.end)
+        archive_start = self._timestamp_to_usecs(self.start)
+        archive_end = self._timestamp_to_usecs(self.end)
         while 1:
             try:
                 # We need to do this without pmFetchArchive() as it does not
                 # support INTERP mode
-                pmids = self.ctx.pmLookupName(metrics)
                 result = self.ctx.pmFetch(pmids)
+                self.fetch_calls += 1
             except pmapi.pmErr as error:
                 # Exit if we are at the end of the file or if the record is
                 # corrupted. Raise proper exception in all other cases
@@ -210,63 +695,59 @@ class PcpArchive(object):
                 else:
                     raise error
 
-            secs = self._timestamp_to_secs(result.contents.timestamp)
-            ts = datetime.datetime.fromtimestamp(secs)
-            if not (float(self.start) <= secs and secs <= float(self.end)):
+            usecs = self._timestamp_to_usecs(result.contents.timestamp)
+            # Samples are returned in timestamp order, so anything past the
+            # window (or the archive) end means we are done
+            if (window_end is not None and usecs >= window_end) or \
+               usecs > archive_end:
+                self.ctx.pmFreeResult(result)
+                break
+            if usecs < window_start or usecs < archive_start:
                 self.ctx.pmFreeResult(result)
                 continue
 
+            secs = self._timestamp_to_secs(result.contents.timestamp)
             if progress:
                 progress(secs, start, end)
 
-            # Walk through the whole list of PMIDs fetched at time ts
+            # Walk through the whole list of PMIDs fetched at time secs
             for i in range(result.contents.numpmid):
                 pmid = result.contents.get_pmid(i)
-                desc = self.ctx.pmLookupDesc(pmid)
-                metric = self.ctx.pmNameID(pmid)
-                if metric not in data:
-                    data[metric] = {}
+                (metric, desc, dtype, extractor) = self.metadata[pmid]
+                mtype = desc.contents.type
+                data.add_metric(metric, dtype)
                 count = result.contents.get_numval(i)
+                self.extracted_values += max(0, count)
                 if count == 0:  # No instance whatsoever
                     continue
-                elif count == 1:  # No indoms are present
+                elif desc.contents.indom == c_api.PM_INDOM_NULL:  # No indoms are present
                     try:
-                        value = self._extract_value(result, desc, i)
+                        value = self._extract_value(result, mtype, extractor, i)
                     except pmapi.pmErr as error:
                         if error.args[0] in [c_api.PM_ERR_CONV]:
                             skipped_metrics.append(metric)
                             continue
                         raise error
-                    if 0 not in data[metric]:
-                        data[metric][0] = [[ts, ], [value, ]]
-                    else:
-                        data[metric][0][0].append(ts)
-                        data[metric][0][1].append(value)
+                    data.get_series(metric, 0, dtype).append(secs, value)
                     continue
 
-                # count > 1 -> Multiple indoms
+                # One value per instance, even when a single one is left
                 for j in range(count):
                     inst = result.contents.get_inst(i, j)
                     try:
-                        value = self._extract_value(result, desc, i, j)
+                        value = self._extract_value(result, mtype, extractor, i, j)
                     except pmapi.pmErr as error:
                         if error.args[0] in [c_api.PM_ERR_CONV]:
                             skipped_metrics.append(metric)
                             continue
-                    if (i, j) not in indom_map:
-                        try:
-                            indom = self.ctx.pmNameInDomArchive(desc, inst)
-                            indom_map[(i, j)] = indom
-                        except pmapi.pmErr:
-                            print("Error in pmNameInDomArchive %s -> %s" % (desc, inst))
-                    else:
-                        indom = indom_map[(i, j)]
-                    if indom not in data[metric]:
-                        data[metric][indom] = [[ts, ], [value, ]]
-                    else:
-                        data[metric][indom][0].append(ts)
-                        data[metric][indom][1].append(value)
+                        raise error
+                    indom = self.get_instance_name(desc, inst)
+                    if indom is None:
+                        print("Error in pmNameInDomArchive %s -> %s" % (desc, inst))
+                        continue
+                    data.get_series(metric, indom, dtype).append(secs, value)
 
             self.ctx.pmFreeResult(result)
+            data.check_memory()
 
         return (data, skipped_metrics)
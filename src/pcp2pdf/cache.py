@@ -0,0 +1,247 @@
+# pcp2pdf.cache - pcp2pdf(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import glob
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import tempfile
+
+import numpy
+
+from pcp2pdf.series import Series
+from pcp2pdf.series import SeriesStore
+from pcp2pdf.summary import SummaryTable
+
+# Bump this whenever the on-disk format changes
+CACHE_VERSION = 3
+
+INDEX_FILE = 'index.json'
+STRINGS_FILE = 'strings.pickle'
+SUMMARY_FILE = 'summary.pickle'
+
+
+def archive_files(archive):
+    '''Returns all the files belonging to an archive
+
+    archive can be the archive's base name or any of its files
+    (foo.0, foo.meta, foo.index, ...).
+    '''
+    base = re.sub(r'\.(meta|index|[0-9]+)(\.[a-z0-9]+)?$', '', archive)
+    files = sorted(glob.glob(glob.escape(base) + '.*'))
+    if not files and os.path.exists(archive):
+        files = [archive]
+    return files
+
+
+class _MetricLoader(object):
+    '''Loads the series of one metric from a cache entry.
+
+    The arrays are memory-mapped so only the pages that are actually read
+    end up in memory.
+    '''
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+
+    def __call__(self, metric):
+        entry = self.index[metric]
+        timestamps = numpy.load(os.path.join(self.path, entry['timestamps']),
+                                mmap_mode='r')
+        values = numpy.load(os.path.join(self.path, entry['values']),
+                            mmap_mode='r')
+        instances = {}
+        for (indom, start, end) in entry['instances']:
+            instances[indom] = Series(values.dtype, timestamps[start:end],
+                                      values[start:end])
+        return instances
+
+
+class _LazyMetrics(dict):
+    '''Dictionary of metric -> instances which loads each metric on access.'''
+
+    def __init__(self, loader, metrics):
+        dict.__init__(self, ((metric, None) for metric in metrics))
+        self.loader = loader
+
+    def __getitem__(self, metric):
+        instances = dict.__getitem__(self, metric)
+        if instances is None:
+            instances = self.loader(metric)
+            dict.__setitem__(self, metric, instances)
+        return instances
+
+
+class ArchiveCache(object):
+    '''On-disk cache of parsed and rate converted archives
+
+    Each entry is a directory named after the cache key. It contains an
+    index.json file and, for every numeric metric, one .npy file with the
+    timestamps and one with the values of all its instances. String metrics
+    and the summary table of all the series are pickled in two more files,
+    so loading an entry does not need to read the series. Entries are evicted in least recently
+    used order once the cache grows over max_size bytes.
+
+    The metrics selected with --include/--exclude/--custom are not part of
+    the key. An entry is used whenever it was created with a superset of the
+    requested metrics.
+    '''
+
+    def __init__(self, directory, max_size):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+
+    def get_key(self, archives, start, end, interval, raw):
+        '''Returns the cache key of a parse run
+
+        archives is a list of archive names. The key changes whenever any of
+        the archive files is modified or any of the options changing the
+        parsed data (start, end, interval and raw) is different.
+        '''
+        key = {'version': CACHE_VERSION, 'start': start, 'end': end,
+               'interval': interval, 'raw': raw, 'files': []}
+        for archive in archives:
+            for fname in archive_files(archive):
+                stat = os.stat(fname)
+                key['files'].append((os.path.abspath(fname), stat.st_mtime,
+                                     stat.st_size))
+        text = json.dumps(key, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key, metrics):
+        '''Returns (data, rate_converted, skipped, summary) or None if key is missing
+
+        None is also returned when the entry was not created with all of the
+        requested metrics. data and the summary table only contain the
+        requested metrics and the series are only loaded when accessed.
+        '''
+        path = self._entry_path(key)
+        try:
+            with open(os.path.join(path, INDEX_FILE)) as index_file:
+                index = json.load(index_file)
+            with open(os.path.join(path, STRINGS_FILE), 'rb') as strings_file:
+                strings = pickle.load(strings_file)
+            with open(os.path.join(path, SUMMARY_FILE), 'rb') as summary_file:
+                summary = pickle.load(summary_file)
+            # Mark the entry as recently used
+            os.utime(path, None)
+        except (IOError, OSError, ValueError, pickle.UnpicklingError):
+            return None
+
+        metrics = set(metrics)
+        if not metrics.issubset(index['fetched']):
+            return None
+
+        data = SeriesStore()
+        data.series = _LazyMetrics(_MetricLoader(path, index['metrics']),
+                                   [m for m in index['metrics'] if m in metrics])
+        data.strings = dict((m, strings[m]) for m in strings if m in metrics)
+        rate_converted = {}
+        for (metric, indoms) in index['rate_converted']:
+            if metric not in metrics:
+                continue
+            if indoms is None:
+                rate_converted[metric] = False
+            else:
+                rate_converted[metric] = dict((indom, True) for indom in indoms)
+        skipped = [m for m in index['skipped'] if m in metrics]
+        return (data, rate_converted, skipped, summary.subset(metrics))
+
+    def save(self, key, data, rate_converted, skipped, metrics, summary):
+        '''Stores the parsed data of the fetched metrics and their summary table under key.'''
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        tmp_path = tempfile.mkdtemp(prefix='.tmp', dir=self.directory)
+        try:
+            index = {'metrics': {}, 'skipped': skipped, 'rate_converted': [],
+                     'fetched': list(metrics)}
+            for (counter, metric) in enumerate(data.series):
+                instances = data[metric]
+                entry = {'timestamps': '%d.timestamps.npy' % counter,
+                         'values': '%d.values.npy' % counter,
+                         'instances': []}
+                offset = 0
+                for indom in instances:
+                    size = len(instances[indom])
+                    entry['instances'].append((indom, offset, offset + size))
+                    offset += size
+                timestamps = [instances[indom].timestamps for indom in instances]
+                values = [instances[indom].values for indom in instances]
+                numpy.save(os.path.join(tmp_path, entry['timestamps']),
+                           numpy.concatenate(timestamps) if timestamps else
+                           numpy.empty(0, dtype=numpy.float64))
+                numpy.save(os.path.join(tmp_path, entry['values']),
+                           numpy.concatenate(values) if values else
+                           numpy.empty(0, dtype=numpy.float64))
+                index['metrics'][metric] = entry
+
+            for metric in rate_converted:
+                if rate_converted[metric]:
+                    indoms = list(rate_converted[metric])
+                else:
+                    indoms = None
+                index['rate_converted'].append((metric, indoms))
+
+            with open(os.path.join(tmp_path, STRINGS_FILE), 'wb') as strings_file:
+                pickle.dump(data.strings, strings_file, pickle.HIGHEST_PROTOCOL)
+            with open(os.path.join(tmp_path, SUMMARY_FILE), 'wb') as summary_file:
+                pickle.dump(summary, summary_file, pickle.HIGHEST_PROTOCOL)
+            with open(os.path.join(tmp_path, INDEX_FILE), 'w') as index_file:
+                json.dump(index, index_file)
+
+            path = self._entry_path(key)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.rename(tmp_path, path)
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+
+    def _entry_size(self, path):
+        size = 0
+        for fname in os.listdir(path):
+            size += os.path.getsize(os.path.join(path, fname))
+        return size
+
+    def evict(self, keep=None):
+        '''Removes the least recently used entries above max_size.'''
+        entries = []
+        total = 0
+        for key in os.listdir(self.directory):
+            path = self._entry_path(key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            size = self._entry_size(path)
+            entries.append((os.path.getmtime(path), key, size))
+            total += size
+
+        for (mtime, key, size) in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            total -= size
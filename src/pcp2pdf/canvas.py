@@ -0,0 +1,106 @@
+# pcp2pdf.canvas - pcp2pdf(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.dates as mdates
+import matplotlib.ticker
+
+
+class GraphCanvas(object):
+    '''A matplotlib figure reused to draw many graphs
+
+    The figure, its axes, formatters and locators are only set up once per
+    process. Between two graphs only the data artists (lines, patches,
+    texts, colorbars and the legend) are removed. The figure is rendered
+    through the Agg canvas directly, without the pyplot state machine.
+    '''
+
+    def __init__(self, graph_size, histogram=False):
+        # reportlab has a 72 dpi by default
+        self.figure = Figure(figsize=(graph_size[0], graph_size[1]))
+        FigureCanvasAgg(self.figure)
+        self.histogram = histogram
+        self.axes = self.figure.add_subplot(111)
+        if histogram:
+            self.axes.set_xlabel('Values')
+        else:
+            self.axes.set_xlabel('Time')
+            self.axes.xaxis.set_major_locator(mdates.AutoDateLocator())
+            self.axes.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d %H:%M'))
+            self.axes.xaxis.set_minor_locator(mdates.MinuteLocator(interval=20))
+        self.reset_yaxis()
+        self.axes.grid(True)
+
+    def reset_yaxis(self):
+        '''Sets the default ticks of the value axis.'''
+        y_formatter = matplotlib.ticker.ScalarFormatter(useOffset=False)
+        y_formatter.set_scientific(False)
+        self.axes.yaxis.set_major_locator(matplotlib.ticker.AutoLocator())
+        self.axes.yaxis.set_major_formatter(y_formatter)
+        self.axes.tick_params(axis='y', labelsize=matplotlib.rcParams['ytick.labelsize'])
+
+    def start(self, title, ylabel):
+        '''Sets the titles of a new graph and returns the axes to draw on.'''
+        self.axes.set_title(title)
+        self.axes.set_ylabel(ylabel)
+        return self.axes
+
+    def colorbar(self, mappable, label):
+        '''Adds a colorbar of mappable on the right of the axes.
+
+        The colorbar lives in an inset of the axes, so removing it does not
+        change the layout of the next graph.
+        '''
+        cax = self.axes.inset_axes([1.02, 0.0, 0.02, 1.0])
+        colorbar = self.figure.colorbar(mappable, cax=cax)
+        colorbar.set_label(label)
+        return colorbar
+
+    def save(self, fname, dpi, legend=None):
+        '''Renders the graph to fname and clears the axes for the next one.'''
+        try:
+            if not self.histogram:
+                self.figure.autofmt_xdate()
+            if legend:
+                self.figure.savefig(fname, bbox_extra_artists=(legend,),
+                                    bbox_inches='tight', dpi=dpi)
+            else:
+                self.figure.savefig(fname, bbox_inches='tight', dpi=dpi)
+        finally:
+            self.clear()
+
+    def clear(self):
+        '''Removes all the data artists and resets the axes limits.'''
+        axes = self.axes
+        legend = axes.get_legend()
+        if legend is not None:
+            legend.remove()
+        # Colorbars go first, removing them looks up their mappable's axes
+        for artists in (axes.child_axes, axes.lines, axes.patches, axes.texts,
+                        axes.collections):
+            for artist in list(artists):
+                artist.remove()
+        del axes.containers[:]
+        # Heat strips label their rows with fixed ticks
+        if self.histogram:
+            self.reset_yaxis()
+        axes.set_prop_cycle(None)
+        axes.relim()
+        axes.set_autoscale_on(True)
+        axes.autoscale_view()
@@ -0,0 +1,148 @@
+# pcp2pdf.instrument - pcp2pdf(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import time
+
+
+def max_rss_kb(who=resource.RUSAGE_SELF):
+    '''Returns the peak resident set size in KB of the process or children.'''
+    return resource.getrusage(who).ru_maxrss
+
+
+def worker_stats(**counters):
+    '''Returns the counters of a worker process along with its peak RSS.'''
+    counters['pid'] = os.getpid()
+    counters['max_rss_kb'] = max_rss_kb()
+    return counters
+
+
+class Instrumentation(object):
+    '''Per-stage timers, counters and peak memory usage of a run
+
+    Stages are timed with the stage() context manager. A stage can be
+    entered several times, in which case its time is accumulated. A stage
+    entered while another one is running is reported in the 'children' of
+    that stage rather than in the top level stages, so the top level times
+    add up to at most the total time. When a profile directory is given,
+    every stage is also profiled with cProfile and dumped to
+    <profile_dir>/<stage>.prof. The profile of a stage does not include its
+    nested stages, which have their own.
+    '''
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        # keys are (kind, pid). Values are the counters of the worker
+        self.workers = collections.OrderedDict()
+        self.graphs = []
+        self.profiles = {}
+        # (stage data, profile) of the stages being run, innermost last
+        self.running = []
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Times the enclosed block as stage name.'''
+        if self.running:
+            stages = self.running[-1][0].setdefault('children', collections.OrderedDict())
+        else:
+            stages = self.stages
+        if name not in stages:
+            stages[name] = {'seconds': 0.0, 'calls': 0}
+        stage = stages[name]
+        profile = None
+        if self.profile_dir:
+            if name not in self.profiles:
+                self.profiles[name] = cProfile.Profile()
+            profile = self.profiles[name]
+            if self.running:
+                self.running[-1][1].disable()
+            profile.enable()
+        self.running.append((stage, profile))
+        start = time.time()
+        try:
+            yield
+        finally:
+            stage['seconds'] += time.time() - start
+            stage['calls'] += 1
+            # ru_maxrss never decreases, so this is the peak reached by the
+            # end of the stage
+            stage['max_rss_kb'] = max_rss_kb()
+            stage['children_max_rss_kb'] = max_rss_kb(resource.RUSAGE_CHILDREN)
+            self.running.pop()
+            if profile is not None:
+                profile.disable()
+                if self.running:
+                    self.running[-1][1].enable()
+
+    def count(self, name, value=1):
+        '''Adds value to the counter name.'''
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_worker(self, kind, stats):
+        '''Merges the counters returned by a worker (see worker_stats()).'''
+        stats = dict(stats)
+        key = (kind, stats.pop('pid'))
+        max_rss = stats.pop('max_rss_kb')
+        worker = self.workers.setdefault(key, {'max_rss_kb': 0, 'tasks': 0})
+        worker['max_rss_kb'] = max(worker['max_rss_kb'], max_rss)
+        worker['tasks'] += 1
+        for name in stats:
+            worker[name] = worker.get(name, 0) + stats[name]
+
+    def add_graph(self, label, seconds, size):
+        '''Records the render time and the image size of a graph.'''
+        self.graphs.append({'label': label, 'seconds': seconds, 'bytes': size})
+        self.count('graphs')
+        self.count('image_bytes', size)
+
+    def report(self):
+        '''Returns all the collected data as a dictionary.'''
+        workers = []
+        for ((kind, pid), stats) in self.workers.items():
+            worker = {'kind': kind, 'pid': pid}
+            worker.update(stats)
+            workers.append(worker)
+        return {'total_seconds': time.time() - self.start,
+                'max_rss_kb': max_rss_kb(),
+                'stages': self.stages,
+                'counters': self.counters,
+                'workers': workers,
+                'graphs': self.graphs}
+
+    def write_json(self, fname):
+        '''Writes the report to fname.'''
+        with open(fname, 'w') as json_file:
+            json.dump(self.report(), json_file, indent=2)
+
+    def write_profiles(self):
+        '''Dumps the cProfile statistics of every stage in profile_dir.'''
+        if not self.profile_dir:
+            return
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        for name in self.profiles:
+            self.profiles[name].dump_stats(os.path.join(self.profile_dir,
+                                                        name + '.prof'))
@@ -0,0 +1,173 @@
+# pcp2pdf.selection - pcp2pdf(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import re
+
+import numpy
+
+
+class PatternSet(object):
+    '''A set of regular expressions matched at the beginning of strings
+
+    The patterns are compiled once and combined in a single alternation, so
+    matching a string costs one regular expression match regardless of the
+    number of patterns. Invalid patterns raise re.error on creation.
+    '''
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        regexes = []
+        for pattern in self.patterns:
+            try:
+                regexes.append(re.compile(pattern))
+            except re.error as e:
+                raise re.error("{0}: {1}".format(pattern, e))
+        self.regexes = regexes
+        if len(regexes) > 1:
+            try:
+                combined = "|".join("(?:%s)" % p for p in self.patterns)
+                self.regexes = [re.compile(combined)]
+            except re.error:
+                # Some patterns (e.g. with backreferences or global inline
+                # flags) cannot be combined. Match them one by one
+                pass
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    __nonzero__ = __bool__
+
+    def match(self, string):
+        '''Returns True if any of the patterns matches string.'''
+        for regex in self.regexes:
+            if regex.match(string) is not None:
+                return True
+        return False
+
+    def filter(self, strings):
+        '''Returns the list of strings matched by any of the patterns.'''
+        return [string for string in strings if self.match(string)]
+
+
+def select_metrics(metrics, include, exclude):
+    '''Returns the set of metrics selected by the include and exclude patterns
+
+    include and exclude are PatternSet objects. With no patterns all the
+    metrics are selected. Otherwise the metrics not matching exclude are
+    selected, and then the ones matching include are added. Only include
+    patterns select just the matching metrics.
+    '''
+    metrics = set(metrics)
+    if exclude:
+        selected = set(m for m in metrics if not exclude.match(m))
+    elif include:
+        selected = set()
+    else:
+        selected = metrics
+    if include:
+        selected.update(include.filter(metrics))
+    return selected
+
+
+class InstanceFilter(object):
+    '''Selects the instances of the metrics of a custom graph
+
+    instance_regexes is a dictionary of metric -> list of patterns. The
+    instances of metrics which are not in the dictionary are all selected.
+    The result for each (metric, instance) pair is cached since the same
+    instances are tested over and over while creating graphs.
+    '''
+
+    def __init__(self, instance_regexes):
+        self.patterns = dict((metric, PatternSet(instance_regexes[metric]))
+                             for metric in instance_regexes)
+        self.cache = {}
+
+    def __contains__(self, metric):
+        return metric in self.patterns
+
+    def match(self, metric, instance):
+        '''Returns True if instance of metric is selected.'''
+        key = (metric, instance)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        if metric in self.patterns:
+            ret = self.patterns[metric].match(str(instance))
+        else:
+            ret = True
+        self.cache[key] = ret
+        return ret
+
+
+class TopInstances(object):
+    '''Number of instances plotted for the metrics matching some patterns
+
+    limits is a list of (pattern, count) tuples. The first pattern matching
+    a metric gives its limit. Metrics not matching any pattern are plotted
+    with all their instances. Invalid patterns raise re.error and invalid
+    counts raise ValueError.
+    '''
+
+    def __init__(self, limits):
+        self.limits = []
+        for (pattern, count) in limits:
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                raise re.error("{0}: {1}".format(pattern, e))
+            count = int(count)
+            if count < 1:
+                raise ValueError("{0}: the number of instances must be "
+                                 "positive".format(pattern))
+            self.limits.append((regex, count))
+        self.cache = {}
+
+    def __bool__(self):
+        return bool(self.limits)
+
+    __nonzero__ = __bool__
+
+    def limit(self, metric):
+        '''Returns the number of instances to plot for metric or None.'''
+        try:
+            return self.cache[metric]
+        except KeyError:
+            pass
+        ret = None
+        for (regex, count) in self.limits:
+            if regex.match(metric) is not None:
+                ret = count
+                break
+        self.cache[metric] = ret
+        return ret
+
+
+def rank_instances(instances, p95, peak, mean):
+    '''Returns the instances sorted from the busiest to the idlest one
+
+    p95, peak and mean are arrays with the 95th percentile, the maximum and
+    the mean value of each of the instances (see SummaryTable). The
+    instances are ranked by the 95th percentile, then by peak and then by
+    mean value. Instances without any value (NaN) come last.
+    '''
+    keys = [numpy.where(numpy.isnan(column), -numpy.inf, column)
+            for column in (mean, peak, p95)]
+    order = numpy.lexsort([-key for key in keys])
+    return [instances[i] for i in order]
@@ -0,0 +1,722 @@
+# pcp2pdf.series - pcp2pdf(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import datetime
+import itertools
+import os
+import shutil
+
+import numpy
+
+# Initial number of samples allocated for a series. The capacity is doubled
+# every time it runs out, so appending stays amortized O(1)
+CHUNK_SIZE = 64
+
+# Minimum number of samples buffered by a SpillStore between two flushes.
+# Every flush opens the files of all the series with buffered samples, so
+# a tight memory budget must not make it happen on every fetch
+SPILL_MIN_ROWS = 64
+
+
+def _counter_deltas(values):
+    '''Returns (deltas, resets) of consecutive counter values
+
+    deltas are float64 differences between consecutive values. A counter
+    which goes backwards is considered wrapped when it is unsigned and the
+    previous value was in the upper half of its range: 2^32 or 2^64 is then
+    added to the difference. In all the other cases the counter is
+    considered reset and the corresponding entry of resets is True.
+    '''
+    if values.dtype.kind == 'u':
+        bits = values.dtype.itemsize * 8
+        previous = values[:-1]
+        # Unsigned subtraction is modulo 2^bits, which is also the right
+        # difference for a wrapped counter
+        deltas = (values[1:] - previous).astype(numpy.float64)
+        backwards = values[1:] < previous
+        resets = backwards & (previous < (1 << (bits - 1)))
+    elif values.dtype.kind == 'i':
+        deltas = numpy.diff(values.astype(numpy.int64)).astype(numpy.float64)
+        resets = deltas < 0
+    else:
+        deltas = numpy.diff(values.astype(numpy.float64))
+        resets = deltas < 0
+    return (deltas, resets)
+
+
+def rate_convert(timestamps, values):
+    '''Do a rate conversion of a counter
+
+    Given an array of timestamps and an array of values it will return the
+    following:
+    [[t1,..,tN], [(v1-v0)/(t1-t0),(v2-v1)/(t2-t1),..,(vN-vN-1)/(tN -tN-1)]
+
+    When two samples have the same timestamp the rate is 0 if the values
+    are the same as well, otherwise the previous rate is used. The previous
+    rate is also used when the counter is reset (see _counter_deltas()).
+    '''
+    if len(timestamps) != len(values):
+        raise Exception('Len of timestamps must be equal to len of values')
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    values = numpy.asarray(values)
+    if len(timestamps) < 2:
+        return (timestamps[1:].copy(), numpy.empty(0, dtype=numpy.float64))
+
+    seconds = numpy.diff(timestamps)
+    (deltas, resets) = _counter_deltas(values)
+    rates = numpy.zeros(len(seconds), dtype=numpy.float64)
+    valid = (seconds != 0) & ~resets
+    rates[valid] = deltas[valid] / seconds[valid]
+    # Zero intervals with a zero difference are simply a 0 rate, all the
+    # other invalid entries take the last valid rate (or 0 if there is none)
+    missing = ~valid & ~((seconds == 0) & (deltas == 0) & ~resets)
+    if missing.any():
+        index = numpy.where(missing, -1, numpy.arange(len(rates)))
+        index = numpy.maximum.accumulate(index)
+        rates = numpy.where(index >= 0, rates[numpy.maximum(index, 0)], 0.0)
+
+    return (timestamps[1:].copy(), rates)
+
+
+def downsample(timestamps, values, buckets):
+    '''Reduces a series to at most 4 points per time bucket
+
+    The [first, last] time range is split in buckets equal intervals (e.g.
+    one per pixel column of the graph) and only the first, last, minimum
+    and maximum samples of each interval are kept, so peaks stay visible.
+    Returns the (timestamps, values) arrays, unchanged if they are already
+    small enough.
+    '''
+    timestamps = numpy.asarray(timestamps)
+    values = numpy.asarray(values)
+    count = len(timestamps)
+    if buckets <= 0 or count <= 4 * buckets:
+        return (timestamps, values)
+    span = timestamps[-1] - timestamps[0]
+    if span <= 0:
+        return (timestamps, values)
+
+    ids = ((timestamps - timestamps[0]) * (buckets / span)).astype(numpy.int64)
+    ids = numpy.minimum(ids, buckets - 1)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(ids)) + 1))
+    ends = numpy.concatenate((starts[1:], [count]))
+    # First sample in each bucket equal to the bucket's minimum/maximum
+    minimums = numpy.minimum.reduceat(values, starts)
+    maximums = numpy.maximum.reduceat(values, starts)
+    sizes = ends - starts
+    at_min = numpy.flatnonzero(values == numpy.repeat(minimums, sizes))
+    at_max = numpy.flatnonzero(values == numpy.repeat(maximums, sizes))
+    bucket_of = numpy.repeat(numpy.arange(len(starts)), sizes)
+    (unused, first_min) = numpy.unique(bucket_of[at_min], return_index=True)
+    (unused, first_max) = numpy.unique(bucket_of[at_max], return_index=True)
+
+    index = numpy.unique(numpy.concatenate((starts, ends - 1, at_min[first_min],
+                                            at_max[first_max])))
+    return (timestamps[index], values[index])
+
+
+def envelope(series, buckets=0):
+    '''Returns the range covered by several series over time
+
+    The result is the (timestamps, lows, highs) arrays where timestamps are
+    all the distinct timestamps of the series, sorted, and lows and highs
+    the float64 minimum and maximum of the series sampled at each of them.
+    With buckets > 0 the time range is split like in downsample() and each
+    bucket is reduced to its first and last timestamps, both with the
+    minimum and maximum of the whole bucket.
+    '''
+    if not series:
+        empty = numpy.empty(0, dtype=numpy.float64)
+        return (empty, empty, empty)
+    timestamps = numpy.concatenate([s.timestamps for s in series])
+    values = numpy.concatenate([numpy.asarray(s.values, dtype=numpy.float64)
+                                for s in series])
+    order = numpy.argsort(timestamps, kind='mergesort')
+    timestamps = timestamps[order]
+    values = values[order]
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(timestamps)) + 1))
+    (timestamps, lows, highs) = (timestamps[starts], numpy.minimum.reduceat(values, starts),
+                                 numpy.maximum.reduceat(values, starts))
+    count = len(timestamps)
+    if buckets <= 0 or count <= 2 * buckets:
+        return (timestamps, lows, highs)
+    span = timestamps[-1] - timestamps[0]
+    ids = ((timestamps - timestamps[0]) * (buckets / span)).astype(numpy.int64)
+    ids = numpy.minimum(ids, buckets - 1)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(ids)) + 1))
+    ends = numpy.concatenate((starts[1:], [count]))
+    index = numpy.empty(2 * len(starts), dtype=numpy.int64)
+    index[0::2] = starts
+    index[1::2] = ends - 1
+    return (timestamps[index], numpy.repeat(numpy.minimum.reduceat(lows, starts), 2),
+            numpy.repeat(numpy.maximum.reduceat(highs, starts), 2))
+
+
+def shared_edges(low, high, bins):
+    '''Returns bins + 1 equal-width bin edges from low to high
+
+    Like numpy.histogram(), a range without width is widened by 0.5 on both
+    sides. Returns None if the range is not finite.
+    '''
+    if not (numpy.isfinite(low) and numpy.isfinite(high)):
+        return None
+    if low == high:
+        (low, high) = (low - 0.5, high + 0.5)
+    return numpy.linspace(low, high, bins + 1)
+
+
+def histograms(datasets, edges):
+    '''Counts the values of several datasets in the same bins
+
+    datasets is a list of value arrays and edges the bin edges shared by
+    all of them (see shared_edges()). All the datasets are binned in a
+    single pass and an array with one row of counts per dataset is
+    returned. As with numpy.histogram() the last bin includes its right
+    edge, while NaNs and values outside the edges are not counted.
+    '''
+    bins = len(edges) - 1
+    sizes = [len(dataset) for dataset in datasets]
+    if not sum(sizes):
+        return numpy.zeros((len(datasets), bins), dtype=numpy.int64)
+    values = numpy.concatenate([numpy.asarray(dataset, dtype=numpy.float64)
+                                for dataset in datasets])
+    segments = numpy.repeat(numpy.arange(len(datasets)), sizes)
+    index = numpy.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = bins - 1
+    valid = (index >= 0) & (index < bins)
+    counts = numpy.bincount(segments[valid] * bins + index[valid],
+                            minlength=len(datasets) * bins)
+    return counts.reshape(len(datasets), bins)
+
+
+class Series(object):
+    '''Timestamps and values of a single (metric, instance) pair
+
+    Timestamps are stored as float64 seconds since the epoch and values as
+    a typed numpy array. Both arrays are over-allocated and grown in chunks,
+    use the timestamps and values properties to get the actual samples.
+    A series can be unpacked like the old lists: (timestamps, values) = s
+
+    While all the appended values are zero, the values array is not
+    allocated at all. Most per-instance series of an archive are idle and
+    end up being pruned, so this keeps them cheap while parsing.
+    '''
+    __slots__ = ('size', '_timestamps', '_values', '_dtype', '_nonzero')
+
+    def __init__(self, dtype=numpy.float64, timestamps=None, values=None):
+        self._dtype = numpy.dtype(dtype)
+        if timestamps is None:
+            self.size = 0
+            self._timestamps = numpy.empty(CHUNK_SIZE, dtype=numpy.float64)
+            self._values = None
+            self._nonzero = False
+        else:
+            if len(timestamps) != len(values):
+                raise Exception('Len of timestamps must be equal to len of values')
+            self.size = len(timestamps)
+            self._timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+            self._values = numpy.asarray(values, dtype=dtype)
+            # Only computed when needed, see has_nonzero()
+            self._nonzero = None
+
+    def __getstate__(self):
+        return (self.timestamps, self._dtype,
+                None if self._values is None else self.values)
+
+    def __setstate__(self, state):
+        (self._timestamps, self._dtype, self._values) = state
+        self.size = len(self._timestamps)
+        self._nonzero = None if self._values is not None else False
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter((self.timestamps, self.values))
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def timestamps(self):
+        return self._timestamps[:self.size]
+
+    @property
+    def values(self):
+        if self._values is None:
+            return numpy.zeros(self.size, dtype=self._dtype)
+        return self._values[:self.size]
+
+    def has_nonzero(self):
+        '''Returns True if at least one of the values is not zero.'''
+        if self._nonzero is None:
+            self._nonzero = bool(numpy.any(self.values))
+        return self._nonzero
+
+    def _materialize(self):
+        '''Allocates the values array of a series which was all zeros.'''
+        self._values = numpy.zeros(len(self._timestamps), dtype=self._dtype)
+        self._nonzero = True
+
+    def _grow(self, needed):
+        '''Makes room for at least needed samples.'''
+        capacity = max(CHUNK_SIZE, len(self._timestamps))
+        while capacity < needed:
+            capacity *= 2
+        timestamps = numpy.empty(capacity, dtype=numpy.float64)
+        timestamps[:self.size] = self.timestamps
+        self._timestamps = timestamps
+        if self._values is not None:
+            values = numpy.empty(capacity, dtype=self._dtype)
+            values[:self.size] = self.values
+            self._values = values
+
+    def append(self, timestamp, value):
+        '''Appends a single sample.'''
+        if self.size == len(self._timestamps):
+            self._grow(self.size + 1)
+        self._timestamps[self.size] = timestamp
+        if self._values is not None:
+            self._values[self.size] = value
+        elif value:
+            self._materialize()
+            self._values[self.size] = value
+        self.size += 1
+
+    def extend(self, timestamps, values):
+        '''Appends a set of samples. values can be None for all zeros.'''
+        count = len(timestamps)
+        if self.size + count > len(self._timestamps):
+            self._grow(self.size + count)
+        self._timestamps[self.size:self.size + count] = timestamps
+        if self._values is None and values is not None and numpy.any(values):
+            self._materialize()
+        if self._values is not None:
+            self._values[self.size:self.size + count] = 0 if values is None else values
+        self.size += count
+
+    def merge(self, other):
+        '''Appends all the samples of another series.'''
+        self.extend(other.timestamps,
+                    None if other._values is None else other.values)
+
+    def clear(self):
+        '''Drops all the samples but keeps the allocated memory.'''
+        self.size = 0
+
+    def trim(self):
+        '''Releases the over-allocated memory.'''
+        self._timestamps = self.timestamps.copy()
+        if self._values is not None:
+            self._values = self.values.copy()
+
+
+def _append_file(fname, source):
+    '''Appends the content of the file source to fname.'''
+    with open(fname, 'ab') as dst, open(source, 'rb') as src:
+        shutil.copyfileobj(src, dst)
+
+
+class SpilledSeries(object):
+    '''Series whose samples are kept in append-only files
+
+    The samples are buffered in a Series and appended to the
+    <path>.timestamps and <path>.values raw files when the buffer is
+    flushed (see SpillStore). The timestamps and values properties
+    memory-map the files, so only the pages actually read end up in memory.
+    Like for Series, the values file is not written at all while all the
+    values are zero.
+    '''
+    __slots__ = ('path', 'size', '_dtype', '_nonzero', '_buffer')
+
+    def __init__(self, path, dtype=numpy.float64):
+        self.path = path
+        self._dtype = numpy.dtype(dtype)
+        # Number of samples in the files
+        self.size = 0
+        self._nonzero = False
+        self._buffer = Series(dtype)
+
+    def __getstate__(self):
+        self.flush()
+        return (self.path, self._dtype, self.size, self._nonzero)
+
+    def __setstate__(self, state):
+        (self.path, self._dtype, self.size, self._nonzero) = state
+        self._buffer = Series(self._dtype)
+
+    def __len__(self):
+        return self.size + len(self._buffer)
+
+    def __iter__(self):
+        return iter((self.timestamps, self.values))
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def _map(self, suffix, dtype):
+        '''Memory-maps one of the files after flushing the buffer.'''
+        self.flush()
+        if self.size == 0:
+            return numpy.empty(0, dtype=dtype)
+        return numpy.memmap(self.path + suffix, dtype=dtype, mode='r',
+                            shape=(self.size,))
+
+    @property
+    def timestamps(self):
+        return self._map('.timestamps', numpy.float64)
+
+    @property
+    def values(self):
+        if not self.has_nonzero():
+            return numpy.zeros(len(self), dtype=self._dtype)
+        return self._map('.values', self._dtype)
+
+    def has_nonzero(self):
+        '''Returns True if at least one of the values is not zero.'''
+        return self._nonzero or self._buffer.has_nonzero()
+
+    def _write_zeros(self, count):
+        '''Appends count zero values to the values file.'''
+        with open(self.path + '.values', 'ab') as values_file:
+            values_file.write(numpy.zeros(count, dtype=self._dtype).tobytes())
+
+    def _set_nonzero(self):
+        '''Writes the values file of a series which was all zeros so far.'''
+        if not self._nonzero:
+            self._write_zeros(self.size)
+            self._nonzero = True
+
+    def append(self, timestamp, value):
+        '''Appends a single sample to the buffer.'''
+        self._buffer.append(timestamp, value)
+
+    def extend(self, timestamps, values):
+        '''Appends a set of samples to the buffer. values can be None for all zeros.'''
+        self._buffer.extend(timestamps, values)
+
+    def flush(self):
+        '''Appends the buffered samples to the files.'''
+        buffer = self._buffer
+        if not len(buffer):
+            return
+        with open(self.path + '.timestamps', 'ab') as timestamps_file:
+            timestamps_file.write(buffer.timestamps.tobytes())
+        if buffer.has_nonzero():
+            self._set_nonzero()
+        if self._nonzero:
+            with open(self.path + '.values', 'ab') as values_file:
+                values_file.write(buffer.values.tobytes())
+        self.size += len(buffer)
+        buffer.clear()
+
+    def merge(self, other):
+        '''Appends all the samples of another SpilledSeries
+
+        The files of other are appended to the files of this series and
+        removed afterwards, without loading them in memory.
+        '''
+        self.flush()
+        other.flush()
+        if other.has_nonzero():
+            self._set_nonzero()
+        _append_file(self.path + '.timestamps', other.path + '.timestamps')
+        if self._nonzero:
+            if other.has_nonzero():
+                _append_file(self.path + '.values', other.path + '.values')
+            else:
+                self._write_zeros(other.size)
+        self.size += other.size
+        other.remove()
+
+    def remove(self):
+        '''Deletes the files of the series.'''
+        for suffix in ('.timestamps', '.values'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        self.size = 0
+        self._nonzero = False
+        self._buffer.clear()
+
+    def trim(self):
+        self.flush()
+
+
+class StringSeries(object):
+    '''Timestamps and values of a string (metric, instance) pair
+
+    Strings do not fit a numpy array, so they are kept in plain lists with
+    the same interface as Series.
+    '''
+    __slots__ = ('_timestamps', 'values')
+
+    def __init__(self, timestamps=None, values=None):
+        self._timestamps = [] if timestamps is None else list(timestamps)
+        self.values = [] if values is None else list(values)
+
+    def __getstate__(self):
+        return (self._timestamps, self.values)
+
+    def __setstate__(self, state):
+        (self._timestamps, self.values) = state
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    def __iter__(self):
+        return iter((self.timestamps, self.values))
+
+    @property
+    def dtype(self):
+        return None
+
+    def has_nonzero(self):
+        return True
+
+    @property
+    def timestamps(self):
+        return numpy.array(self._timestamps, dtype=numpy.float64)
+
+    def append(self, timestamp, value):
+        self._timestamps.append(timestamp)
+        self.values.append(value)
+
+    def extend(self, timestamps, values):
+        self._timestamps.extend(timestamps)
+        self.values.extend(values)
+
+    def merge(self, other):
+        self.extend(other._timestamps, other.values)
+
+    def trim(self):
+        pass
+
+
+class SeriesStore(object):
+    '''Columnar store of all the series parsed from an archive
+
+    It behaves like the old dictionary of dictionaries:
+    store[metric] = {'indom1': Series, ...., 'indomN': Series}
+    Numeric metrics are kept as Series, while string metrics are kept aside
+    as StringSeries.
+    '''
+
+    def __init__(self):
+        self.series = {}
+        self.strings = {}
+
+    def __contains__(self, metric):
+        return metric in self.series or metric in self.strings
+
+    def __getitem__(self, metric):
+        if metric in self.series:
+            return self.series[metric]
+        return self.strings[metric]
+
+    def __iter__(self):
+        return itertools.chain(self.series, self.strings)
+
+    def __len__(self):
+        return len(self.series) + len(self.strings)
+
+    def add_metric(self, metric, dtype):
+        '''Makes sure metric exists in the store
+
+        dtype is the numpy type of the values or None for string metrics.
+        '''
+        if metric in self:
+            return
+        if dtype is None:
+            self.strings[metric] = {}
+        else:
+            self.series[metric] = {}
+
+    def _new_series(self, dtype):
+        '''Returns a new empty numeric series.'''
+        return Series(dtype)
+
+    def get_series(self, metric, indom, dtype):
+        '''Returns the series of (metric, indom), creating it if needed.'''
+        self.add_metric(metric, dtype)
+        instances = self[metric]
+        if indom not in instances:
+            if metric in self.strings:
+                instances[indom] = StringSeries()
+            else:
+                instances[indom] = self._new_series(dtype)
+        return instances[indom]
+
+    def set_series(self, metric, indom, series):
+        '''Stores series as the (metric, indom) pair.'''
+        self.add_metric(metric, series.dtype)
+        self[metric][indom] = series
+
+    def remove(self, metric, indom=None):
+        '''Removes a whole metric or only one of its instances.'''
+        if indom is None:
+            self.series.pop(metric, None)
+            self.strings.pop(metric, None)
+        else:
+            del self[metric][indom]
+
+    def check_memory(self):
+        '''Called by the parser after every fetched sample.
+
+        All the samples are kept in memory, so there is nothing to do. See
+        SpillStore.
+        '''
+        pass
+
+    def is_string_metric(self, metric):
+        '''Returns True if the values of metric are strings.'''
+        return metric in self.strings
+
+    def merge(self, other):
+        '''Appends all the samples of another store to this one
+
+        The other store needs to contain samples which come after the ones
+        in this store.
+        '''
+        for metric in other:
+            if metric not in self:
+                if other.is_string_metric(metric):
+                    self.strings[metric] = {}
+                else:
+                    self.series[metric] = {}
+            for indom in other[metric]:
+                series = other[metric][indom]
+                if indom in self[metric]:
+                    self[metric][indom].merge(series)
+                else:
+                    self[metric][indom] = series
+
+    def prune(self):
+        '''Removes the series whose values are all zero
+
+        Metrics left without any series are removed as well. It makes no
+        sense to graph those.
+        '''
+        for metric in list(self):
+            instances = self[metric]
+            for indom in list(instances):
+                if not instances[indom].has_nonzero():
+                    del instances[indom]
+            if not instances:
+                self.remove(metric)
+
+    def trim(self):
+        '''Releases the over-allocated memory of all the series.'''
+        for metric in self:
+            for indom in self[metric]:
+                self[metric][indom].trim()
+
+    def as_dict(self):
+        '''Returns the data as the old dictionary of dictionaries
+
+        return[metric] = {'indom1': [[ts0, .., tsN], [v0, .., vN]], ...}
+        with the timestamps in datetime format. This is only meant for
+        compatibility as it is a lot larger than the store itself.
+        '''
+        ret = {}
+        for metric in self:
+            ret[metric] = {}
+            for indom in self[metric]:
+                (timestamps, values) = self[metric][indom]
+                ret[metric][indom] = [
+                    [datetime.datetime.fromtimestamp(t) for t in timestamps.tolist()],
+                    list(values) if metric in self.strings else values.tolist()]
+        return ret
+
+
+class SpillStore(SeriesStore):
+    '''SeriesStore whose numeric series are spilled to disk
+
+    Every numeric series is a SpilledSeries with its files in directory.
+    The samples appended to all the series are buffered in memory until
+    they may take more than max_bytes, then all the non-empty buffers are
+    flushed at once. This keeps the memory usage roughly constant
+    regardless of the length of the archive. String metrics are kept in
+    memory.
+    '''
+
+    def __init__(self, directory, max_bytes):
+        SeriesStore.__init__(self)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Used to name the files of the series
+        self.counter = 0
+        # Bytes taken by one sample of every series and number of samples
+        # appended since the last flush, see check_memory()
+        self.row_bytes = 0
+        self.rows = 0
+
+    def _new_series(self, dtype):
+        path = os.path.join(self.directory, '%d' % self.counter)
+        self.counter += 1
+        series = SpilledSeries(path, dtype)
+        self.row_bytes += series.dtype.itemsize + 8
+        return series
+
+    def set_series(self, metric, indom, series):
+        '''Stores series as the (metric, indom) pair, spilling it to disk.'''
+        if not isinstance(series, Series):
+            SeriesStore.set_series(self, metric, indom, series)
+            return
+        spilled = self._new_series(series.dtype)
+        spilled.extend(series.timestamps,
+                       series.values if series.has_nonzero() else None)
+        spilled.flush()
+        self.add_metric(metric, series.dtype)
+        if indom in self[metric] and metric in self.series:
+            self[metric][indom].remove()
+        self[metric][indom] = spilled
+
+    def check_memory(self):
+        '''Flushes all the buffers once they may take more than max_bytes.
+
+        Every fetched sample adds at most one value to each series, so the
+        buffers never take more than rows * row_bytes. At least
+        SPILL_MIN_ROWS samples are buffered between two flushes, whatever
+        the budget.
+        '''
+        self.rows += 1
+        if self.rows >= SPILL_MIN_ROWS and self.rows * self.row_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        '''Appends the buffered samples of all the series to their files.'''
+        for metric in self.series:
+            for series in self.series[metric].values():
+                # Series without new samples keep their files closed
+                if len(series) > series.size:
+                    series.flush()
+        self.rows = 0
+
+    def prune(self):
+        for metric in self.series:
+            for series in self.series[metric].values():
+                if not series.has_nonzero():
+                    series.remove()
+        SeriesStore.prune(self)
+
+    def trim(self):
+        self.flush()
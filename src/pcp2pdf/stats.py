@@ -16,14 +16,13 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 # MA 02110-1301, USA.
 
-import bisect
 import datetime
 import hashlib
-import itertools
+import heapq
 import multiprocessing
 import os
+import queue
 import re
-import resource
 import shutil
 import sys
 import tempfile
@@ -39,16 +38,38 @@ from reportlab.lib.pagesizes import A4
 from reportlab.lib.pagesizes import landscape
 from reportlab.lib.units import inch
 import matplotlib
-import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import matplotlib.colors as colors
 import matplotlib.cm as cm
 from matplotlib.patches import Rectangle
+import numpy
+try:
+    # Optional, needed to embed the graphs as vector drawings
+    from svglib.svglib import svg2rlg
+except ImportError:
+    svg2rlg = None
 
 import cpmapi as c_api
 from pcp2pdf.style import PcpDocTemplate
 from pcp2pdf.archive import PcpArchive
 from pcp2pdf.archive import PcpHelp
+from pcp2pdf.cache import ArchiveCache
+from pcp2pdf.instrument import Instrumentation
+from pcp2pdf.instrument import worker_stats
+from pcp2pdf.canvas import GraphCanvas
+from pcp2pdf.selection import InstanceFilter
+from pcp2pdf.selection import PatternSet
+from pcp2pdf.selection import TopInstances
+from pcp2pdf.selection import rank_instances
+from pcp2pdf.selection import select_metrics
+from pcp2pdf.series import Series
+from pcp2pdf.series import SeriesStore
+from pcp2pdf.series import downsample
+from pcp2pdf.series import envelope
+from pcp2pdf.series import histograms
+from pcp2pdf.series import rate_convert
+from pcp2pdf.series import shared_edges
+from pcp2pdf.summary import SummaryTable
 
 # When showing a rectangle gap when the interval is > than the average frequency we
 # first multiply by FREQUNCY ERROR in order to avoid spurious rectangles
@@ -58,6 +79,22 @@ FREQUENCY_ERROR = 1.1
 # of the page
 LEGEND_THRESHOLD = 50
 
+# Number of bins of the histograms
+HISTOGRAM_BINS = 50
+
+# Histograms with more distributions than this are drawn as a heat strip
+# rather than as step outlines
+HISTOGRAM_STEPS_THRESHOLD = 20
+
+# Maximum number of instance labels on the axis of a heat strip
+HISTOGRAM_ROW_LABELS = 40
+
+# Image formats the graphs can be rendered to
+GRAPH_FORMATS = ('png', 'svg')
+
+# matplotlib date number of the epoch
+EPOCH_DATE_NUM = mdates.date2num(datetime.datetime(1970, 1, 1))
+
 progress_counter = multiprocessing.Value('i', 0)
 progress_lock = multiprocessing.Lock()
 progress_total = 0
@@ -74,11 +111,57 @@ def ellipsize(text, limit=20):
     return ret
 
 
+def series_label(title, metrics, metric, indom):
+    '''Returns the legend label of the indom instance of metric.'''
+    if len(metrics) > 1:
+        if indom == 0:
+            lbl = metric
+        else:
+            lbl = "%s %s" % (metric, indom)
+    else:
+        if indom == 0:
+            lbl = title
+        else:
+            lbl = indom
+    return ellipsize(lbl, 30)
+
+
+def other_label(metrics, metric, count):
+    '''Returns the legend label of the sum of count instances of metric.'''
+    if len(metrics) > 1:
+        return ellipsize("%s other (%d)" % (metric, count), 30)
+    return "other (%d)" % count
+
+
 def date_string(dt):
     '''Prints a datetime string in format '2014-10-21 23:24:10'.'''
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 
+def datetime_to_secs(dt):
+    '''Converts a local datetime to seconds since the epoch.'''
+    return time.mktime(dt.timetuple()) + dt.microsecond * 10**-6
+
+
+def date_nums(timestamps):
+    '''Converts seconds since the epoch to matplotlib date numbers
+
+    The dates are in local time, just like datetime.fromtimestamp() would
+    return them.
+    '''
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    if len(timestamps) == 0:
+        return timestamps
+    first = time.localtime(timestamps[0]).tm_gmtoff
+    last = time.localtime(timestamps[-1]).tm_gmtoff
+    if first == last:
+        offsets = first
+    else:  # A DST change happened in between
+        offsets = numpy.array([time.localtime(t).tm_gmtoff
+                               for t in timestamps.tolist()])
+    return (timestamps + offsets) / 86400.0 + EPOCH_DATE_NUM
+
+
 def parse_progress_callback(ts, start, finish):
     percentage = round(((ts - start) / (finish - start)) * 100.0, 1)
     sys.stdout.write('\rParsing archive: [%s %s%%]' % ('#' * (int(percentage/10)), percentage))
@@ -97,107 +180,162 @@ def split_chunks(list_to_split, chunksize):
     return ret
 
 
-def graph_wrapper(zip_obj):
+# PcpStats object used by the graph workers. It is set once per worker by
+# init_graph_worker() so that it does not need to be pickled for every graph
+graph_pcpstats = None
+
+
+def init_graph_worker(pcpstats_obj):
+    """Pool initializer of the graph workers.
+    With the default fork start method pcpstats_obj, along with all
+    the parsed data, is inherited by the worker and not pickled at all
+    """
+    global graph_pcpstats
+    graph_pcpstats = pcpstats_obj
+
+
+def graph_wrapper(graph):
     """Wrapper due to pool.map() single argument limit.
-    zip_obj = zip(itertools.repeat(self), self.all_graphs)
-    where self is a PcpStats object. Each CPU will get
-    a slice of the self.all_graphs list
+    graph = (label, fname, metrics, indom_regexes, histogram)
+    Each CPU will get a slice of the graph descriptors and
+    creates them with the worker's graph_pcpstats object
     """
-    (pcpstats_obj, data) = list(zip_obj)
-    (label, fname, metrics, text, indom_regexes, histogram) = data
+    (label, fname, metrics, indom_regexes, histogram) = graph
+    start_time = time.time()
     if histogram:
-        ret = pcpstats_obj.create_histogram(fname, label, metrics, indom_regexes)
+        ret = graph_pcpstats.create_histogram(fname, label, metrics, indom_regexes)
     else:
-        ret = pcpstats_obj.create_graph(fname, label, metrics, indom_regexes)
+        ret = graph_pcpstats.create_graph(fname, label, metrics, indom_regexes)
+    # svg graphs are converted here rather than in the parent, which would
+    # otherwise do all the conversions serially
+    drawing = None
+    if ret and graph_pcpstats.graph_format == 'svg':
+        drawing = graph_pcpstats.graph_drawing(fname)
+    render_seconds = time.time() - start_time
     with progress_lock:
         progress_counter.value += 1
-    graph_progress_callback(pcpstats_obj)
-    return ((label, fname, metrics, text, indom_regexes, histogram), ret)
-
-
-def print_mem_usage(data):
-    usage = resource.getrusage(resource.RUSAGE_SELF)
-    print("Graphing: {0} usertime={1} systime={2} mem={3} MB"
-          .format(data, usage[0], usage[1], (usage[2] / 1024.0)))
-
+    graph_progress_callback(graph_pcpstats)
+    image_bytes = os.path.getsize(fname) if ret else 0
+    return (ret, drawing, worker_stats(render_seconds=render_seconds,
+                                       image_bytes=image_bytes))
+
+
+def ordered_results(pool, func, tasks, costs, max_in_flight):
+    """Runs func on every task in pool and yields the results in task order.
+    Only the tasks less than max_in_flight positions ahead of the next
+    result to yield are submitted, the most expensive of them first, so
+    the expensive tasks do not end up as the long tail of the run while
+    the results keep coming out in order. At most max_in_flight tasks are
+    queued in the pool and held back results are bounded the same way.
+    The first exception raised by func is re-raised, the caller has to
+    terminate the pool
+    """
+    # (-cost, index) of the tasks which can be submitted
+    pending = []
+    done = queue.Queue()
+    results = {}
+    # Tasks before this index are pending or submitted
+    window_end = 0
+    in_flight = 0
+    next_result = 0
+    while next_result < len(tasks):
+        while window_end < min(len(tasks), next_result + max_in_flight):
+            heapq.heappush(pending, (-costs[window_end], window_end))
+            window_end += 1
+        while pending and in_flight < max_in_flight:
+            index = heapq.heappop(pending)[1]
+            pool.apply_async(func, (tasks[index],),
+                             callback=lambda ret, index=index: done.put((index, ret, None)),
+                             error_callback=lambda exc, index=index: done.put((index, None, exc)))
+            in_flight += 1
+        (index, ret, exc) = done.get()
+        in_flight -= 1
+        if exc is not None:
+            raise exc
+        results[index] = ret
+        while next_result in results:
+            yield results.pop(next_result)
+            next_result += 1
 
-def match_res(patterns, string, flags=0):
-    if type(string) != str:
-        string = str(string)
-    for pattern in patterns:
-        ret = re.match(pattern, string, flags)
-        if ret is not None:
-            return ret
-    return None
 
 class PcpStats(object):
-    story = []
-
     def __init__(self, args, opts):
         self.args = args
         self.opts = opts
         self.configparser = opts.configparser
         self.doc = PcpDocTemplate(opts.output_file, self.configparser, pagesize=landscape(A4))
-        self.pcphelp = PcpHelp()
-        self.pcparchive = PcpArchive(args, opts)
+        # Flowables not yet written to the pdf, see flush_story()
+        self.story = []
+        # Stage timings, counters and memory usage. See --stats-json
+        self.instrumentation = Instrumentation(opts.profile_dir)
+        with self.instrumentation.stage('pmns'):
+            self.pcparchive = PcpArchive(args, opts)
+        self.instrumentation.count('archives', len(args))
+        self.instrumentation.count('pmns_metrics', len(self.pcparchive.get_metrics()))
         if self.opts.dpi is not None and self.opts.dpi > 0:
             self.DPI = self.opts.dpi
         else:
             self.DPI = self.configparser.getint('main', 'dpi')
+        # Number of pixel columns of a graph. Series with more samples than
+        # this are downsampled before being plotted
+        self.graph_columns = int(self.doc.graph_size[0] * self.DPI)
+        # Graphs are either embedded as png images or as vector drawings
+        # converted from svg files
+        if self.opts.graph_format is not None:
+            self.graph_format = self.opts.graph_format
+        else:
+            self.graph_format = self.configparser.get('main', 'graph_format',
+                                                      fallback='png')
+        if self.graph_format not in GRAPH_FORMATS:
+            print("Invalid graph format: {0}. Valid formats are: {1}".format(
+                self.graph_format, " ".join(GRAPH_FORMATS)))
+            sys.exit(-1)
+        if self.graph_format == 'svg' and svg2rlg is None:
+            print("svglib is not installed, falling back to png graphs")
+            self.graph_format = 'png'
         self.logo = self.configparser.get('main', 'logo')
         # Allow to be run from the current dir for unit-testing purposes
         if not os.path.isfile(self.logo):
             self.logo = os.path.join(os.getcwd(), "src", "pcplogo.png")
+        help_index = self.configparser.get('main', 'help_index',
+                                           fallback='/usr/share/pcp2pdf/help.json')
+        if not os.path.isfile(help_index):
+            help_index = os.path.join(os.getcwd(), "share", "pcp2pdf", "help.json")
+        # Help texts are only loaded for the graphed metrics, see output()
+        self.pcphelp = PcpHelp(help_index)
+
+        self.cache = None
+        if not opts.no_cache:
+            cache_dir = opts.cache_dir
+            if cache_dir is None:
+                cache_dir = self.configparser.get('cache', 'dir', fallback='')
+            if cache_dir:
+                max_size = self.configparser.getint('cache', 'max_size', fallback=2048)
+                self.cache = ArchiveCache(cache_dir, max_size * 1024 * 1024)
 
         # Using /var/tmp as /tmp is ram-mounted these days
         self.tempdir = tempfile.mkdtemp(prefix='pcpstats', dir='/var/tmp')
+        # In memory-bounded mode the parsed series are spilled to disk
+        if self.opts.max_memory is not None:
+            self.max_memory = self.opts.max_memory
+        else:
+            self.max_memory = self.configparser.getint('main', 'max_memory',
+                                                       fallback=0)
         # This will contain all the metrics found in the archive file
-        self.all_data = {}
+        self.all_data = SeriesStore()
+        # Start and end times of all the data gaps sorted by start time.
+        # See build_gap_index()
+        self.gap_starts = numpy.empty(0)
+        self.gap_ends = numpy.empty(0)
         # Verify which set of metrics are to be used
-        self.metrics = []
-        if not opts.include and not opts.exclude:
-            self.metrics = sorted(self.pcparchive.get_metrics())
-        elif opts.include and not opts.exclude:  # Only specified filters
-            metrics = sorted(self.pcparchive.get_metrics())
-            for i in opts.include:
-                try:
-                    matched = filter(lambda x: re.match(i, x), metrics)
-                except Exception:
-                    print("Failed to parse: {0}".format(i))
-                    sys.exit(-1)
-                self.metrics.extend(matched)
-        elif not opts.include and opts.exclude:  # Exclude specified filter
-            metrics = sorted(self.pcparchive.get_metrics())
-            matched = []
-            for i in opts.exclude:
-                try:
-                    matched.extend(filter(lambda x: re.match(i, x), metrics))
-                except Exception:
-                    print("Failed to parse: {0}".format(i))
-                    sys.exit(-1)
-
-            self.metrics = sorted(list(set(metrics) - set(matched)))
-        else:
-            all_metrics = sorted(self.pcparchive.get_metrics())
-            matched = []
-            for i in opts.exclude:
-                try:
-                    matched.extend(filter(lambda x: re.match(i, x),
-                                          all_metrics))
-                except Exception:
-                    print("Failed to parse: {0}".format(i))
-                    sys.exit(-1)
-
-            delta_metrics = sorted(list(set(all_metrics) - set(matched)))
-            metrics = sorted(self.pcparchive.get_metrics())
-            for i in opts.include:
-                try:
-                    matched = filter(lambda x: re.match(i, x), metrics)
-                except Exception:
-                    print("Failed to parse: {0}".format(i))
-                    sys.exit(-1)
-                delta_metrics.extend(matched)
-            self.metrics = delta_metrics
+        all_metrics = self.pcparchive.get_metrics()
+        try:
+            include = PatternSet(opts.include)
+            exclude = PatternSet(opts.exclude)
+        except re.error as e:
+            print("Failed to parse: {0}".format(e))
+            sys.exit(-1)
+        self.metrics = select_metrics(all_metrics, include, exclude)
 
         self.custom_graphs = []
         # Verify if there are any custom graphs. They can be defined like
@@ -217,7 +355,6 @@ class PcpStats(object):
                 print("Cannot use label {0}. It is an existing metric".format(label))
                 sys.exit(-1)
 
-            all_metrics = sorted(self.pcparchive.get_metrics())
             indom_regexes = {}
             metrics = []
             for element in elements:
@@ -227,49 +364,65 @@ class PcpStats(object):
                     print("Failed to parse: {0}".format(element))
                     sys.exit(-1)
                 try:
-                    tmp_metrics = filter(lambda x: re.match(metric_str, x),
-                                         all_metrics)
-                    metrics.extend(tmp_metrics)
-                except Exception:
-                    print("Failed to parse: {0}".format(metric_str))
+                    tmp_metrics = sorted(PatternSet([metric_str]).filter(all_metrics))
+                except re.error as e:
+                    print("Failed to parse: {0}".format(e))
                     sys.exit(-1)
                 for metric in tmp_metrics:
                     if metric in indom_regexes:
                         indom_regexes[metric].append(indom_str)
                     else:
                         indom_regexes[metric] = [indom_str]
+                        metrics.append(metric)
 
-            # Try to compile the indom_res to make sure they are valid
-            errors = []
-            for pattern in indom_regexes:
-                try:
-                    re.compile(pattern)
-                except Exception:
-                    errors.append(pattern)
-                    pass
-
-            if errors:
-                print("Invalid regular expressions: {0}".format(
-                    " ".join(errors)))
+            # Compile the indom_res to make sure they are valid
+            try:
+                instance_filter = InstanceFilter(indom_regexes)
+            except re.error as e:
+                print("Invalid regular expressions: {0}".format(e))
                 sys.exit(-1)
 
             # We expanded all the metrics here. We cannot do the same for
             # indoms as those are not yet available. We just pass the regexes
             # and do it at custom graph creation time
-            self.custom_graphs.append(("Custom.%s" % label, metrics, indom_regexes))
-
-        try:  # Not all matplotlib versions have this key
-            matplotlib.rcParams['figure.max_open_warning'] = 100
-        except KeyError:
-            pass
-
-    def _graph_filename(self, metrics, extension='.png', histogram=False):
+            self.custom_graphs.append(("Custom.%s" % label, metrics, instance_filter))
+
+        # Only the metrics which are going to be graphed are fetched from
+        # the archive
+        fetch_metrics = set(self.metrics)
+        for (label, metrics, indom_regexes) in self.custom_graphs:
+            fetch_metrics.update(metrics)
+        self.fetch_metrics = sorted(fetch_metrics)
+
+        # Only the busiest instances of the metrics matching these patterns
+        # are plotted, the other ones are drawn as a single band. The
+        # command line patterns take precedence over the configuration
+        limits = list(opts.top_instances)
+        if self.configparser.has_section('top_instances'):
+            limits.extend(self.configparser.items('top_instances'))
+        try:
+            self.top_instances = TopInstances(limits)
+        except (re.error, ValueError) as e:
+            print("Invalid top instances: {0}".format(e))
+            sys.exit(-1)
+        # keys are the metrics with more instances than their top instances
+        # limit. Value is the list of instances ranked by rank_instances()
+        self.rankings = {}
+        # Statistics of every parsed series, see parse()
+        self.summary = SummaryTable()
+
+        # Reusable figures of the graph worker, see get_canvas()
+        self.canvases = {}
+
+    def _graph_filename(self, metrics, extension=None, histogram=False):
         '''Creates a unique constant file name given a list of metrics.'''
+        if extension is None:
+            extension = '.' + self.graph_format
         # We're on python 2.6o .jpg even though graph quality is affected,
         # because the underlying imaging lib bails out on a few graphs from
         # time to time
         pyver = sys.version_info
-        if pyver[0] == 2 and pyver[1] <= 6:
+        if pyver[0] == 2 and pyver[1] <= 6 and extension == '.png':
             extension = '.jpg'
         if isinstance(metrics, list):
             temp = ''
@@ -282,6 +435,37 @@ class PcpStats(object):
         fname = os.path.join(self.tempdir, temp + extension)
         return fname
 
+    def graph_drawing(self, fname):
+        '''Returns the svg graph fname as a reportlab drawing
+
+        The drawing ends up as vector graphics in the pdf. It is stretched
+        to the graph size of the page.
+        '''
+        width = self.doc.graph_size[0] * inch
+        height = self.doc.graph_size[1] * inch
+        drawing = svg2rlg(fname)
+        drawing.scale(width / drawing.width, height / drawing.height)
+        drawing.width = width
+        drawing.height = height
+        return drawing
+
+    def _graph_flowable(self, fname, drawing=None):
+        '''Returns the flowable embedding the graph image fname
+
+        drawing is the graph already converted by graph_drawing() for svg
+        graphs. png graphs are stretched to the graph size of the page.
+        '''
+        if drawing is not None:
+            return drawing
+        return Image(fname, width=self.doc.graph_size[0] * inch,
+                     height=self.doc.graph_size[1] * inch)
+
+    def flush_story(self):
+        '''Writes the pending flowables to the pdf and empties the story.'''
+        with self.instrumentation.stage('pdf_layout'):
+            self.doc.add_flowables(self.story)
+        self.story = []
+
     def _do_heading(self, text, sty):
         if isinstance(text, list):
             text = "_".join(text)
@@ -296,82 +480,32 @@ class PcpStats(object):
     def rate_convert(self, timestamps, values):
         '''Do a rate conversion
 
-        Given a list of timestamps and a list of values it will return the
+        Given an array of timestamps and an array of values it will return the
         following:
         [[t1,..,tN], [(v1-v0)/(t1-t0),(v2-v1)/(t2-t1),..,(vN-vN-1)/(tN -tN-1)]
+        Counter wraps and resets are taken into account, see
+        pcp2pdf.series.rate_convert()
         '''
-        if len(timestamps) != len(values):
-            raise Exception('Len of timestamps must be equal to len of values')
-        new_timestamps = []
-        new_values = []
-        for t in range(1, len(timestamps)):
-            delta = timestamps[t] - timestamps[t - 1]
-            new_timestamps.append(delta)
-
-        for v in range(1, len(values)):
-            seconds = new_timestamps[v - 1].total_seconds()
-            try:
-                delta = (values[v] - values[v - 1]) / seconds
-            except ZeroDivisionError:
-                # If we have a zero interval but the values difference is zero
-                # return 0 anyway
-                if values[v] - values[v - 1] == 0:
-                    delta = 0
-                    pass
-                else:
-                    # if the delta between the values is not zero try to use
-                    # the previous calculated delta
-                    if v > 1:
-                        delta = new_values[v - 2]
-                    else:  # In all other cases just set the delta to 0
-                        delta = 0
-                    pass
-
-            new_values.append(delta)
-
-        # Add previous datetime to the time delta
-        for t in range(len(new_timestamps)):
-            ts = new_timestamps[t]
-            new_timestamps[t] = ts + timestamps[t]
-
-        return (new_timestamps, new_values)
-
-    def find_max(self, timestamp, metrics):
-        '''Find maximum value given timestamp and metrics
-
-        Given data as returned by pcparchive.get_values a timestamp and a set
-        of metrics, find the maximum y value. If the given timestamp does not
-        exist in the data we do a linear interpolation.
+        return rate_convert(timestamps, values)
+
+    def find_max(self, timestamps, metrics):
+        '''Find maximum values given timestamps and metrics
+
+        Given an array of timestamps (seconds since the epoch) and a set of
+        metrics, find the maximum y value of all the metrics' instances at
+        each timestamp. Values between two samples are linearly
+        interpolated. Timestamps outside of the data get -sys.maxsize.
         '''
-        max_value = -sys.maxsize
+        max_values = numpy.full(len(timestamps), -sys.maxsize, dtype=numpy.float64)
         for metric in metrics:
             for indom in self.all_data[metric]:
-                timestamps = self.all_data[metric][indom][0]
-                y_values = self.all_data[metric][indom][1]
-                try:
-                    x = timestamps.index(timestamp)
-                    y = y_values[timestamp]
-                except ValueError:
-                    time_key_right = bisect.bisect_right(timestamps, timestamp)
-                    # If the custom label's timestamp falls outside the
-                    # data we have we skip this
-                    if time_key_right >= len(timestamps):
-                        continue
-                    time_key_left = time_key_right - 1
-                    x1 = mdates.date2num(timestamps[time_key_left])
-                    x2 = mdates.date2num(timestamps[time_key_right])
-                    y1 = y_values[time_key_left]
-                    y2 = y_values[time_key_right]
-                    if x1 == x2 or y1 == y2:  # No need to do any interpolation
-                        y = y1
-                    else:
-                        m = (y2 - y1) / (x2 - x1)
-                        x = mdates.date2num(timestamp) - x1
-                        y = m * x + y1
-
-                if y > max_value:
-                    max_value = y
-        return max_value
+                (x_values, y_values) = self.all_data[metric][indom]
+                if len(x_values) == 0:
+                    continue
+                y = numpy.interp(timestamps, x_values, y_values,
+                                 left=numpy.nan, right=numpy.nan)
+                numpy.fmax(max_values, y, out=max_values)
+        return max_values
 
     def get_frequency(self, data):
         # First we calculate the observed frequency (in seconds) of the
@@ -380,17 +514,13 @@ class PcpStats(object):
         counter = 0
         for metric in data:
             for indom in data[metric]:
-                timestamps = data[metric][indom][0]
-                last = None
-                for timestamp in timestamps:
-                    if not last:
-                        last = timestamp
-                        continue
-                    delta = (timestamp - last).total_seconds()
-                    total += delta
-                    counter += 1
-                    last = timestamp
+                timestamps = data[metric][indom].timestamps
+                if len(timestamps) > 1:
+                    total += timestamps[-1] - timestamps[0]
+                    counter += len(timestamps) - 1
 
+        if counter == 0:
+            return 0.0
         frequency = total / counter
         return frequency
 
@@ -408,71 +538,177 @@ class PcpStats(object):
         ret = {}
         for metric in data:
             for indom in data[metric]:
-                timestamps = data[metric][indom][0]
-                last = None
-                for timestamp in timestamps:
-                    if not last:
-                        last = timestamp
-                        continue
-                    delta = (timestamp - last).total_seconds()
-                    if delta > frequency * FREQUENCY_ERROR:
-                        key = (last, timestamp)
-                        if key not in ret:
-                            ret[key] = [(metric, indom)]
-                        else:
-                            ret[key].append((metric, indom))
-                    last = timestamp
+                timestamps = data[metric][indom].timestamps
+                deltas = numpy.diff(timestamps)
+                for i in numpy.flatnonzero(deltas > frequency * FREQUENCY_ERROR):
+                    key = (timestamps[i], timestamps[i + 1])
+                    if key not in ret:
+                        ret[key] = [(metric, indom)]
+                    else:
+                        ret[key].append((metric, indom))
         return ret
 
+    def build_gap_index(self):
+        '''Computes the data gaps of the whole report once
+
+        The gaps are stored in self.gap_starts and self.gap_ends, sorted by
+        start time, so that each graph can look up the ones in its own time
+        range with get_gaps().
+        '''
+        gaps = sorted(self.find_data_gaps(self.all_data))
+        self.gap_starts = numpy.array([g[0] for g in gaps], dtype=numpy.float64)
+        self.gap_ends = numpy.array([g[1] for g in gaps], dtype=numpy.float64)
+
+    def get_gaps(self, start, end):
+        '''Returns the list of (start, end) gaps overlapping [start, end].'''
+        last = numpy.searchsorted(self.gap_starts, end, side='right')
+        overlapping = numpy.flatnonzero(self.gap_ends[:last] >= start)
+        return [(self.gap_starts[i], self.gap_ends[i]) for i in overlapping]
+
     def parse(self):
         '''Parse the archive and store all the metrics in self.all_data
 
         It returns a dictionary containing the metrics which have been
-        rate converted
+        rate converted. If the same archive was already parsed with the same
+        options, the data is loaded from the cache instead. The statistics
+        of every series end up in self.summary, computed after parsing or
+        loaded from the cache, and the instances of the metrics with a top
+        instances limit are ranked.
         '''
+        if self.cache is None:
+            rate_converted = self._parse_archive()
+            self.build_summary()
+        else:
+            rate_converted = self._parse_cached()
+        with self.instrumentation.stage('ranking'):
+            self.rank_instances()
+        return rate_converted
+
+    def _parse_cached(self):
+        '''Load the parsed data from the cache or parse and cache it.'''
+        start_time = time.time()
+        interval = self.pcparchive.interval
+        key = self.cache.get_key(self.args, float(self.pcparchive.start),
+                                 float(self.pcparchive.end),
+                                 float(interval) if interval else None,
+                                 self.opts.raw)
+        with self.instrumentation.stage('cache_load'):
+            cached = self.cache.load(key, self.fetch_metrics)
+        if cached is not None:
+            # The summary table comes from the cache too, so the series are
+            # only loaded when graphed
+            (self.all_data, rate_converted, self.skipped_graphs, self.summary) = cached
+            tdelta = time.time() - start_time
+            print('Parsing archive: loaded from cache - %.2fs' % tdelta)
+            return rate_converted
+
+        rate_converted = self._parse_archive()
+        self.build_summary()
+        try:
+            with self.instrumentation.stage('cache_save'):
+                self.cache.save(key, self.all_data, rate_converted, self.skipped_graphs,
+                                self.fetch_metrics, self.summary)
+        except (IOError, OSError) as e:
+            print("Unable to write the archive cache: {0}".format(e))
+        return rate_converted
+
+    def build_summary(self):
+        '''Computes the summary table of all the parsed series.'''
+        with self.instrumentation.stage('summary'):
+            self.summary = SummaryTable.build(self.all_data)
+
+    def _parse_archive(self):
+        '''Parse the archive, prune the all-zero series and rate convert.'''
         start_time = time.time()
-        (all_data, self.skipped_graphs) = self.pcparchive.get_values(progress=parse_progress_callback)
+        with self.instrumentation.stage('parse'):
+            spill_dir = None
+            if self.max_memory > 0:
+                spill_dir = os.path.join(self.tempdir, 'series')
+            (all_data, self.skipped_graphs) = self.pcparchive.get_values(progress=parse_progress_callback,
+                                                                            metrics=self.fetch_metrics,
+                                                                            spill_dir=spill_dir,
+                                                                            max_memory=self.max_memory * 1024 * 1024)
         tdelta = time.time() - start_time
-        sys.stdout.write('\rParsing archive: [########## 100.0%%] - %.2fs' % tdelta)
+        self.instrumentation.count('metadata_calls', self.pcparchive.metadata_calls)
+        self.instrumentation.count('fetch_calls', self.pcparchive.fetch_calls)
+        self.instrumentation.count('extracted_values', self.pcparchive.extracted_values)
+        for stats in self.pcparchive.worker_stats:
+            self.instrumentation.add_worker('parse', stats)
+        sys.stdout.write('\rParsing archive: [########## 100.0%%] - %.2fs (%d metadata calls)' %
+                         (tdelta, self.pcparchive.metadata_calls))
         sys.stdout.flush()
         print()
 
         rate_converted = {}
         # Prune all the sets of values where all values are zero as it makes
-        # no sense to show those
+        # no sense to show those. The parser already tracked which series
+        # ever had a non-zero value, so this does not walk the samples
         for metric in all_data:
             rate_converted[metric] = False
-            tmp = {}
-            # FIXME: Once python 2.6 dep is dropped we can use the following
-            # tmp = {key: value for key, value in all_data[metric].items()
-            #       if not all([ v == 0 for v in value[1]])}
-            data = all_data[metric].items()
-            for key, value in data:
-                if not all([v == 0 for v in value[1]]):
-                    tmp[key] = value
-
-            if tmp:
-                self.all_data[metric] = tmp
+        all_data.prune()
+        self.all_data = all_data
 
         if self.opts.raw:  # User explicitely asked to not rate convert any metrics
             return rate_converted
 
         # Rate convert all the PM_SEM_COUNTER metrics
-        for metric in self.all_data:
-            (mtype, msem, munits, dtype, desc_units, desc_type) = self.pcparchive.get_metric_info(metric)
-            if msem != c_api.PM_SEM_COUNTER:
-                continue
+        with self.instrumentation.stage('rate_conversion'):
+            for metric in self.all_data:
+                (mtype, msem, munits, dtype, desc_units, desc_type) = self.pcparchive.get_metric_info(metric)
+                if msem != c_api.PM_SEM_COUNTER:
+                    continue
 
-            for indom in self.all_data[metric]:
-                data = self.all_data[metric][indom]
-                (ts, val) = self.rate_convert(data[0], data[1])
-                self.all_data[metric][indom] = [ts, val]
-                if not rate_converted[metric]:
-                    rate_converted[metric] = {}
-                rate_converted[metric][indom] = True
+                for indom in self.all_data[metric]:
+                    (ts, val) = self.rate_convert(*self.all_data[metric][indom])
+                    self.all_data.set_series(metric, indom, Series(timestamps=ts, values=val))
+                    self.instrumentation.count('rate_converted_series')
+                    if not rate_converted[metric]:
+                        rate_converted[metric] = {}
+                    rate_converted[metric][indom] = True
 
         return rate_converted
 
+    def rank_instances(self):
+        '''Ranks the instances of the metrics with a top instances limit
+
+        Only the metrics with more instances than their limit are ranked.
+        See select_instances().
+        '''
+        self.rankings = {}
+        if not self.top_instances:
+            return
+        for metric in self.summary:
+            limit = self.top_instances.limit(metric)
+            if limit is None or self.summary.is_string_metric(metric) or \
+               len(self.summary.instances(metric)) <= limit:
+                continue
+            self.rankings[metric] = rank_instances(self.summary.instances(metric),
+                                                   self.summary.column(metric, 'p95'),
+                                                   self.summary.column(metric, 'max'),
+                                                   self.summary.column(metric, 'mean'))
+            self.instrumentation.count('ranked_metrics')
+
+    def select_instances(self, metric, indom_regexes):
+        '''Returns the (plotted, other) instances of a metric
+
+        The instances not matching indom_regexes and the ones with less than
+        two samples, which cannot be graphed, are left out. When the metric
+        has more instances than its top instances limit, only the busiest
+        ones are plotted, from the busiest to the idlest, and the remaining
+        ones are returned as other to be drawn as a single band.
+        '''
+        counts = self.summary.column(metric, 'count')
+        indoms = [indom for (indom, count) in
+                  sorted(zip(self.summary.instances(metric), counts.tolist()))
+                  if count > 1 and (indom_regexes is None or
+                                    indom_regexes.match(metric, indom))]
+        if metric not in self.rankings:
+            return (indoms, [])
+        limit = self.top_instances.limit(metric)
+        selected = set(indoms)
+        ranked = [indom for indom in self.rankings[metric] if indom in selected]
+        return (ranked[:limit], ranked[limit:])
+
     def get_category(self, label, metrics):
         '''Return the category given one or a list of metric strings.'''
         if isinstance(metrics, str):
@@ -495,28 +731,16 @@ class PcpStats(object):
 
     def is_string_metric(self, metric):
         '''Given a metric returns True if values' types are strings.'''
-        data = self.all_data[metric]
-        isstring = False
-        for indom in data:
-            values = data[indom][1]
-            if all([isinstance(v, bytes) for v in values]):
-                isstring = True
-                break
-
-        return isstring
+        if metric in self.summary:
+            return self.summary.is_string_metric(metric)
+        return self.all_data.is_string_metric(metric)
 
     def get_colormap(self, metrics, indom_regexes):
         '''Return the colormap used to plot the different graphs'''
         # First we calculate the maximum number of colors needed
         max_values_len = 0
         for metric in metrics:
-            values = self.all_data[metric]
-            count = 0
-            for indom in values:
-                if indom_regexes is not None and metric in indom_regexes:
-                    if match_res(indom_regexes[metric], indom) is None:
-                        continue
-                count += 1
+            count = len(self.select_instances(metric, indom_regexes)[0])
             if count > max_values_len:
                 max_values_len = count
 
@@ -524,101 +748,111 @@ class PcpStats(object):
         vmax_color = max_values_len * len(metrics)
         color_norm = colors.Normalize(vmin=0, vmax=vmax_color)
         scalar_map = cm.ScalarMappable(norm=color_norm,
-                                       cmap=plt.get_cmap('Set1'))
+                                       cmap=matplotlib.colormaps['Set1'])
         return scalar_map
 
+    def graph_cost(self, metrics):
+        '''Estimates the rendering cost of a graph as its number of samples.'''
+        return sum(self.summary.total_count(metric) for metric in metrics)
+
+    def get_canvas(self, histogram=False):
+        '''Returns the GraphCanvas of this process for the graph type
+
+        The canvases are created on first use, so each graph worker process
+        sets up its own figures once and reuses them for all its graphs.
+        '''
+        if histogram not in self.canvases:
+            self.canvases[histogram] = GraphCanvas(self.doc.graph_size,
+                                                   histogram)
+        return self.canvases[histogram]
+
     def create_histogram(self, fname, title, metrics, indom_regexes):
         '''Creates a histogram image
 
         Take a filename, a title, a list of metrics and an indom_regex to
-        create an image of the graph
+        create an image of the graph. The values of all the plotted
+        instances are binned at once with the same bin edges, which span
+        their range according to the summary table, so the distributions
+        can be compared. Up to HISTOGRAM_STEPS_THRESHOLD distributions are
+        drawn as step outlines, more of them as a single heat strip with one
+        row per instance.
         '''
-        # reportlab has a 72 dpi by default
-        fig = plt.figure(figsize=(self.doc.graph_size[0],
-                                  self.doc.graph_size[1]))
-        axes = fig.add_subplot(111)
-        # Set Axis metadata
-        axes.set_xlabel('Values')
-        axes.set_title('{0}'.format(title, fontsize=self.doc.fonts['axes'].fontSize))
-        axes.set_ylabel('%s frequency' % title)
-        y_formatter = matplotlib.ticker.ScalarFormatter(useOffset=False)
-        axes.yaxis.set_major_formatter(y_formatter)
-        axes.yaxis.get_major_formatter().set_scientific(False)
-        axes.grid(True)
-
-        found = False
-        indoms = 0
-        counter = 0
-        scalar_map = self.get_colormap(metrics, indom_regexes)
-
-        # Then we walk the metrics and plot
+        labels = []
+        datasets = []
+        # keys are the indexes of the datasets pooling the instances which
+        # are not plotted. Value is the number of pooled instances
+        other_rows = {}
+        lows = []
+        highs = []
         for metric in metrics:
             values = self.all_data[metric]
-            for indom in sorted(values):
-                # If the indom_regexes is not None we use the indom only if the re string
-                # matches
-                if indom_regexes is not None and metric in indom_regexes:
-                    if match_res(indom_regexes[metric], indom) is None:
-                        continue
-                (timestamps, dataset) = values[indom]
-                # Currently if there is only one (timestamp,value) like with filesys.blocksize
-                # we just do not graph the thing
-                if len(timestamps) <= 1:
-                    continue
-
-                if len(metrics) > 1:
-                    if indom == 0:
-                        lbl = metric
-                    else:
-                        lbl = "%s %s" % (metric, indom)
-                else:
-                    if indom == 0:
-                        lbl = title
-                    else:
-                        lbl = indom
-
-                lbl = ellipsize(lbl, 30)
-                found = True
-                try:
-                    axes.hist(dataset, cumulative=False,
-                              label=lbl, color=scalar_map.to_rgba(counter))
-                except Exception:
-                    import traceback
-                    print("Metric: {0}".format(metric))
-                    print(traceback.format_exc())
-                    sys.exit(-1)
-
-                indoms += 1
-                counter += 1
-
-        if not found:
+            # If the indom_regexes is not None we use the indom only if the re string
+            # matches
+            (plotted, others) = self.select_instances(metric, indom_regexes)
+            for indom in plotted:
+                labels.append(series_label(title, metrics, metric, indom))
+                datasets.append(values[indom].values)
+            if others:
+                # The samples of the instances which are not plotted are
+                # shown as a single distribution
+                other_rows[len(datasets)] = len(others)
+                labels.append(other_label(metrics, metric, len(others)))
+                datasets.append(numpy.concatenate([values[i].values for i in others]))
+            if plotted or others:
+                lows.append(numpy.nanmin(self.summary.select(metric, 'min', plotted + others)))
+                highs.append(numpy.nanmax(self.summary.select(metric, 'max', plotted + others)))
+        if not datasets:
+            return False
+        edges = shared_edges(min(lows), max(highs), HISTOGRAM_BINS)
+        if edges is None:
             return False
+        counts = histograms(datasets, edges).astype(numpy.float64)
+        # The pooled instances are scaled to a single instance, like the
+        # plotted ones
+        for (index, pooled) in other_rows.items():
+            counts[index] /= pooled
 
-        # Add legend only when there is more than one instance
+        canvas = self.get_canvas(histogram=True)
         lgd = False
-        if indoms > 1:
-            fontproperties = matplotlib.font_manager.FontProperties(size='xx-small')
-            if indoms > LEGEND_THRESHOLD:
-                # Draw legend on the bottom only when instances are more than
-                # LEGEND_THRESHOLD
-                lgd = axes.legend(loc=9, ncol=int(indoms ** 0.6),
-                                  bbox_to_anchor=(0.5, -0.29), shadow=True,
-                                  prop=fontproperties)
+        if len(datasets) > HISTOGRAM_STEPS_THRESHOLD:
+            axes = canvas.start(title, 'Instances')
+            mesh = axes.pcolormesh(edges, numpy.arange(len(datasets) + 1), counts,
+                                   cmap='Blues')
+            canvas.colorbar(mesh, '%s frequency' % title)
+            # The rows pooling the instances which are not plotted are
+            # hatched and always labelled
+            for index in other_rows:
+                axes.add_patch(Rectangle((edges[0], index), edges[-1] - edges[0], 1,
+                                         fill=False, hatch='//', edgecolor='grey',
+                                         linewidth=0))
+            step = -(-len(datasets) // HISTOGRAM_ROW_LABELS)
+            rows = sorted(set(range(0, len(datasets), step)) | set(other_rows))
+            axes.set_yticks([row + 0.5 for row in rows])
+            axes.set_yticklabels([labels[row] for row in rows])
+            axes.tick_params(axis='y', labelsize='xx-small')
+            canvas.save(fname, self.DPI)
+            return True
+
+        axes = canvas.start(title, '%s frequency' % title)
+        scalar_map = self.get_colormap(metrics, indom_regexes)
+        counter = 0
+        for (index, (lbl, row)) in enumerate(zip(labels, counts)):
+            if index in other_rows:
+                axes.stairs(row, edges, fill=True, color='grey', alpha=0.3,
+                            label=lbl)
             else:
-                # Draw legend on the right when instances are more than
-                # LEGEND_THRESHOLD
-                lgd = axes.legend(loc=1, ncol=int(indoms ** 0.5), shadow=True,
-                                  prop=fontproperties)
+                axes.stairs(row, edges, label=lbl, color=scalar_map.to_rgba(counter))
+                counter += 1
+        # Have the Y axis always start from 0
+        axes.set_ylim(bottom=0)
 
+        # Add legend only when there is more than one instance
+        if len(datasets) > 1:
+            fontproperties = matplotlib.font_manager.FontProperties(size='xx-small')
+            lgd = axes.legend(loc=1, ncol=int(len(datasets) ** 0.5), shadow=True,
+                              prop=fontproperties)
 
-        if lgd:
-            plt.savefig(fname, bbox_extra_artists=(lgd,), bbox_inches='tight',
-                        dpi=self.DPI)
-        else:
-            plt.savefig(fname, bbox_inches='tight', dpi=self.DPI)
-        plt.cla()
-        plt.clf()
-        plt.close('all')
+        canvas.save(fname, self.DPI, lgd)
         return True
 
     def create_graph(self, fname, title, metrics, indom_regexes):
@@ -627,60 +861,54 @@ class PcpStats(object):
         Take a filename, a title, a list of metrics and an indom_regex to
         create an image of the graph
         '''
-        # reportlab has a 72 dpi by default
-        fig = plt.figure(figsize=(self.doc.graph_size[0],
-                                  self.doc.graph_size[1]))
-        axes = fig.add_subplot(111)
-        # Set X Axis metadata
-        axes.set_xlabel('Time')
-        axes.set_title('{0}'.format(title, fontsize=self.doc.fonts['axes'].fontSize))
-        axes.xaxis.set_major_formatter(mdates.DateFormatter('%m-%d %H:%M'))
-        axes.xaxis.set_minor_locator(mdates.MinuteLocator(interval=20))
-        fig.autofmt_xdate()
-        # Set Y Axis metadata
-        axes.set_ylabel(title)
-        y_formatter = matplotlib.ticker.ScalarFormatter(useOffset=False)
-        axes.yaxis.set_major_formatter(y_formatter)
-        axes.yaxis.get_major_formatter().set_scientific(False)
-
-        axes.grid(True)
+        canvas = self.get_canvas(histogram=False)
+        axes = canvas.start(title, title)
 
         found = False
         indoms = 0
         counter = 0
         scalar_map = self.get_colormap(metrics, indom_regexes)
+        # Time range of the plotted data
+        start = sys.float_info.max
+        end = -sys.float_info.max
 
         # Then we walk the metrics and plot
         for metric in metrics:
             values = self.all_data[metric]
+            # If the indom_regexes is not None we use the indom only if the re string
+            # matches
+            (plotted, others) = self.select_instances(metric, indom_regexes)
+            if others:
+                # The instances which are not plotted are drawn as a single
+                # band going from their minimum to their maximum value
+                (timestamps, lows, highs) = envelope([values[i] for i in others],
+                                                     self.graph_columns)
+                if len(timestamps) > 1:
+                    found = True
+                    start = min(start, timestamps[0])
+                    end = max(end, timestamps[-1])
+                    axes.fill_between(date_nums(timestamps), lows, highs, color='grey',
+                                      alpha=0.3, linewidth=0,
+                                      label=other_label(metrics, metric, len(others)))
+                    # Have the Y axis always start from 0
+                    axes.set_ylim(bottom=0)
+                    indoms += 1
             try:
-                for indom in sorted(values):
-                    # If the indom_regexes is not None we use the indom only if the re string
-                    # matches
-                    if indom_regexes is not None and metric in indom_regexes:
-                        if match_res(indom_regexes[metric], indom) is None:
-                            continue
+                for indom in plotted:
                     (timestamps, dataset) = values[indom]
                     # Currently if there is only one (timestamp,value) like with filesys.blocksize
                     # we just do not graph the thing
                     if len(timestamps) <= 1:
                         continue
 
-                    if len(metrics) > 1:
-                        if indom == 0:
-                            lbl = metric
-                        else:
-                            lbl = "%s %s" % (metric, indom)
-                    else:
-                        if indom == 0:
-                            lbl = title
-                        else:
-                            lbl = indom
-
-                    lbl = ellipsize(lbl, 30)
+                    lbl = series_label(title, metrics, metric, indom)
                     found = True
+                    start = min(start, timestamps[0])
+                    end = max(end, timestamps[-1])
+                    (timestamps, dataset) = downsample(timestamps, dataset,
+                                                       self.graph_columns)
                     try:
-                        axes.plot(timestamps, dataset, 'o:', label=lbl,
+                        axes.plot(date_nums(timestamps), dataset, 'o:', label=lbl,
                                   color=scalar_map.to_rgba(counter))
                     except Exception:
                         import traceback
@@ -689,7 +917,7 @@ class PcpStats(object):
                         sys.exit(-1)
 
                     # Have the Y axis always start from 0
-                    axes.set_ylim(ymin=0)
+                    axes.set_ylim(bottom=0)
 
                     indoms += 1
                     counter += 1
@@ -702,23 +930,23 @@ class PcpStats(object):
             return False
 
         # Show any data collection gaps in the graph
-        gaps = self.find_data_gaps(self.all_data).keys()
+        gaps = self.get_gaps(start, end)
         if gaps:
             for i in gaps:
-                (g1, g2) = i
-                x1 = mdates.date2num(g1)
-                x2 = mdates.date2num(g2)
-                (ymin, ymax) = plt.ylim()
+                (x1, x2) = date_nums(i)
+                (ymin, ymax) = axes.get_ylim()
                 axes.add_patch(Rectangle((x1, ymin), x2 - x1, ymax - ymin,
                                facecolor="lightgrey"))
 
         # Draw self.labels if non empty
         if self.opts.labels:
-            for label in self.opts.labels:
-                max_value = self.find_max(self.opts.labels[label], metrics)
-                # should we not find a max_value at all (due to empty timestamps)
-                if max_value == -sys.maxsize:
-                    max_value = 0
+            labels = sorted(self.opts.labels)
+            label_secs = numpy.array([datetime_to_secs(self.opts.labels[label])
+                                      for label in labels])
+            max_values = self.find_max(label_secs, metrics)
+            # should we not find a max_value at all (due to empty timestamps)
+            max_values[max_values == -sys.maxsize] = 0
+            for (label, max_value) in zip(labels, max_values.tolist()):
                 axes.annotate(label, xy=(mdates.date2num(self.opts.labels[label]), max_value),
                               xycoords='data', xytext=(30, 30), textcoords='offset points',
                               arrowprops=dict(arrowstyle="->", connectionstyle="arc3,rad=.2"))
@@ -739,16 +967,28 @@ class PcpStats(object):
                 lgd = axes.legend(loc=1, ncol=int(indoms ** 0.5), shadow=True,
                                   prop=fontproperties)
 
-        if lgd:
-            plt.savefig(fname, bbox_extra_artists=(lgd,), bbox_inches='tight',
-                        dpi=self.DPI)
-        else:
-            plt.savefig(fname, bbox_inches='tight', dpi=self.DPI)
-        plt.cla()
-        plt.clf()
-        plt.close('all')
+        canvas.save(fname, self.DPI, lgd)
         return True
 
+    def get_summary_rows(self):
+        '''Returns the rows of the summary page
+
+        There is one row for every plotted series of the selected numeric
+        metrics, with the statistics from self.summary.
+        '''
+        rows = []
+        for metric in sorted(self.metrics):
+            if metric not in self.summary or self.summary.is_string_metric(metric):
+                continue
+            for indom in self.select_instances(metric, None)[0]:
+                row = self.summary.row(metric, indom)
+                rows.append([ellipsize(metric, 45),
+                             '-' if indom == 0 else ellipsize(str(indom), 20),
+                             '%d' % row['count']] +
+                            ['%.6g' % row[field] for field in
+                             ('min', 'mean', 'max', 'stddev', 'p95', 'p99')])
+        return rows
+
     def get_all_graphs(self):
         '''Returns all the graphs that need to be plotted
 
@@ -791,6 +1031,9 @@ class PcpStats(object):
             if self.is_string_metric(metric):
                 string_metrics.append(metric)
                 continue
+            # Series need at least two samples to be graphed
+            if metric in self.summary and not (self.summary.column(metric, 'count') > 1).any():
+                continue
 
             fname = self._graph_filename([metric])
             units_str = self.pcparchive.get_metric_info(metric)[4]
@@ -813,6 +1056,12 @@ class PcpStats(object):
     def output(self):
         # FIXME: Split this function in smaller pieces. This is unreadable
         self.rate_converted = self.parse()
+        with self.instrumentation.stage('gaps'):
+            self.build_gap_index()
+        self.instrumentation.count('gaps', len(self.gap_starts))
+        with self.instrumentation.stage('help'):
+            self.pcphelp.load([m for m in self.fetch_metrics if m in self.all_data],
+                              self.pcparchive.ctx)
         (self.all_graphs, string_metrics) = self.get_all_graphs()
         if not self.all_graphs:
             print('No usable non-zero graphs found.')
@@ -847,48 +1096,17 @@ class PcpStats(object):
         self.story.append(table)
         self.story.append(PageBreak())
 
-        start_time = time.time()
-        done_metrics = []
-        global progress_total
-        progress_total = len(self.all_graphs)
-        # Set this to False to disable multiprocessing
-        if True:
-            pool = multiprocessing.Pool(self.opts.max_cpus)
-            l = zip(itertools.repeat(self), self.all_graphs)
-            metrics_rets = pool.map(graph_wrapper, l)
-            (metrics, rets) = zip(*metrics_rets)
-            done_metrics = [metric for (metric, ret) in metrics_rets if ret]
-        else: # This is just to debug in non multi-threaded mode
-            for graph in self.all_graphs:
-                (label, fname, metrics, text, indom_regexes, histogram) = graph
-                if histogram:
-                    if self.create_histogram(fname, label, metrics, indom_regexes):
-                        done_metrics.append(graph)
-                    progress_counter.value += 1
-                else:
-                    if self.create_graph(fname, label, metrics, indom_regexes):
-                        done_metrics.append(graph)
-                    progress_counter.value += 1
-
-                graph_progress_callback(self)
-
-
-        tdelta = time.time() - start_time
-        sys.stdout.write('\rCreating graphs: [########## 100.0%%] - %.2fs' % tdelta)
-        sys.stdout.flush()
-        print()
         # Build the string metrics table. It only prints
         # a value if it changed over time
         data = [('Metric', 'Timestamp', 'Value')]
         for metric in string_metrics:
             last_value = None
             for indom in self.all_data[metric]:
-                timestamps = self.all_data[metric][indom][0]
-                values = self.all_data[metric][indom][1]
-                for (ts, v) in zip(timestamps, values):
+                (timestamps, values) = self.all_data[metric][indom]
+                for (ts, v) in zip(timestamps.tolist(), values):
                     if last_value != v:
                         text = ellipsize(v, 100)
-                        ts = date_string(ts)
+                        ts = date_string(datetime.datetime.fromtimestamp(ts))
                         data.append((metric, '%s' % ts, text))
                         last_value = v
 
@@ -900,27 +1118,89 @@ class PcpStats(object):
             self.story.append(table)
             self.story.append(PageBreak())
 
-        # At this point all images are created let's build the pdf
-        print("Building pdf: ", end='')
-        sys.stdout.flush()
+        # Build the summary table of the numeric series
+        if self.configparser.getboolean('main', 'summary_page', fallback=True):
+            data = [('Metric', 'Instance', 'Samples', 'Min', 'Mean', 'Max',
+                     'Std dev', '95th', '99th')]
+            data.extend(self.get_summary_rows())
+            if len(data) > 1:
+                self._do_heading('Summary', self.doc.fonts["heading1"])
+                self.story.append(Spacer(1, 0.2 * inch))
+                table = Table(data, colWidths=[0.28 * width, 0.13 * width, 0.07 * width] +
+                              6 * [0.065 * width], repeatRows=1)
+                table.setStyle(self.doc.tablestyle)
+                self.story.append(table)
+                self.story.append(PageBreak())
+
+        # The pages are written as soon as their graph is rendered, so
+        # building the pdf overlaps with the graph creation
+        self.doc.start_stream()
+        self.flush_story()
+
         start_time = time.time()
+        global progress_total
+        progress_total = len(self.all_graphs)
+        # Only the graph descriptors are sent to the workers
+        graphs = [(label, fname, metrics, indom_regexes, histogram) for
+                  (label, fname, metrics, text, indom_regexes, histogram)
+                  in self.all_graphs]
+        # Set this to False to disable multiprocessing
+        if True:
+            cpus = self.opts.max_cpus or multiprocessing.cpu_count()
+            pool = multiprocessing.Pool(cpus, init_graph_worker, (self,))
+            costs = [self.graph_cost(metrics) for (label, fname, metrics, indom_regexes,
+                                                   histogram) in graphs]
+            rets = ordered_results(pool, graph_wrapper, graphs, costs, 2 * cpus)
+        else: # This is just to debug in non multi-threaded mode
+            pool = None
+            init_graph_worker(self)
+            rets = map(graph_wrapper, graphs)
+
         # Add the graphs to the pdf
         last_category = ''
-        for graph in done_metrics:
-            (label, fname, metrics, text, indom_res, histogram) = graph
-            category = self.get_category(label, metrics)
-            if last_category != category:
-                self._do_heading(category, self.doc.fonts["heading1"])
-                last_category = category
-
-            self._do_heading(label, self.doc.fonts["heading2_invisible"])
-            self.story.append(Image(fname, width=self.doc.graph_size[0] * inch,
-                                    height=self.doc.graph_size[1] * inch))
-            if text:
-                self.story.append(Paragraph(text, self.doc.fonts["normal"]))
-            self.story.append(PageBreak())
+        with self.instrumentation.stage('graphs'):
+            try:
+                for (graph, (ret, drawing, stats)) in zip(self.all_graphs, rets):
+                    self.instrumentation.add_worker('graph', stats)
+                    if not ret:
+                        continue
+                    (label, fname, metrics, text, indom_res, histogram) = graph
+                    self.instrumentation.add_graph(label, stats['render_seconds'],
+                                                   stats['image_bytes'])
+                    category = self.get_category(label, metrics)
+                    if last_category != category:
+                        self._do_heading(category, self.doc.fonts["heading1"])
+                        last_category = category
+
+                    self._do_heading(label, self.doc.fonts["heading2_invisible"])
+                    self.story.append(self._graph_flowable(fname, drawing))
+                    if text:
+                        self.story.append(Paragraph(text, self.doc.fonts["normal"]))
+                    self.story.append(PageBreak())
+                    self.flush_story()
+                    # The image is now part of the pdf
+                    os.remove(fname)
+            except BaseException:
+                # Do not leave the queued graphs running after an error
+                if pool is not None:
+                    pool.terminate()
+                raise
+            if pool is not None:
+                pool.close()
+                pool.join()
+        tdelta = time.time() - start_time
+        sys.stdout.write('\rCreating graphs: [########## 100.0%%] - %.2fs' % tdelta)
+        sys.stdout.flush()
+        print()
 
-        self.doc.multiBuild(self.story)
+        print("Building pdf: ", end='')
+        sys.stdout.flush()
+        start_time = time.time()
+        with self.instrumentation.stage('pdf_save'):
+            self.doc.end_stream()
         tdelta = time.time() - start_time
         print("{0} - {1:.2f}s".format(self.opts.output_file, tdelta))
         shutil.rmtree(self.tempdir)
+        self.instrumentation.write_profiles()
+        if self.opts.stats_json:
+            self.instrumentation.write_json(self.opts.stats_json)
@@ -71,6 +71,32 @@ class PcpDocTemplate(BaseDocTemplate):
             tmp_ps.__dict__.update(items)
             self.fonts[font] = tmp_ps
 
+    def start_stream(self):
+        """Starts an incremental build of the document
+
+        Flowables passed to add_flowables() are laid out and drawn right
+        away instead of being kept in a story until the end. The outline
+        is filled in by afterFlowable() as the headings are drawn, so a
+        single pass is enough. Note that reportlab still keeps every
+        finished page, images included, until end_stream() saves the
+        document, so the memory usage grows with the number of pages.
+        """
+        self._indexingFlowables = []
+        self._startBuild()
+        self.canv._doctemplate = self
+
+    def add_flowables(self, flowables):
+        """Lays out and draws the flowables on the current pages."""
+        flowables = list(flowables)
+        while flowables:
+            self.clean_hanging()
+            self.handle_flowable(flowables)
+
+    def end_stream(self):
+        """Finishes the last page and saves the document."""
+        del self.canv._doctemplate
+        self._endBuild()
+
     def afterFlowable(self, flowable):
         """Registers TOC entries."""
         if flowable.__class__.__name__ == 'Paragraph':
@@ -0,0 +1,188 @@
+# pcp2pdf.summary - pcp2pdf(1) report graphing utility
+# Copyright (C) 2014  Michele Baldessari
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+import numpy
+
+# Columns of the summary of every series. The value statistics are NaN for
+# string metrics and for series without samples
+FIELDS = ('count', 'min', 'max', 'mean', 'stddev', 'p50', 'p95', 'p99',
+          'first', 'last')
+
+# Number of samples summarized at once, see summarize()
+SUMMARY_CHUNK_SIZE = 1 << 20
+# Number of series summarized at once, so their index fits an uint16 and the
+# per series ordering is a radix sort
+SUMMARY_CHUNK_SERIES = 1 << 16
+
+# Percentile columns and the matching quantiles
+PERCENTILES = (('p50', 0.50), ('p95', 0.95), ('p99', 0.99))
+
+
+def _summarize_chunk(series, present, columns):
+    '''Fills in the value columns of the non-empty series at indexes present
+
+    The values of these series are concatenated and every statistic is
+    computed for all of them at once with segmented numpy reductions.
+    '''
+    sizes = numpy.array([len(series[i]) for i in present], dtype=numpy.int64)
+    values = numpy.concatenate([numpy.asarray(series[i].values, dtype=numpy.float64)
+                                for i in present])
+    starts = numpy.concatenate(([0], numpy.cumsum(sizes)[:-1]))
+    segments = numpy.repeat(numpy.arange(len(present)), sizes)
+
+    mean = numpy.add.reduceat(values, starts) / sizes
+    # Two passes, so large counter values do not lose precision
+    deviations = values - mean[segments]
+    columns['mean'][present] = mean
+    columns['stddev'][present] = numpy.sqrt(
+        numpy.add.reduceat(deviations * deviations, starts) / sizes)
+    del deviations
+    columns['min'][present] = numpy.minimum.reduceat(values, starts)
+    columns['max'][present] = numpy.maximum.reduceat(values, starts)
+
+    # Sort the values within each series once for all the percentiles: a
+    # global sort followed by a stable (radix) sort on the series index is
+    # several times faster than lexsort()
+    order = numpy.argsort(values)
+    order = order[numpy.argsort(segments[order].astype(numpy.uint16), kind='stable')]
+    ordered = values[order]
+    del order
+    for (field, quantile) in PERCENTILES:
+        position = starts + quantile * (sizes - 1)
+        low = numpy.floor(position).astype(numpy.int64)
+        high = numpy.ceil(position).astype(numpy.int64)
+        columns[field][present] = ordered[low] + \
+            (ordered[high] - ordered[low]) * (position - low)
+
+
+def summarize(series):
+    '''Returns the summary columns of a list of series
+
+    The result is a dictionary of field -> numpy array with one entry per
+    series (see FIELDS). The series are summarized in chunks of about
+    SUMMARY_CHUNK_SIZE samples and at most SUMMARY_CHUNK_SERIES series (a
+    larger series makes a chunk on its own),
+    each with a single pass of segmented numpy reductions. This bounds the
+    temporary memory regardless of the size of the metric, and spilled
+    series are only read a chunk at a time. Percentiles use linear
+    interpolation like numpy.percentile().
+    '''
+    count = len(series)
+    counts = numpy.array([len(s) for s in series], dtype=numpy.int64)
+    columns = dict((field, numpy.full(count, numpy.nan)) for field in FIELDS)
+    columns['count'] = counts
+    present = numpy.flatnonzero(counts)
+    if len(present) == 0:
+        return columns
+
+    columns['first'][present] = [series[i].timestamps[0] for i in present]
+    columns['last'][present] = [series[i].timestamps[-1] for i in present]
+    if series[present[0]].dtype is None:
+        return columns
+
+    ends = numpy.cumsum(counts[present])
+    start = 0
+    while start < len(present):
+        limit = ends[start] - counts[present[start]] + SUMMARY_CHUNK_SIZE
+        end = int(numpy.searchsorted(ends, limit, side='right'))
+        end = max(start + 1, min(end, start + SUMMARY_CHUNK_SERIES))
+        _summarize_chunk(series, present[start:end], columns)
+        start = end
+    return columns
+
+
+class SummaryTable(object):
+    '''Summary statistics of every (metric, instance) series
+
+    The table is built once after parsing, so graphing, the instance
+    selection and the summary page do not need to walk the samples again.
+    For each metric it keeps the list of its instances, the type of its
+    values and one numpy array per field of FIELDS, aligned with the
+    instances.
+    '''
+
+    def __init__(self):
+        # keys are the metrics. Value is (instances, value type, columns,
+        # positions) where positions maps each instance to its index
+        self.metrics = {}
+
+    @classmethod
+    def build(cls, store):
+        '''Returns the summary table of all the series of a SeriesStore.'''
+        table = cls()
+        for metric in store:
+            table.add_metric(metric, store[metric], store.is_string_metric(metric))
+        return table
+
+    def add_metric(self, metric, instances, string=False):
+        '''Summarizes the instances (a dictionary of instance -> series) of metric.'''
+        names = list(instances)
+        if string:
+            value_type = 'string'
+        elif names:
+            value_type = str(instances[names[0]].dtype)
+        else:
+            value_type = None
+        columns = summarize([instances[name] for name in names])
+        positions = dict((name, index) for (index, name) in enumerate(names))
+        self.metrics[metric] = (names, value_type, columns, positions)
+
+    def subset(self, metrics):
+        '''Returns a table with the given metrics only.'''
+        table = SummaryTable()
+        table.metrics = dict((metric, self.metrics[metric]) for metric in metrics
+                             if metric in self.metrics)
+        return table
+
+    def __contains__(self, metric):
+        return metric in self.metrics
+
+    def __iter__(self):
+        return iter(self.metrics)
+
+    def instances(self, metric):
+        '''Returns the list of the instances of metric.'''
+        return self.metrics[metric][0]
+
+    def value_type(self, metric):
+        '''Returns 'string' or the name of the numpy type of the values.'''
+        return self.metrics[metric][1]
+
+    def is_string_metric(self, metric):
+        return self.value_type(metric) == 'string'
+
+    def column(self, metric, field):
+        '''Returns the field of all the instances of metric as an array.'''
+        return self.metrics[metric][2][field]
+
+    def select(self, metric, field, instances):
+        '''Returns the field of the given instances of metric as an array.'''
+        (names, value_type, columns, positions) = self.metrics[metric]
+        return columns[field][[positions[instance] for instance in instances]]
+
+    def row(self, metric, instance):
+        '''Returns the summary of one series as a dictionary.'''
+        (names, value_type, columns, positions) = self.metrics[metric]
+        index = positions[instance]
+        ret = dict((field, columns[field][index].item()) for field in FIELDS)
+        ret['type'] = value_type
+        return ret
+
+    def total_count(self, metric):
+        '''Returns the number of samples of all the instances of metric.'''
+        return int(self.column(metric, 'count').sum())
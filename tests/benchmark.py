@@ -0,0 +1,264 @@
+"""
+Benchmark harness for pcp2pdf. It generates synthetic PCP archives through
+the PCP log import API and measures the parse, graph and end-to-end
+throughput and peak memory usage. It is not part of the unit tests, run it
+from the top directory:
+
+    python3 tests/benchmark.py --metrics 50 --instances 100 --samples 1440 \\
+        --churn 0.01 --output results.json --compare previous.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import os.path
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+# Make src/pcp2pdf importable when run from the top directory
+basedir = os.path.split(os.path.dirname(os.path.abspath(__file__)))[0]
+sys.path.insert(0, os.path.join(basedir, "src"))
+
+import cpmapi as c_api
+from pcp import pmi
+
+SCENARIOS = ('parse', 'graph', 'e2e')
+# Start of the generated archives: 2014-05-30 00:00:00 UTC
+ARCHIVE_START = 1401408000
+DOMAIN = 510
+
+
+def generate_archive(path, metrics, instances, samples, interval=60,
+                     churn=0.0, seed=0):
+    '''Writes a synthetic archive with metrics x instances x samples values
+
+    Half of the metrics are counters and half instantaneous values. Every
+    sample, a churn fraction of the instances exits and is replaced by new
+    ones, like processes in the proc.* metrics. Returns the number of values
+    written.
+    '''
+    rand = random.Random(seed)
+    log = pmi.pmiLogImport(path)
+    log.pmiSetHostname('benchmark')
+    log.pmiSetTimezone('UTC')
+    indom = log.pmiInDom(DOMAIN, 1)
+    units = log.pmiUnits(0, 0, 1, 0, 0, 0)
+    names = []
+    for item in range(metrics):
+        if item % 2:
+            (name, sem) = ('bench.counter%d' % item, c_api.PM_SEM_COUNTER)
+        else:
+            (name, sem) = ('bench.instant%d' % item, c_api.PM_SEM_INSTANT)
+        log.pmiAddMetric(name, log.pmiID(DOMAIN, 0, item), c_api.PM_TYPE_U64,
+                         indom, sem, units)
+        names.append(name)
+
+    active = list(range(instances))
+    next_inst = instances
+    added = set()
+    counters = {}
+    written = 0
+    for sample in range(samples):
+        if sample and churn:
+            exits = int(round(len(active) * churn))
+            for inst in rand.sample(active, exits):
+                active.remove(inst)
+            active.extend(range(next_inst, next_inst + exits))
+            next_inst += exits
+        for inst in active:
+            if inst not in added:
+                log.pmiAddInstance(indom, 'pid%d' % inst, inst)
+                added.add(inst)
+        for (item, name) in enumerate(names):
+            for inst in active:
+                if item % 2:
+                    key = (item, inst)
+                    counters[key] = counters.get(key, 0) + rand.randint(0, 1000)
+                    value = counters[key]
+                else:
+                    value = rand.randint(0, 1000)
+                log.pmiPutValue(name, 'pid%d' % inst, str(value))
+                written += 1
+        log.pmiWrite(ARCHIVE_START + sample * interval, 0)
+    log.pmiEnd()
+    del log
+    return written
+
+
+def max_rss_kb():
+    '''Returns the peak RSS in KB of this process and of its children.'''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def get_options(argv):
+    '''Parses argv like pcp2pdf does and returns the options object.'''
+    import pcp2pdf.__main__
+    sys.argv = argv
+    opts = pcp2pdf.__main__._Options()
+    pcp2pdf.__main__.opts = opts
+    if c_api.pmGetOptionsFromList(argv) != 0:
+        raise Exception("Unable to parse the options: {0}".format(argv))
+    return opts
+
+
+def run_parse(archive, workdir):
+    '''Parses the whole archive with PcpArchive.get_values().'''
+    from pcp2pdf.archive import PcpArchive
+    opts = get_options(['pcp2pdf', '--no-cache', '-a', archive])
+    start_time = time.time()
+    pcparchive = PcpArchive([archive], opts)
+    (data, skipped) = pcparchive.get_values()
+    seconds = time.time() - start_time
+    return {'seconds': seconds,
+            'samples': pcparchive.extracted_values,
+            'samples_per_sec': pcparchive.extracted_values / seconds}
+
+
+def run_graph(archive, workdir):
+    '''Renders all the graphs of a parsed archive in a single process.'''
+    import pcp2pdf.stats
+    opts = get_options(['pcp2pdf', '--no-cache', '-a', archive,
+                        '-o', os.path.join(workdir, 'graph.pdf')])
+    pcpstats = pcp2pdf.stats.PcpStats([archive], opts)
+    pcpstats.rate_converted = pcpstats.parse()
+    pcpstats.build_gap_index()
+    (all_graphs, string_metrics) = pcpstats.get_all_graphs()
+    pcp2pdf.stats.progress_total = len(all_graphs)
+    pcp2pdf.stats.init_graph_worker(pcpstats)
+    start_time = time.time()
+    graphs = 0
+    for (label, fname, metrics, text, indom_regexes, histogram) in all_graphs:
+        (ret, drawing, stats) = pcp2pdf.stats.graph_wrapper((label, fname, metrics,
+                                                             indom_regexes, histogram))
+        graphs += int(bool(ret))
+    seconds = time.time() - start_time
+    print()
+    shutil.rmtree(pcpstats.tempdir)
+    return {'seconds': seconds, 'graphs': graphs,
+            'graphs_per_sec': graphs / seconds}
+
+
+def run_e2e(archive, workdir):
+    '''Runs pcp2pdf as from the command line.'''
+    import pcp2pdf.__main__
+    stats_json = os.path.join(workdir, 'stats.json')
+    sys.argv = ['pcp2pdf', '--no-cache', '-a', archive,
+                '-o', os.path.join(workdir, 'e2e.pdf'),
+                '--stats-json', stats_json]
+    start_time = time.time()
+    pcp2pdf.__main__.main()
+    seconds = time.time() - start_time
+    with open(stats_json) as json_file:
+        report = json.load(json_file)
+    graphs = report['counters'].get('graphs', 0)
+    samples = report['counters'].get('extracted_values', 0)
+    return {'seconds': seconds, 'graphs': graphs, 'samples': samples,
+            'graphs_per_sec': graphs / seconds,
+            'samples_per_sec': samples / seconds,
+            'stages': dict((name, stage['seconds']) for (name, stage)
+                           in report['stages'].items())}
+
+
+def _scenario_process(scenario, archive, workdir, results):
+    try:
+        result = globals()['run_' + scenario](archive, workdir)
+        result['max_rss_kb'] = max_rss_kb()
+    except BaseException:
+        import traceback
+        result = {'error': traceback.format_exc()}
+    results.put(result)
+
+
+def run_scenario(scenario, archive, workdir):
+    '''Runs scenario in a new process so that its peak RSS is its own.'''
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_scenario_process,
+                                      args=(scenario, archive, workdir, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if 'error' in result:
+        raise Exception("Scenario {0} failed:\n{1}".format(scenario, result['error']))
+    return result
+
+
+def compare(results, previous):
+    '''Prints the change of every measure of results against previous.'''
+    for scenario in results['scenarios']:
+        if scenario not in previous['scenarios']:
+            continue
+        old = previous['scenarios'][scenario]
+        new = results['scenarios'][scenario]
+        for measure in sorted(new):
+            if measure in old and isinstance(new[measure], (int, float)) and old[measure]:
+                change = (new[measure] - old[measure]) * 100.0 / old[measure]
+                print("{0:6s} {1:18s} {2:14.2f} -> {3:14.2f} ({4:+.1f}%)".format(
+                    scenario, measure, old[measure], new[measure], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pcp2pdf benchmark")
+    parser.add_argument('--metrics', type=int, default=20)
+    parser.add_argument('--instances', type=int, default=50)
+    parser.add_argument('--samples', type=int, default=1440)
+    parser.add_argument('--interval', type=int, default=60,
+                        help="seconds between two samples")
+    parser.add_argument('--churn', type=float, default=0.0,
+                        help="fraction of the instances replaced every sample")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS),
+                        help="comma separated list of: %s" % ", ".join(SCENARIOS))
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of a previous run")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the generated archive and reports")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("Unknown scenario: {0}".format(scenario))
+
+    workdir = tempfile.mkdtemp(prefix='pcp2pdf-bench', dir='/var/tmp')
+    archive = os.path.join(workdir, 'bench')
+    start_time = time.time()
+    values = generate_archive(archive, args.metrics, args.instances,
+                              args.samples, args.interval, args.churn, args.seed)
+    print("Generated {0} values in {1:.2f}s: {2}".format(
+        values, time.time() - start_time, archive))
+
+    results = {'python': platform.python_version(),
+               'cpus': multiprocessing.cpu_count(),
+               'archive': {'metrics': args.metrics, 'instances': args.instances,
+                           'samples': args.samples, 'interval': args.interval,
+                           'churn': args.churn, 'seed': args.seed,
+                           'values': values},
+               'scenarios': {}}
+    try:
+        for scenario in scenarios:
+            result = run_scenario(scenario, archive, workdir)
+            results['scenarios'][scenario] = result
+            print("{0}: {1}".format(scenario, json.dumps(result, sort_keys=True)))
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    if args.output:
+        with open(args.output, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as json_file:
+            compare(results, json.load(json_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+"""
+Test unit for the pcp2pdf archive parsing. This is only meant to be run from
+the current directory via ./setup.py test
+
+The PCP contexts are replaced by FakeContext, so no archive is needed, but
+the pcp python bindings still have to be installed.
+"""
+
+from __future__ import print_function
+
+import os
+import os.path
+from pkgutil import extend_path
+import shutil
+import sys
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+# Get the path at ../tests/test_archive.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+try:
+    import cpmapi as c_api
+    from pcp import pmapi
+    from pcp2pdf import archive
+    HAVE_PCP = True
+except ImportError:
+    HAVE_PCP = False
+
+
+class FakeUnits(object):
+    """pmUnits look-alike"""
+    def __init__(self, dimSpace=0, dimTime=0, dimCount=0):
+        self.dimSpace = dimSpace
+        self.dimTime = dimTime
+        self.dimCount = dimCount
+        self.scaleSpace = self.scaleTime = self.scaleCount = 0
+
+
+class FakeDesc(object):
+    """pmDesc look-alike, desc.contents is the desc itself"""
+    def __init__(self, mtype, indom, units=None):
+        self.contents = self
+        self.type = mtype
+        self.indom = indom
+        self.sem = 0
+        self.units = units or FakeUnits()
+
+
+class FakeAtom(object):
+    """pmAtomValue look-alike holding the same value for every type"""
+    def __init__(self, value):
+        self.l = self.ul = self.ll = self.ull = self.f = self.d = value
+
+
+class FakeResult(object):
+    """pmResult look-alike. values is a list of (pmid, [(inst, value), ..])"""
+    def __init__(self, secs, values):
+        self.contents = self
+        self.timestamp = pmapi.timeval(secs, 0)
+        self.values = values
+        self.numpmid = len(values)
+
+    def get_pmid(self, i):
+        return self.values[i][0]
+
+    def get_numval(self, i):
+        return len(self.values[i][1])
+
+    def get_inst(self, i, j):
+        return self.values[i][1][j][0]
+
+    def get_valfmt(self, i):
+        return 0
+
+    def get_vlist(self, i, j):
+        return self.values[i][1][j][1]
+
+
+class FakeContext(object):
+    """Archive context serving metrics = {name: (pmid, indom, samples)}
+
+    samples is a list of (secs, [(inst, value), ..]). The metrics are
+    doubles without units unless set in descs = {pmid: FakeDesc} and the
+    instance names are 'inst<N>'. The pmids in missing_descs have no
+    descriptor.
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.descs = {}
+        self.missing_descs = set()
+        self.lookups = 0
+        self.desc_lookups = 0
+        self.units_strs = 0
+        self.type_strs = 0
+        self.fetched = []
+        self.results = None
+
+    def pmTraversePMNS(self, name, callback):
+        for metric in sorted(self.metrics):
+            callback(metric.encode('utf-8'))
+
+    def pmLookupName(self, names, relaxed=0):
+        self.lookups += 1
+        if not isinstance(names, list):
+            names = [names]
+        if not relaxed and any(name not in self.metrics for name in names):
+            raise pmapi.pmErr(-12357)
+        return [self.metrics[name][0] if name in self.metrics else c_api.PM_ID_NULL
+                for name in names]
+
+    def pmLookupDescs(self, pmids):
+        self.desc_lookups += 1
+        if c_api.PM_ID_NULL in pmids or self.missing_descs.intersection(pmids):
+            raise pmapi.pmErr(-12357)
+        return [self._desc(pmid) for pmid in pmids]
+
+    def pmLookupDesc(self, pmid):
+        self.desc_lookups += 1
+        if pmid == c_api.PM_ID_NULL or pmid in self.missing_descs:
+            raise pmapi.pmErr(-12357)
+        return self._desc(pmid)
+
+    def _desc(self, pmid):
+        if pmid in self.descs:
+            return self.descs[pmid]
+        for (metric_pmid, indom, samples) in self.metrics.values():
+            if metric_pmid == pmid:
+                return FakeDesc(c_api.PM_TYPE_DOUBLE, indom)
+
+    def pmUnitsStr(self, units):
+        self.units_strs += 1
+        return 'units(%d,%d,%d)' % (units.dimSpace, units.dimTime, units.dimCount)
+
+    def pmTypeStr(self, mtype):
+        self.type_strs += 1
+        return 'type%d' % mtype
+
+    def pmGetInDomArchive(self, desc):
+        insts = sorted(set(inst for (pmid, indom, samples) in self.metrics.values()
+                           for (secs, values) in samples for (inst, value) in values))
+        return (insts, ['inst%d' % inst for inst in insts])
+
+    def pmSetMode(self, mode, start, interval):
+        # Always rewinds to the first sample, the parse workers have to skip
+        # the ones before their window
+        times = sorted(set(secs for (pmid, indom, samples) in self.metrics.values()
+                           for (secs, values) in samples))
+        self.results = iter(times)
+
+    def pmFetch(self, pmids):
+        self.fetched.append(list(pmids))
+        try:
+            secs = next(self.results)
+        except StopIteration:
+            raise pmapi.pmErr(c_api.PM_ERR_EOL)
+        values = []
+        for (pmid, indom, samples) in self.metrics.values():
+            if pmid in pmids:
+                values.extend((pmid, v) for (t, v) in samples if t == secs)
+        return FakeResult(secs, values)
+
+    def pmExtractValue(self, valfmt, vlist, intype, outtype):
+        # Values which are pmErr codes are raised
+        if isinstance(vlist, int):
+            raise pmapi.pmErr(vlist)
+        return FakeAtom(vlist)
+
+    def pmFreeResult(self, result):
+        pass
+
+
+def make_archive(start, end, interval=0, archives=None, archive_starts=()):
+    """Returns a PcpArchive covering [start, end] seconds without a context"""
+    pcparchive = archive.PcpArchive.__new__(archive.PcpArchive)
+    pcparchive.pcparchive = archives or 'archive'
+    pcparchive.archive_starts = [secs * 10**6 for secs in archive_starts]
+    pcparchive.start = pmapi.timeval(start, 0)
+    pcparchive.end = pmapi.timeval(end, 0)
+    pcparchive.interval = interval
+    pcparchive.metadata = {}
+    pcparchive.metadata_calls = 0
+    pcparchive.fetch_calls = 0
+    pcparchive.extracted_values = 0
+    pcparchive.instances = {}
+    pcparchive.loaded_indoms = set()
+    pcparchive.spill_dir = None
+    pcparchive.spill_bytes = 0
+    pcparchive.pmns = {}
+    pcparchive.skipped = []
+    return pcparchive
+
+
+class StrictContext(FakeContext):
+    """Context of python bindings without relaxed name lookups"""
+    def pmLookupName(self, names):
+        return FakeContext.pmLookupName(self, names)
+
+
+@unittest.skipUnless(HAVE_PCP, "the pcp python bindings are not installed")
+class TestLookups(unittest.TestCase):
+    """Batched name and descriptor lookups"""
+
+    def setUp(self):
+        self.metrics = {'kernel.all.load': (1, c_api.PM_INDOM_NULL, []),
+                        'disk.dev.read': (2, 7, []),
+                        'disk.dev.write': (3, 7, [])}
+        self.names = ['disk.dev.read', 'unknown.metric', 'kernel.all.load']
+
+    def test_relaxed_names(self):
+        ctx = FakeContext(self.metrics)
+        self.assertEqual(archive.lookup_names(ctx, self.names), [2, c_api.PM_ID_NULL, 1])
+        self.assertEqual(ctx.lookups, 1)
+        self.assertEqual(archive.lookup_names(ctx, []), [])
+        self.assertEqual(ctx.lookups, 1)
+
+    def test_strict_names(self):
+        """Without relaxed lookups the names are resolved one by one on errors"""
+        ctx = StrictContext(self.metrics)
+        self.assertEqual(archive.lookup_names(ctx, self.names), [2, c_api.PM_ID_NULL, 1])
+        # The failed batch, then one lookup per name
+        self.assertEqual(ctx.lookups, 1 + len(self.names))
+        ctx = StrictContext(self.metrics)
+        self.assertEqual(archive.lookup_names(ctx, ['disk.dev.read', 'kernel.all.load']),
+                         [2, 1])
+        self.assertEqual(ctx.lookups, 1)
+
+    def test_relaxed_error(self):
+        ctx = FakeContext(self.metrics)
+        with mock.patch.object(ctx, 'pmLookupName', side_effect=pmapi.pmErr(-12357)):
+            self.assertEqual(archive.lookup_names(ctx, self.names),
+                             [c_api.PM_ID_NULL] * len(self.names))
+
+    def test_descs(self):
+        ctx = FakeContext(self.metrics)
+        descs = archive.lookup_descs(ctx, [2, c_api.PM_ID_NULL, 1])
+        self.assertEqual([desc and desc.indom for desc in descs],
+                         [7, None, c_api.PM_INDOM_NULL])
+        self.assertEqual(ctx.desc_lookups, 1)
+        # A failed batch falls back to one lookup per pmid
+        ctx.missing_descs.add(2)
+        descs = archive.lookup_descs(ctx, [2, 3, 1])
+        self.assertEqual([desc and desc.indom for desc in descs],
+                         [None, 7, c_api.PM_INDOM_NULL])
+        self.assertEqual(ctx.desc_lookups, 1 + 1 + 3)
+
+    def test_load_pmns(self):
+        """Descriptors are fetched in one batch, the strings once per value"""
+        ctx = FakeContext(self.metrics)
+        ctx.descs = {1: FakeDesc(c_api.PM_TYPE_FLOAT, c_api.PM_INDOM_NULL),
+                     2: FakeDesc(c_api.PM_TYPE_U64, 7, FakeUnits(dimSpace=1)),
+                     3: FakeDesc(c_api.PM_TYPE_U64, 7, FakeUnits(dimSpace=1))}
+        pcparchive = make_archive(100, 200)
+        pcparchive.ctx = ctx
+        pcparchive.load_pmns()
+        self.assertEqual(sorted(pcparchive.pmns),
+                         ['disk.dev.read', 'disk.dev.write', 'kernel.all.load'])
+        self.assertEqual((ctx.lookups, ctx.desc_lookups), (1, 1))
+        self.assertEqual((ctx.units_strs, ctx.type_strs), (2, 2))
+        self.assertEqual(pcparchive.pmns['disk.dev.write'][4:], ('units(1,0,0)', 'type3'))
+        self.assertEqual(pcparchive.pmns['kernel.all.load'][4:], ('units(0,0,0)', 'type4'))
+        self.assertEqual(sorted(pcparchive.metadata), [1, 2, 3])
+
+        # Metrics without a descriptor are skipped
+        ctx = FakeContext(dict(self.metrics, **{'other.metric': (4, c_api.PM_INDOM_NULL, [])}))
+        ctx.missing_descs.add(4)
+        pcparchive = make_archive(100, 200)
+        pcparchive.ctx = ctx
+        pcparchive.load_pmns()
+        self.assertEqual(len(pcparchive.pmns), 3)
+        self.assertEqual(pcparchive.skipped, ['other.metric'])
+        # The failed batch, then one lookup per metric
+        self.assertEqual(ctx.desc_lookups, 1 + 4)
+
+
+@unittest.skipUnless(HAVE_PCP, "the pcp python bindings are not installed")
+class TestWindowValues(unittest.TestCase):
+    """Parse workers on archive sets whose archives carry different metrics"""
+
+    def setUp(self):
+        self.contexts = {
+            'first': FakeContext({
+                'kernel.all.load': (1, c_api.PM_INDOM_NULL,
+                                    [(100, [(0, 1.0)]), (101, [(0, 2.0)])]),
+                'disk.dev.read': (2, 7, [(100, [(0, 10.0), (1, 20.0)]),
+                                         (101, [(0, 11.0), (1, 21.0)])]),
+            }),
+            # disk.dev.read is not in the second archive
+            'second': FakeContext({
+                'kernel.all.load': (1, c_api.PM_INDOM_NULL,
+                                    [(200, [(0, 3.0)]), (201, [(0, 4.0)])]),
+            }),
+        }
+        self.metrics = ['kernel.all.load', 'disk.dev.read']
+        self.pcparchive = make_archive(100, 201, archives=['first', 'second'],
+                                       archive_starts=[100, 200])
+
+    def parse(self, window):
+        def context(ctx_type, target):
+            return self.contexts[target]
+        with mock.patch.object(archive.pmapi, 'pmContext', side_effect=context):
+            return archive._get_values_worker((self.pcparchive, window, self.metrics))
+
+    def test_metric_missing_from_archive(self):
+        (data, skipped, stats) = self.parse((200 * 10**6, None))
+        ctx = self.contexts['second']
+        self.assertEqual(skipped, [])
+        self.assertEqual(list(data), ['kernel.all.load'])
+        self.assertEqual(list(data['kernel.all.load'][0].values), [3.0, 4.0])
+        # The names are resolved once and no PM_ID_NULL is ever fetched
+        self.assertEqual(ctx.lookups, 1)
+        for pmids in ctx.fetched:
+            self.assertEqual(pmids, [1])
+
+    def test_all_metrics_present(self):
+        (data, skipped, stats) = self.parse((100 * 10**6, 200 * 10**6))
+        self.assertEqual(sorted(data), self.metrics[::-1])
+        self.assertEqual(sorted(data['disk.dev.read']), ['inst0', 'inst1'])
+        self.assertEqual(list(data['disk.dev.read']['inst1'].values), [20.0, 21.0])
+        self.assertEqual(self.contexts['first'].lookups, 1)
+
+    def test_single_instance_left(self):
+        self.contexts['first'].metrics['disk.dev.read'] = (2, 7, [(100, [(1, 20.0)]),
+                                                                 (101, [(1, 21.0)])])
+        (data, skipped, stats) = self.parse((100 * 10**6, 200 * 10**6))
+        self.assertEqual(list(data['disk.dev.read']), ['inst1'])
+        self.assertEqual(list(data['disk.dev.read']['inst1'].values), [20.0, 21.0])
+
+    def test_extract_errors(self):
+        """Conversion errors skip the value, any other error is raised"""
+        self.contexts['first'].metrics['disk.dev.read'] = (
+            2, 7, [(100, [(0, 10.0), (1, c_api.PM_ERR_CONV)]), (101, [(0, 11.0)])])
+        (data, skipped, stats) = self.parse((100 * 10**6, 200 * 10**6))
+        self.assertEqual(skipped, ['disk.dev.read'])
+        self.assertEqual(list(data['disk.dev.read']['inst0'].values), [10.0, 11.0])
+        self.assertNotIn('inst1', data['disk.dev.read'])
+
+        for (metric, pmid, indom) in (('kernel.all.load', 1, c_api.PM_INDOM_NULL),
+                                      ('disk.dev.read', 2, 7)):
+            self.setUp()
+            self.contexts['first'].metrics[metric] = (
+                pmid, indom, [(100, [(0, c_api.PM_ERR_VALUE)])])
+            with self.assertRaises(pmapi.pmErr):
+                self.parse((100 * 10**6, 200 * 10**6))
+
+    def test_no_metric_in_archive(self):
+        self.metrics = ['disk.dev.read']
+        (data, skipped, stats) = self.parse((200 * 10**6, None))
+        self.assertEqual(list(data), [])
+        self.assertEqual(self.contexts['second'].fetched, [])
+
+
+@unittest.skipUnless(HAVE_PCP, "the pcp python bindings are not installed")
+class TestSplitWindows(unittest.TestCase):
+    """Time windows of the parallel parser"""
+
+    def assertContiguous(self, windows, start):
+        self.assertEqual(windows[0][0], start * 10**6)
+        self.assertIsNone(windows[-1][1])
+        for (first, second) in zip(windows, windows[1:]):
+            self.assertEqual(first[1], second[0])
+            self.assertLess(first[0], first[1])
+
+    def test_split_range(self):
+        pcparchive = make_archive(100, 200)
+        self.assertEqual(pcparchive._split_range(0, 100, 4), [0, 25, 50, 75])
+        # Never more windows than microseconds
+        self.assertEqual(pcparchive._split_range(0, 2, 4), [0, 1])
+        self.assertEqual(pcparchive._split_range(5, 5, 4), [5])
+        pcparchive.interval = 10
+        # 11 samples on the grid, the windows start on one of them
+        self.assertEqual(pcparchive._split_range(0, 100 * 10**6, 4),
+                         [0, 20 * 10**6, 50 * 10**6, 80 * 10**6])
+        self.assertEqual(pcparchive._split_range(0, 10 * 10**6, 4), [0, 10 * 10**6])
+
+    def test_windows(self):
+        windows = make_archive(100, 200).split_windows(4)
+        self.assertContiguous(windows, 100)
+        self.assertEqual([w[0] // 10**6 for w in windows], [100, 125, 150, 175])
+        self.assertEqual(make_archive(100, 100).split_windows(4), [(100 * 10**6, None)])
+
+    def test_interval_grid(self):
+        windows = make_archive(100, 200, interval=10).split_windows(3)
+        self.assertContiguous(windows, 100)
+        for (start, end) in windows:
+            self.assertEqual((start // 10**6 - 100) % 10, 0)
+
+    def test_archive_seams(self):
+        pcparchive = make_archive(100, 300, interval=10, archives=['first', 'second'],
+                                  archive_starts=[100, 155])
+        windows = pcparchive.split_windows(4)
+        self.assertContiguous(windows, 100)
+        # The second archive starts on the first grid sample after it
+        self.assertIn(160 * 10**6, [w[0] for w in windows])
+        for (start, end) in windows:
+            self.assertFalse(start < 160 * 10**6 < (end or sys.maxsize))
+        self.assertEqual([pcparchive.get_window_target(w) for w in windows],
+                         ['first'] + ['second'] * (len(windows) - 1))
+
+    def test_samples_parsed_once(self):
+        """Samples at the window seams end up in exactly one window"""
+        samples = [(secs, [(0, float(secs))]) for secs in range(100, 121)]
+        pcparchive = make_archive(100, 120)
+        timestamps = []
+        for window in pcparchive.split_windows(4):
+            ctx = FakeContext({'kernel.all.load': (1, c_api.PM_INDOM_NULL, samples)})
+            with mock.patch.object(archive.pmapi, 'pmContext', return_value=ctx):
+                (data, skipped, stats) = archive._get_values_worker(
+                    (pcparchive, window, ['kernel.all.load']))
+            timestamps.extend(data['kernel.all.load'][0].timestamps)
+        self.assertEqual(timestamps, [float(secs) for secs in range(100, 121)])
+
+
+@unittest.skipUnless(HAVE_PCP, "the pcp python bindings are not installed")
+class TestExpandArchives(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_directory(self):
+        """Directories are replaced by their archives, files are kept"""
+        for name in ('20140101.0', '20140101.meta', '20140101.index',
+                     '20140102.0.xz', '20140102.meta.xz', 'notes.txt'):
+            open(os.path.join(self.directory, name), 'w').close()
+        self.assertEqual(archive.expand_archives(['other', self.directory]),
+                         ['other'] + [os.path.join(self.directory, name)
+                                      for name in ('20140101', '20140102')])
+        self.assertEqual(archive.expand_archives([os.path.join(self.directory, 'empty')]),
+                         [os.path.join(self.directory, 'empty')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Test unit for the pcp2pdf archive cache. This is only meant to be run from
+the current directory via ./setup.py test
+"""
+
+from __future__ import print_function
+
+import os
+import os.path
+from pkgutil import extend_path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+# Get the path at ../tests/test_cache.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+from pcp2pdf.cache import ArchiveCache
+from pcp2pdf.series import SeriesStore
+from pcp2pdf.summary import SummaryTable
+
+ARCHIVE = os.path.join(os.path.dirname(mypath), 'naslog')
+
+
+class TestArchiveCache(unittest.TestCase):
+    """ArchiveCache UnitTest class"""
+    def setUp(self):
+        """Creates an empty cache directory"""
+        self.directory = tempfile.mkdtemp(prefix='pcp2pdf-test')
+        self.cache = ArchiveCache(self.directory, 1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        """The key depends on the parse options"""
+        key = self.cache.get_key([ARCHIVE], 1.0, 2.0, None, False)
+        self.assertEqual(key, self.cache.get_key([ARCHIVE], 1.0, 2.0, None, False))
+        self.assertNotEqual(key, self.cache.get_key([ARCHIVE], 1.0, 2.0, None, True))
+        self.assertNotEqual(key, self.cache.get_key([ARCHIVE], 1.0, 2.0, 60.0, False))
+
+    def test_round_trip(self):
+        """Saved data is loaded back lazily and unchanged"""
+        data = SeriesStore()
+        data.get_series('kernel.all.load', '1 minute', numpy.float32).extend([1.0, 2.0], [0.5, 1.5])
+        data.get_series('kernel.all.load', '5 minute', numpy.float32).extend([1.0], [0.25])
+        data.get_series('disk.all.read', 0, numpy.float64).extend([1.0, 2.0], [3.0, 4.0])
+        data.get_series('kernel.uname.release', 0, None).append(1.0, b'3.10')
+        rate_converted = {'disk.all.read': {0: True}, 'kernel.all.load': False}
+        metrics = sorted(data) + ['bar']
+        self.assertIsNone(self.cache.load('foo', metrics))
+        self.cache.save('foo', data, rate_converted, ['bar'], metrics,
+                        SummaryTable.build(data))
+
+        (loaded, loaded_rate_converted, skipped, summary) = self.cache.load('foo', metrics)
+        self.assertEqual(skipped, ['bar'])
+        # The summary is loaded without reading any series
+        self.assertEqual(summary.row('disk.all.read', 0)['max'], 4.0)
+        self.assertTrue(all(dict.__getitem__(loaded.series, m) is None for m in loaded.series))
+        self.assertEqual(loaded_rate_converted, rate_converted)
+        self.assertEqual(sorted(loaded), sorted(data))
+        (timestamps, values) = loaded['kernel.all.load']['5 minute']
+        self.assertEqual(timestamps.tolist(), [1.0])
+        self.assertEqual(values.tolist(), [0.25])
+        self.assertEqual(values.dtype, numpy.float32)
+        self.assertEqual(loaded['disk.all.read'][0].values.tolist(), [3.0, 4.0])
+        self.assertTrue(loaded.is_string_metric('kernel.uname.release'))
+
+    def test_metric_subset(self):
+        """Entries are only used for a subset of their fetched metrics"""
+        data = SeriesStore()
+        data.get_series('foo', 0, numpy.float64).extend([1.0], [1.0])
+        data.get_series('bar', 0, numpy.float64).extend([1.0], [2.0])
+        self.cache.save('foo', data, {'foo': False, 'bar': False}, [], ['foo', 'bar'],
+                        SummaryTable.build(data))
+        self.assertIsNone(self.cache.load('foo', ['foo', 'baz']))
+        (loaded, rate_converted, skipped, summary) = self.cache.load('foo', ['bar'])
+        self.assertEqual(list(loaded), ['bar'])
+        self.assertEqual(list(summary), ['bar'])
+        self.assertEqual(rate_converted, {'bar': False})
+
+    def test_evict(self):
+        """Least recently used entries are removed first"""
+        data = SeriesStore()
+        data.get_series('foo', 0, numpy.float64).extend(range(1000), range(1000))
+        self.cache.max_size = 1
+        self.cache.save('first', data, {}, [], ['foo'], SummaryTable.build(data))
+        self.cache.save('second', data, {}, [], ['foo'], SummaryTable.build(data))
+        self.assertIsNone(self.cache.load('first', ['foo']))
+        self.assertIsNotNone(self.cache.load('second', ['foo']))
+
+if __name__ == '__main__':
+    unittest.main()
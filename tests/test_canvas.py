@@ -0,0 +1,117 @@
+"""
+Test unit for the pcp2pdf graph canvas. This is only meant to be run from
+the current directory via ./setup.py test
+"""
+
+from __future__ import print_function
+
+import datetime
+import os
+import os.path
+from pkgutil import extend_path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import matplotlib.dates as mdates
+from matplotlib.patches import Rectangle
+import matplotlib.ticker
+import numpy
+
+# Get the path at ../tests/test_canvas.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+from pcp2pdf.canvas import GraphCanvas
+
+GRAPH_SIZE = (6, 3)
+DPI = 50
+
+
+def draw_graph(canvas, offset):
+    """Draws a time graph with lines, a band, a gap, a label and a legend"""
+    start = mdates.date2num(datetime.datetime(2014, 10, 10, 22, 0))
+    dates = start + numpy.arange(60) / 1440.0
+    axes = canvas.start('graph %d' % offset, 'values')
+    axes.fill_between(dates, dates * 0, dates * 0 + offset, color='grey', label='others')
+    axes.plot(dates, numpy.arange(60) + offset, 'o:', label='first')
+    axes.plot(dates, numpy.arange(60) * 2 + offset, 'o:', label='second')
+    axes.set_ylim(bottom=0)
+    axes.add_patch(Rectangle((dates[10], 0), 0.01, 10))
+    axes.annotate('label', xy=(dates[20], 10), xytext=(30, 30),
+                  textcoords='offset points')
+    return axes.legend(loc=1)
+
+
+def draw_heat_strip(canvas, rows):
+    """Draws a heat strip with labelled rows and a colorbar"""
+    axes = canvas.start('heat strip', 'frequency')
+    counts = numpy.arange(rows * 10).reshape(rows, 10)
+    mesh = axes.pcolormesh(numpy.arange(11), numpy.arange(rows + 1), counts)
+    canvas.colorbar(mesh, 'frequency')
+    axes.set_yticks([row + 0.5 for row in range(rows)])
+    axes.set_yticklabels(['row %d' % row for row in range(rows)])
+    axes.tick_params(axis='y', labelsize='xx-small')
+
+
+def ytick_fontsize(axes):
+    return axes.yaxis.get_major_ticks()[0].label1.get_fontsize()
+
+
+class TestGraphCanvas(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def render(self, canvas, draw, name, *args):
+        fname = os.path.join(self.directory, name)
+        legend = draw(canvas, *args)
+        canvas.save(fname, DPI, legend)
+        with open(fname, 'rb') as image:
+            return image.read()
+
+    def assertEmpty(self, axes):
+        for artists in (axes.lines, axes.patches, axes.texts, axes.collections,
+                        axes.child_axes, axes.containers):
+            self.assertEqual(len(artists), 0)
+        self.assertIsNone(axes.get_legend())
+
+    def test_reuse(self):
+        """A reused canvas draws the same graph as a new one"""
+        canvas = GraphCanvas(GRAPH_SIZE)
+        axes = canvas.axes
+        self.render(canvas, draw_graph, 'first.png', 100)
+        self.assertIs(canvas.axes, axes)
+        self.assertEmpty(axes)
+        reused = self.render(canvas, draw_graph, 'second.png', 1)
+        fresh = self.render(GraphCanvas(GRAPH_SIZE), draw_graph, 'fresh.png', 1)
+        self.assertEqual(reused, fresh)
+
+    def test_heat_strip(self):
+        """The rows of a heat strip do not leak into the next histogram"""
+        canvas = GraphCanvas(GRAPH_SIZE, histogram=True)
+        default_size = ytick_fontsize(canvas.axes)
+        self.render(canvas, draw_heat_strip, 'strip.png', 5)
+        axes = canvas.axes
+        self.assertEmpty(axes)
+        self.assertIsInstance(axes.yaxis.get_major_locator(), matplotlib.ticker.AutoLocator)
+        self.assertIsInstance(axes.yaxis.get_major_formatter(),
+                              matplotlib.ticker.ScalarFormatter)
+        self.assertEqual(ytick_fontsize(axes), default_size)
+
+        def draw_stairs(canvas):
+            axes = canvas.start('histogram', 'frequency')
+            axes.stairs([1, 5, 2], [0, 1, 2, 3], label='values')
+        reused = self.render(canvas, draw_stairs, 'reused.png')
+        fresh = self.render(GraphCanvas(GRAPH_SIZE, histogram=True), draw_stairs,
+                            'fresh.png')
+        self.assertEqual(reused, fresh)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""
+Test unit for the pcp2pdf instrumentation. This is only meant to be run
+from the current directory via ./setup.py test
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import os.path
+from pkgutil import extend_path
+import pstats
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Get the path at ../tests/test_instrument.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+from pcp2pdf.instrument import Instrumentation
+from pcp2pdf.instrument import worker_stats
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_stages(self):
+        instrumentation = Instrumentation()
+        for i in range(2):
+            with instrumentation.stage('parse'):
+                pass
+        with instrumentation.stage('graphs'):
+            pass
+        self.assertEqual(list(instrumentation.stages), ['parse', 'graphs'])
+        self.assertEqual(instrumentation.stages['parse']['calls'], 2)
+        self.assertTrue(instrumentation.stages['parse']['max_rss_kb'] > 0)
+
+    def test_workers(self):
+        instrumentation = Instrumentation()
+        for i in range(3):
+            instrumentation.add_worker('graph', worker_stats(image_bytes=10))
+        worker = instrumentation.report()['workers'][0]
+        self.assertEqual(worker['pid'], os.getpid())
+        self.assertEqual(worker['tasks'], 3)
+        self.assertEqual(worker['image_bytes'], 30)
+
+    def test_json_and_profiles(self):
+        profile_dir = os.path.join(self.tempdir, 'profiles')
+        instrumentation = Instrumentation(profile_dir)
+        with instrumentation.stage('parse'):
+            with instrumentation.stage('rate_conversion'):
+                pass
+        instrumentation.add_graph('kernel.all.load', 0.5, 1000)
+        fname = os.path.join(self.tempdir, 'stats.json')
+        instrumentation.write_json(fname)
+        instrumentation.write_profiles()
+        with open(fname) as json_file:
+            report = json.load(json_file)
+        self.assertEqual(report['counters'], {'graphs': 1, 'image_bytes': 1000})
+        self.assertEqual(list(report['stages']), ['parse'])
+        self.assertEqual(list(report['stages']['parse']['children']), ['rate_conversion'])
+        self.assertEqual(sorted(os.listdir(profile_dir)),
+                         ['parse.prof', 'rate_conversion.prof'])
+
+    def test_nested_stages(self):
+        """Nested stages are reported, and profiled, apart from their parent"""
+        instrumentation = Instrumentation(os.path.join(self.tempdir, 'profiles'))
+        with instrumentation.stage('pdf_layout'):
+            pass
+        with instrumentation.stage('graphs'):
+            for i in range(3):
+                with instrumentation.stage('pdf_layout'):
+                    sorted(range(1000))
+        stages = instrumentation.stages
+        self.assertEqual(list(stages), ['pdf_layout', 'graphs'])
+        self.assertEqual(stages['pdf_layout']['calls'], 1)
+        children = stages['graphs']['children']
+        self.assertEqual(children['pdf_layout']['calls'], 3)
+        self.assertLessEqual(children['pdf_layout']['seconds'], stages['graphs']['seconds'])
+        self.assertNotIn('children', stages['pdf_layout'])
+        self.assertEqual(instrumentation.running, [])
+
+        def calls(name, function):
+            profile = pstats.Stats(instrumentation.profiles[name])
+            return sum(stat[1] for (func, stat) in profile.stats.items()
+                       if func[2] == function)
+        # The sorts are profiled in the nested stage only
+        self.assertEqual(calls('pdf_layout', "<built-in method builtins.sorted>"), 3)
+        self.assertEqual(calls('graphs', "<built-in method builtins.sorted>"), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Test unit for the pcp2pdf metric selection. This is only meant to be run
+from the current directory via ./setup.py test
+"""
+
+from __future__ import print_function
+
+import os
+import os.path
+from pkgutil import extend_path
+import re
+import sys
+import unittest
+
+# Get the path at ../tests/test_selection.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+from pcp2pdf.selection import InstanceFilter
+from pcp2pdf.selection import PatternSet
+from pcp2pdf.selection import TopInstances
+from pcp2pdf.selection import rank_instances
+from pcp2pdf.selection import select_metrics
+from pcp2pdf.series import Series
+from pcp2pdf.summary import SummaryTable
+
+METRICS = ['kernel.all.load', 'kernel.all.cpu.user', 'mem.util.free',
+           'network.interface.in.bytes', 'network.interface.out.bytes',
+           'network.tcp.retrans']
+
+
+def loop_select(metrics, include, exclude):
+    """Reference implementation with one re.match() per pattern"""
+    selected = set(metrics)
+    if exclude:
+        selected = set(m for m in metrics
+                       if not any(re.match(p, m) for p in exclude))
+    elif include:
+        selected = set()
+    for pattern in include:
+        selected.update(m for m in metrics if re.match(pattern, m))
+    return selected
+
+
+class TestSelection(unittest.TestCase):
+    def test_same_as_loop(self):
+        cases = [([], []), (['network.*'], []), ([], ['network.*']),
+                 (['network.tcp'], ['network.*']),
+                 (['kernel.all.load', 'mem'], ['kernel', 'mem'])]
+        for (include, exclude) in cases:
+            self.assertEqual(select_metrics(METRICS, PatternSet(include),
+                                            PatternSet(exclude)),
+                             loop_select(METRICS, include, exclude))
+
+    def test_match_is_anchored(self):
+        patterns = PatternSet(['interface', 'mem'])
+        self.assertEqual(patterns.filter(METRICS), ['mem.util.free'])
+
+    def test_invalid_pattern(self):
+        self.assertRaises(re.error, PatternSet, ['network.(in'])
+
+    def test_uncombinable_patterns(self):
+        patterns = PatternSet([r'(k)ernel\.all\.\1', 'mem'])
+        self.assertEqual(patterns.filter(METRICS), ['mem.util.free'])
+
+    def test_instance_filter(self):
+        instance_filter = InstanceFilter({'network.interface.in.bytes':
+                                          ['eth', 'lo']})
+        self.assertTrue(instance_filter.match('network.interface.in.bytes', 'eth0'))
+        self.assertFalse(instance_filter.match('network.interface.in.bytes', 'virbr0'))
+        self.assertTrue(instance_filter.match('network.interface.out.bytes', 'virbr0'))
+        self.assertTrue(instance_filter.match('network.interface.in.bytes', 'lo'))
+        self.assertEqual(len(instance_filter.cache), 4)
+
+    def test_top_instances(self):
+        top = TopInstances([(r'proc\.psinfo', 5), ('proc', '10')])
+        self.assertEqual(top.limit('proc.psinfo.rss'), 5)
+        self.assertEqual(top.limit('proc.io.read_bytes'), 10)
+        self.assertIsNone(top.limit('kernel.all.load'))
+        self.assertFalse(TopInstances([]))
+        self.assertRaises(re.error, TopInstances, [('proc(', 5)])
+        self.assertRaises(ValueError, TopInstances, [('proc', 0)])
+
+    def test_rank_instances(self):
+        timestamps = [float(i) for i in range(100)]
+        instances = {
+            'idle': Series(timestamps=timestamps, values=[0] * 99 + [1]),
+            # A single spike does not make an instance busy
+            'spike': Series(timestamps=timestamps, values=[1] * 99 + [1000]),
+            'busy': Series(timestamps=timestamps, values=[50] * 100),
+            'empty': Series(timestamps=[], values=[]),
+        }
+        summary = SummaryTable()
+        summary.add_metric('proc.psinfo.rss', instances)
+        ranked = rank_instances(summary.instances('proc.psinfo.rss'),
+                                summary.column('proc.psinfo.rss', 'p95'),
+                                summary.column('proc.psinfo.rss', 'max'),
+                                summary.column('proc.psinfo.rss', 'mean'))
+        self.assertEqual(ranked, ['busy', 'spike', 'idle', 'empty'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,291 @@
+"""
+Test unit for the pcp2pdf series store. This is only meant to be run from
+the current directory via ./setup.py test
+"""
+
+from __future__ import print_function
+
+import os
+import os.path
+from pkgutil import extend_path
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+# Get the path at ../tests/test_series.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+from pcp2pdf.series import Series
+from pcp2pdf.series import SeriesStore
+from pcp2pdf.series import SPILL_MIN_ROWS
+from pcp2pdf.series import SpillStore
+from pcp2pdf.series import downsample
+from pcp2pdf.series import envelope
+from pcp2pdf.series import histograms
+from pcp2pdf.series import rate_convert
+from pcp2pdf.series import shared_edges
+
+
+def loop_rate_convert(timestamps, values):
+    """Reference per-sample implementation of the rate conversion"""
+    new_values = []
+    for v in range(1, len(values)):
+        seconds = timestamps[v] - timestamps[v - 1]
+        try:
+            delta = (values[v] - values[v - 1]) / seconds
+        except ZeroDivisionError:
+            if values[v] - values[v - 1] == 0:
+                delta = 0
+            elif v > 1:
+                delta = new_values[v - 2]
+            else:
+                delta = 0
+        new_values.append(delta)
+    return (timestamps[1:], new_values)
+
+
+class TestSeries(unittest.TestCase):
+    """Series and SeriesStore UnitTest class"""
+
+    def test_append_grows(self):
+        """Appending past the initial chunk keeps all the samples"""
+        series = Series(numpy.uint64)
+        for i in range(1000):
+            series.append(float(i), i * 2)
+        (timestamps, values) = series
+        self.assertEqual(len(series), 1000)
+        self.assertEqual(timestamps.tolist(), [float(i) for i in range(1000)])
+        self.assertEqual(values.tolist(), [i * 2 for i in range(1000)])
+        self.assertEqual(values.dtype, numpy.uint64)
+
+    def test_pickle_trims(self):
+        """Pickling only carries the used samples"""
+        series = Series(numpy.int32)
+        series.extend([1.0, 2.0], [3, 4])
+        copy = pickle.loads(pickle.dumps(series))
+        self.assertEqual(len(copy._timestamps), 2)
+        self.assertEqual(copy.values.tolist(), [3, 4])
+
+    def test_merge(self):
+        """Merging stores appends samples and keeps string metrics aside"""
+        first = SeriesStore()
+        first.get_series('a', 0, numpy.float64).append(1.0, 1.5)
+        first.get_series('s', 0, None).append(1.0, b'foo')
+        second = SeriesStore()
+        second.get_series('a', 0, numpy.float64).append(2.0, 2.5)
+        second.get_series('a', 'eth0', numpy.float64).append(2.0, 3.5)
+        second.get_series('s', 0, None).append(2.0, b'bar')
+        first.merge(second)
+        self.assertEqual(first['a'][0].values.tolist(), [1.5, 2.5])
+        self.assertEqual(list(first['a']), [0, 'eth0'])
+        self.assertTrue(first.is_string_metric('s'))
+        self.assertEqual(first['s'][0].values, [b'foo', b'bar'])
+        self.assertEqual(first.as_dict()['s'][0][1], [b'foo', b'bar'])
+
+    def test_zero_series(self):
+        """All-zero series do not allocate values and get pruned"""
+        store = SeriesStore()
+        zero = store.get_series('a', 'cpu0', numpy.uint64)
+        busy = store.get_series('a', 'cpu1', numpy.uint64)
+        for i in range(100):
+            zero.append(float(i), 0)
+            busy.append(float(i), 0 if i < 50 else i)
+        store.get_series('b', 0, numpy.uint64).append(1.0, 0)
+        self.assertIsNone(zero._values)
+        self.assertEqual(busy.values.tolist(), [0] * 50 + list(range(50, 100)))
+        self.assertEqual(pickle.loads(pickle.dumps(zero)).values.tolist(), [0] * 100)
+        store.prune()
+        self.assertEqual(list(store), ['a'])
+        self.assertEqual(list(store['a']), ['cpu1'])
+
+    def test_envelope(self):
+        """The envelope only covers the instances present at each timestamp"""
+        first = Series(numpy.uint64, [1.0, 2.0, 3.0], [1, 2, 3])
+        second = Series(numpy.uint32, [2.0, 3.0, 4.0], [10, 0, 30])
+        (timestamps, lows, highs) = envelope([first, second])
+        self.assertEqual(timestamps.tolist(), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual(lows.tolist(), [1.0, 2.0, 0.0, 30.0])
+        self.assertEqual(highs.tolist(), [1.0, 10.0, 3.0, 30.0])
+        self.assertEqual(len(envelope([])[0]), 0)
+
+    def test_envelope_buckets(self):
+        """The bucketed envelope keeps the extremes of every bucket"""
+        timestamps = [float(t) for t in range(100)]
+        first = Series(numpy.float64, timestamps, [float(t % 10) for t in range(100)])
+        second = Series(numpy.float64, timestamps, [100.0 if t == 42 else 0.0
+                                                   for t in range(100)])
+        (ts, lows, highs) = envelope([first, second], 10)
+        self.assertEqual(len(ts), 20)
+        self.assertEqual(ts[:4].tolist(), [0.0, 9.0, 10.0, 19.0])
+        self.assertEqual(lows.tolist(), [0.0] * 20)
+        self.assertEqual(highs.tolist(), [9.0] * 8 + [100.0] * 2 + [9.0] * 10)
+        # Small envelopes are not reduced
+        self.assertEqual(len(envelope([first, second], 50)[0]), 100)
+
+    def test_merge_zero_series(self):
+        """A series which is all zeros in one window only is kept"""
+        first = SeriesStore()
+        first.get_series('a', 0, numpy.uint32).extend([1.0, 2.0], [0, 0])
+        second = SeriesStore()
+        second.get_series('a', 0, numpy.uint32).extend([3.0], [7])
+        first.merge(second)
+        first.prune()
+        self.assertEqual(first['a'][0].values.tolist(), [0, 0, 7])
+
+
+class TestSpillStore(unittest.TestCase):
+    """SpillStore UnitTest class"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='pcp2pdf-test')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_flush_on_budget(self):
+        """Samples are spilled once the buffers reach max_bytes"""
+        rows = 2 * (SPILL_MIN_ROWS + 10) + 5
+        store = SpillStore(os.path.join(self.directory, 'all'), 16 * (SPILL_MIN_ROWS + 10))
+        for i in range(rows):
+            store.get_series('a', 0, numpy.uint64).append(float(i), i)
+            store.check_memory()
+        series = store['a'][0]
+        self.assertEqual(series.size, 2 * (SPILL_MIN_ROWS + 10))
+        self.assertEqual(len(series), rows)
+        (timestamps, values) = series
+        self.assertIsInstance(values, numpy.memmap)
+        self.assertEqual(timestamps.tolist(), [float(i) for i in range(rows)])
+        self.assertEqual(values.tolist(), list(range(rows)))
+
+    def test_flush_min_rows(self):
+        """A tiny budget still buffers SPILL_MIN_ROWS samples per flush"""
+        store = SpillStore(os.path.join(self.directory, 'all'), 1)
+        idle = store.get_series('b', 0, numpy.uint64)
+        idle.append(0.0, 1)
+        store.flush()
+        for i in range(SPILL_MIN_ROWS + 5):
+            store.get_series('a', 0, numpy.uint64).append(float(i), i)
+            store.check_memory()
+        self.assertEqual(store['a'][0].size, SPILL_MIN_ROWS)
+        self.assertEqual(idle.size, 1)
+
+    def test_merge_and_prune(self):
+        """Merging spilled windows appends the files in order"""
+        first = SpillStore(os.path.join(self.directory, 'window0'), 1024)
+        first.get_series('a', 0, numpy.uint32).extend([1.0, 2.0], [0, 0])
+        first.get_series('b', 0, numpy.uint32).extend([1.0, 2.0], [0, 0])
+        second = SpillStore(os.path.join(self.directory, 'window1'), 1024)
+        second.get_series('a', 0, numpy.uint32).extend([3.0], [7])
+        second.get_series('a', 1, numpy.uint32).extend([3.0], [8])
+        second.get_series('b', 0, numpy.uint32).extend([3.0], [0])
+        second = pickle.loads(pickle.dumps(second))
+        first.merge(second)
+        first.prune()
+        self.assertEqual(list(first), ['a'])
+        self.assertEqual(first['a'][0].timestamps.tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual(first['a'][0].values.tolist(), [0, 0, 7])
+        self.assertEqual(first['a'][1].values.tolist(), [8])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.directory, 'window0'))),
+                         ['0.timestamps', '0.values'])
+
+    def test_set_series(self):
+        """Rate converted series replace the spilled ones on disk"""
+        store = SpillStore(os.path.join(self.directory, 'all'), 1024)
+        store.get_series('a', 0, numpy.uint64).extend([1.0, 2.0, 3.0], [1, 3, 7])
+        store.set_series('a', 0, Series(timestamps=[2.0, 3.0], values=[2.0, 4.0]))
+        self.assertEqual(store['a'][0].values.tolist(), [2.0, 4.0])
+        self.assertEqual(store['a'][0].dtype, numpy.float64)
+        self.assertEqual(sorted(os.listdir(store.directory)),
+                         ['1.timestamps', '1.values'])
+
+
+class TestHistograms(unittest.TestCase):
+    """histograms() UnitTest class"""
+
+    def test_same_as_numpy(self):
+        """Batched binning matches numpy.histogram() on each dataset"""
+        datasets = [numpy.arange(100) % 7, numpy.array([3.0, 6.0, 6.0]),
+                    numpy.empty(0), numpy.array([0.0, numpy.nan, 6.0])]
+        edges = shared_edges(0.0, 6.0, 12)
+        counts = histograms(datasets, edges)
+        self.assertEqual(counts.shape, (4, 12))
+        for (dataset, row) in zip(datasets, counts):
+            dataset = dataset[~numpy.isnan(dataset)]
+            self.assertEqual(row.tolist(),
+                             numpy.histogram(dataset, edges)[0].tolist())
+
+    def test_edges(self):
+        """Ranges without width are widened and non-finite ones rejected"""
+        self.assertEqual(shared_edges(5, 5, 2).tolist(), [4.5, 5.0, 5.5])
+        self.assertIsNone(shared_edges(numpy.nan, 1.0, 10))
+
+
+class TestRateConvert(unittest.TestCase):
+    """rate_convert() UnitTest class"""
+
+    def test_same_as_loop(self):
+        """Increasing counters give the same results as the per-sample loop"""
+        rand = numpy.random.RandomState(42)
+        timestamps = numpy.cumsum(rand.randint(0, 3, 500)).astype(numpy.float64)
+        values = numpy.cumsum(rand.randint(0, 2**40, 500)).astype(numpy.uint64)
+        values[10:20] = values[10]
+        (ts, rates) = rate_convert(timestamps, values)
+        (ref_ts, ref_rates) = loop_rate_convert(timestamps.tolist(), values.tolist())
+        self.assertEqual(ts.tolist(), ref_ts)
+        self.assertEqual(rates.tolist(), ref_rates)
+
+    def test_wrap(self):
+        """Unsigned counters wrapping around give a positive rate"""
+        values = numpy.array([2**32 - 10, 10, 30], dtype=numpy.uint32)
+        (ts, rates) = rate_convert([0.0, 1.0, 2.0], values)
+        self.assertEqual(rates.tolist(), [20.0, 20.0])
+        values = numpy.array([2**64 - 5, 5], dtype=numpy.uint64)
+        (ts, rates) = rate_convert([0.0, 2.0], values)
+        self.assertEqual(rates.tolist(), [5.0])
+
+    def test_reset(self):
+        """Counters going backwards reuse the previous rate"""
+        values = numpy.array([100, 200, 5, 105], dtype=numpy.uint64)
+        (ts, rates) = rate_convert([0.0, 1.0, 2.0, 3.0], values)
+        self.assertEqual(rates.tolist(), [100.0, 100.0, 100.0])
+        values = numpy.array([100, 5, 105], dtype=numpy.int32)
+        (ts, rates) = rate_convert([0.0, 1.0, 2.0], values)
+        self.assertEqual(rates.tolist(), [0.0, 100.0])
+
+    def test_short(self):
+        """Series with less than two samples have no rate"""
+        (ts, rates) = rate_convert([1.0], numpy.array([1], dtype=numpy.uint32))
+        self.assertEqual(len(ts), 0)
+        self.assertEqual(len(rates), 0)
+
+
+class TestDownsample(unittest.TestCase):
+    """downsample() UnitTest class"""
+
+    def test_keeps_peaks(self):
+        """Downsampled series keep the extremes, the first and last sample"""
+        timestamps = numpy.arange(100000, dtype=numpy.float64)
+        values = numpy.sin(timestamps / 1000)
+        values[54321] = 10
+        values[70000] = -10
+        (ts, vals) = downsample(timestamps, values, 1000)
+        self.assertLessEqual(len(ts), 4000)
+        self.assertEqual((ts[0], ts[-1]), (0, 99999))
+        self.assertEqual((vals.max(), vals.min()), (10, -10))
+        self.assertTrue((numpy.diff(ts) > 0).all())
+
+    def test_small_series(self):
+        """Series already small enough are left alone"""
+        timestamps = numpy.arange(10, dtype=numpy.float64)
+        (ts, vals) = downsample(timestamps, timestamps, 5)
+        self.assertEqual(ts.tolist(), timestamps.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+"""
+Test unit for the pcp2pdf report helpers. This is only meant to be run from
+the current directory via ./setup.py test
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import os
+import os.path
+from pkgutil import extend_path
+import sys
+import time
+import unittest
+
+import numpy
+
+# Get the path at ../tests/test_stats.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+from pcp2pdf.series import SeriesStore
+try:
+    from pcp2pdf.stats import PcpStats
+    from pcp2pdf.stats import ordered_results
+    HAVE_PCP = True
+except ImportError:
+    HAVE_PCP = False
+
+
+def delayed_square(task):
+    """Returns the square of value after sleeping delay seconds"""
+    (value, delay) = task
+    time.sleep(delay)
+    return value * value
+
+
+def fail_on_three(task):
+    """Returns task, except for 3 which raises ValueError"""
+    if task == 3:
+        raise ValueError("three")
+    time.sleep(0.01)
+    return task
+
+
+@unittest.skipUnless(HAVE_PCP, "the pcp python bindings are not installed")
+class TestOrderedResults(unittest.TestCase):
+    def setUp(self):
+        self.pool = multiprocessing.Pool(3)
+
+    def tearDown(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def test_order(self):
+        """Results come out in task order whatever the costs and delays"""
+        tasks = [(i, 0.002 * ((i * 7) % 5)) for i in range(30)]
+        costs = [(i * 3) % 11 for i in range(30)]
+        for max_in_flight in (1, 2, 6, 50):
+            results = list(ordered_results(self.pool, delayed_square, tasks, costs,
+                                           max_in_flight))
+            self.assertEqual(results, [i * i for i in range(30)])
+
+    def test_error(self):
+        """The first error of a task is raised to the caller"""
+        results = []
+        with self.assertRaises(ValueError):
+            for ret in ordered_results(self.pool, fail_on_three, list(range(10)),
+                                       [1] * 10, 4):
+                results.append(ret)
+        # Nothing past the failed task is yielded
+        self.assertEqual(results, list(range(len(results))))
+        self.assertLessEqual(len(results), 3)
+
+
+def make_stats(series):
+    """Returns a PcpStats holding series = {(metric, indom): (timestamps, values)}"""
+    pcpstats = PcpStats.__new__(PcpStats)
+    pcpstats.all_data = SeriesStore()
+    for ((metric, indom), (timestamps, values)) in series.items():
+        pcpstats.all_data.get_series(metric, indom, numpy.float64).extend(timestamps, values)
+    return pcpstats
+
+
+@unittest.skipUnless(HAVE_PCP, "the pcp python bindings are not installed")
+class TestGaps(unittest.TestCase):
+    def setUp(self):
+        # One sample per second with gaps 10-20 and 30-45, the second
+        # series also misses 50-53
+        first = [float(t) for t in list(range(0, 11)) + list(range(20, 31)) +
+                 list(range(45, 61))]
+        second = [float(t) for t in list(range(0, 11)) + list(range(20, 31)) +
+                  list(range(45, 51)) + list(range(53, 61))]
+        self.pcpstats = make_stats({('a', 0): (first, [1.0] * len(first)),
+                                    ('b', 'cpu0'): (second, [2.0] * len(second))})
+        self.pcpstats.build_gap_index()
+
+    def test_index(self):
+        self.assertEqual(self.pcpstats.get_gaps(0, 60),
+                         [(10.0, 20.0), (30.0, 45.0), (50.0, 53.0)])
+
+    def test_edges(self):
+        """Gaps touching the edges of the time range are included"""
+        get_gaps = self.pcpstats.get_gaps
+        self.assertEqual(get_gaps(0, 10), [(10.0, 20.0)])
+        self.assertEqual(get_gaps(20, 30), [(10.0, 20.0), (30.0, 45.0)])
+        self.assertEqual(get_gaps(12, 18), [(10.0, 20.0)])
+        self.assertEqual(get_gaps(21, 29), [])
+        self.assertEqual(get_gaps(53, 60), [(50.0, 53.0)])
+        self.assertEqual(get_gaps(54, 60), [])
+
+    def test_no_gaps(self):
+        pcpstats = make_stats({('a', 0): ([1.0, 2.0, 3.0], [1.0, 2.0, 3.0]),
+                               ('b', 0): ([5.0], [1.0])})
+        pcpstats.build_gap_index()
+        self.assertEqual(pcpstats.get_gaps(0, 10), [])
+
+
+@unittest.skipUnless(HAVE_PCP, "the pcp python bindings are not installed")
+class TestFindMax(unittest.TestCase):
+    def test_interpolated(self):
+        """The maximum of all the instances is interpolated between samples"""
+        pcpstats = make_stats({('a', 'cpu0'): ([0.0, 10.0], [0.0, 10.0]),
+                               ('a', 'cpu1'): ([0.0, 10.0], [8.0, 2.0]),
+                               ('b', 0): ([4.0, 6.0], [100.0, 100.0])})
+        max_values = pcpstats.find_max(numpy.array([0.0, 2.5, 5.0, 7.5, 10.0]), ['a'])
+        self.assertEqual(max_values.tolist(), [8.0, 6.5, 5.0, 7.5, 10.0])
+        max_values = pcpstats.find_max(numpy.array([2.0, 5.0]), ['a', 'b'])
+        self.assertEqual(max_values.tolist(), [6.8, 100.0])
+
+    def test_outside(self):
+        """Timestamps outside of the data get -sys.maxsize"""
+        pcpstats = make_stats({('a', 0): ([4.0, 6.0], [1.0, 3.0]),
+                               ('a', 1): ([5.0, 8.0], [0.0, 0.0])})
+        max_values = pcpstats.find_max(numpy.array([3.0, 4.0, 7.0, 9.0]), ['a'])
+        missing = float(-sys.maxsize)
+        self.assertEqual(max_values.tolist(), [missing, 1.0, 0.0, missing])
+
+
+if __name__ == '__main__':
+    unittest.main()
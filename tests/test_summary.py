@@ -0,0 +1,115 @@
+"""
+Test unit for the pcp2pdf series summary. This is only meant to be run
+from the current directory via ./setup.py test
+"""
+
+from __future__ import print_function
+
+import math
+import os
+import os.path
+from pkgutil import extend_path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+# Get the path at ../tests/test_summary.py and import
+# src/pcp2pdf
+mypath = os.path.join(sys.modules['tests'].__file__)
+basedir = os.path.split(os.path.dirname(mypath))[0]
+moduledir = os.path.join(basedir, "src")
+extend_path(moduledir, 'pcp2pdf')
+from pcp2pdf.series import Series
+from pcp2pdf.series import SeriesStore
+from pcp2pdf.series import SpillStore
+from pcp2pdf.summary import SummaryTable
+from pcp2pdf.summary import summarize
+from pcp2pdf import summary
+
+
+class TestSummary(unittest.TestCase):
+    def test_same_as_numpy(self):
+        """The statistics match numpy on each series"""
+        rand = random.Random(0)
+        series = []
+        for size in (1, 2, 7, 100, 0, 33):
+            values = [rand.randint(0, 1 << 40) for _ in range(size)]
+            series.append(Series(numpy.uint64, [float(i) for i in range(size)], values))
+        columns = summarize(series)
+        for (i, s) in enumerate(series):
+            self.assertEqual(columns['count'][i], len(s))
+            if not len(s):
+                self.assertTrue(math.isnan(columns['mean'][i]))
+                continue
+            values = s.values.astype(numpy.float64)
+            self.assertEqual(columns['min'][i], values.min())
+            self.assertEqual(columns['max'][i], values.max())
+            self.assertAlmostEqual(columns['mean'][i], values.mean(), delta=1e-3)
+            self.assertAlmostEqual(columns['stddev'][i], values.std(), delta=1e-3)
+            for (field, q) in (('p50', 50), ('p95', 95), ('p99', 99)):
+                self.assertAlmostEqual(columns[field][i],
+                                       numpy.percentile(values, q), delta=1e-3)
+            self.assertEqual(columns['first'][i], 0.0)
+            self.assertEqual(columns['last'][i], len(s) - 1.0)
+
+    def test_table(self):
+        """The table keeps the type of the values and the string metrics"""
+        store = SeriesStore()
+        store.get_series('a', 'cpu0', numpy.uint32).extend([1.0, 2.0], [4, 6])
+        store.get_series('a', 'cpu1', numpy.uint32).extend([1.0, 2.0, 3.0], [1, 2, 3])
+        store.get_series('s', 0, None).extend([1.0, 5.0], [b'foo', b'bar'])
+        table = SummaryTable.build(store)
+        self.assertEqual(table.instances('a'), ['cpu0', 'cpu1'])
+        self.assertEqual(table.value_type('a'), 'uint32')
+        self.assertEqual(table.total_count('a'), 5)
+        row = table.row('a', 'cpu0')
+        self.assertEqual((row['count'], row['min'], row['max'], row['mean']),
+                         (2, 4.0, 6.0, 5.0))
+        self.assertTrue(table.is_string_metric('s'))
+        row = table.row('s', 0)
+        self.assertEqual((row['count'], row['first'], row['last']), (2, 1.0, 5.0))
+        self.assertTrue(math.isnan(row['mean']))
+
+    def test_chunks(self):
+        """Summarizing in several chunks gives the same columns"""
+        rand = random.Random(1)
+        series = [Series(numpy.float64, [float(i) for i in range(size)],
+                         [rand.random() for _ in range(size)])
+                  for size in (5, 0, 3, 12, 1, 7)]
+        whole = summarize(series)
+        limits = (summary.SUMMARY_CHUNK_SIZE, summary.SUMMARY_CHUNK_SERIES)
+        for (chunk_size, chunk_series) in ((8, limits[1]), (limits[0], 2)):
+            try:
+                summary.SUMMARY_CHUNK_SIZE = chunk_size
+                summary.SUMMARY_CHUNK_SERIES = chunk_series
+                chunked = summarize(series)
+            finally:
+                (summary.SUMMARY_CHUNK_SIZE, summary.SUMMARY_CHUNK_SERIES) = limits
+            for field in whole:
+                numpy.testing.assert_allclose(whole[field], chunked[field], rtol=1e-12)
+
+    def test_spilled(self):
+        """Spilled series give the same summary as in-memory ones"""
+        directory = tempfile.mkdtemp()
+        try:
+            store = SpillStore(directory, 0)
+            memory = SeriesStore()
+            for s in (store, memory):
+                s.get_series('a', 'cpu0', numpy.float64).extend([1.0, 2.0, 3.0], [3.5, 1.0, 2.0])
+                s.get_series('a', 'cpu1', numpy.float64).extend([1.0, 2.0], None)
+            store.flush()
+            spilled = SummaryTable.build(store)
+            table = SummaryTable.build(memory)
+            for instance in ('cpu0', 'cpu1'):
+                self.assertEqual(spilled.row('a', instance), table.row('a', instance))
+            self.assertEqual(table.row('a', 'cpu1')['p95'], 0.0)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()